@@ -1,7 +1,7 @@
 import vapoursynth as vs
 from vardautomation import FileInfo, MplsReader, PresetBD, PresetWEB, PresetAAC
 
-from common import Encoder, EightySixFiltering
+from common import Encoder, EightySixFiltering, audio_only_idx
 
 core = vs.core
 
@@ -29,6 +29,7 @@ NCED = FileInfo(
 WEB = FileInfo(
     f"./WEB/86 - Eighty Six - S01 - FRENCH 1080p WEB x264 -NanDesuKa (CR)/86 - Eighty Six - S01E{EP_NUM} - FRENCH 1080p WEB x264 -NanDesuKa (CR).mkv",
     trims_or_dfs=(None, None),
+    idx=audio_only_idx,
     preset=[PresetWEB, PresetAAC]
 )
 
@@ -53,13 +54,13 @@ filtered = flt.filter()
 
 
 if __name__ == "__main__":
-    Encoder(JP_BD, WEB, filtered, CHAPTERS, CHAPTERS_NAMES).run()
+    Encoder(JP_BD, WEB, filtered, CHAPTERS, CHAPTERS_NAMES, flt.zone_ranges).run()
 
 elif __name__ == "__vapoursynth__":
     filtered.set_output()
 
 else:
-    outputs = [JP_BD.clip_cut, WEB.clip_cut]
+    outputs = [JP_BD.clip_cut, core.ffms2.Source(WEB.path.to_str())]
 
     if not len(outputs):
         flt.filtersteps()
@@ -1,7 +1,7 @@
 import vapoursynth as vs
 from vardautomation import FileInfo, MplsReader, PresetBD, PresetWEB, PresetAAC
 
-from common import Encoder, EightySixFiltering
+from common import Encoder, EightySixFiltering, audio_only_idx
 
 core = vs.core
 
@@ -28,6 +28,7 @@ NCED = FileInfo(
 WEB = FileInfo(
     f"./WEB/86 - Eighty Six - S01 - FRENCH 1080p WEB x264 -NanDesuKa (CR)/86 - Eighty Six - S01E{EP_NUM} - FRENCH 1080p WEB x264 -NanDesuKa (CR).mkv",
     trims_or_dfs=(None, None),
+    idx=audio_only_idx,
     preset=[PresetWEB, PresetAAC]
 )
 
@@ -49,6 +50,7 @@ class Filtering(EightySixFiltering):
         # Masking is done to preserve these.
 
         import lvsfunc as lvf
+        from common.masks import masked_merge
 
         screen_ranges = [(18383, 18413)]
 
@@ -58,7 +60,7 @@ class Filtering(EightySixFiltering):
         details = core.std.Expr([detail_mask, detail_mask_blur], expr="x y -").std.Binarize(5<<8).std.Minimum().std.Maximum().std.Maximum().std.Maximum()
         details = lvf.rfs(core.std.BlankClip(details), details, screen_ranges)
 
-        scene_filter = core.std.MaskedMerge(clip, denoise, details)
+        scene_filter = masked_merge(clip, denoise, details, screen_ranges)
 
         return scene_filter
 
@@ -68,13 +70,13 @@ filtered = flt.filter()
 
 
 if __name__ == "__main__":
-    Encoder(JP_BD, WEB, filtered, CHAPTERS, CHAPTERS_NAMES).run()
+    Encoder(JP_BD, WEB, filtered, CHAPTERS, CHAPTERS_NAMES, flt.zone_ranges).run()
 
 elif __name__ == "__vapoursynth__":
     filtered.set_output()
 
 else:
-    outputs = [JP_BD.clip_cut, WEB.clip_cut]
+    outputs = [JP_BD.clip_cut, core.ffms2.Source(WEB.path.to_str())]
 
     if not len(outputs):
         flt.filtersteps()
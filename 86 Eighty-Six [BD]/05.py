@@ -1,7 +1,7 @@
 import vapoursynth as vs
 from vardautomation import FileInfo, MplsReader, PresetBD, PresetWEB, PresetAAC
 
-from common import Encoder, EightySixFiltering
+from common import Encoder, EightySixFiltering, audio_only_idx
 
 core = vs.core
 
@@ -28,6 +28,7 @@ NCED = FileInfo(
 WEB = FileInfo(
     f"./WEB/86 - Eighty Six - S01 - FRENCH 1080p WEB x264 -NanDesuKa (CR)/86 - Eighty Six - S01E{EP_NUM} - FRENCH 1080p WEB x264 -NanDesuKa (CR).mkv",
     trims_or_dfs=(None, None),
+    idx=audio_only_idx,
     preset=[PresetWEB, PresetAAC]
 )
 
@@ -52,7 +53,7 @@ filtered = flt.filter()
 
 
 if __name__ == "__main__":
-    Encoder(JP_BD, WEB, filtered, CHAPTERS, CHAPTERS_NAMES).run()
+    Encoder(JP_BD, WEB, filtered, CHAPTERS, CHAPTERS_NAMES, flt.zone_ranges).run()
 
 elif __name__ == "__vapoursynth__":
     filtered.set_output()
@@ -1,7 +1,7 @@
 import vapoursynth as vs
 from vardautomation import FileInfo, MplsReader, PresetBD, PresetWEB, PresetAAC
 
-from common import Encoder, EightySixFiltering
+from common import Encoder, EightySixFiltering, audio_only_idx
 
 core = vs.core
 
@@ -28,6 +28,7 @@ NCED = FileInfo(
 WEB = FileInfo(
     f"./WEB/86 - Eighty Six - S01 - FRENCH 1080p WEB x264 -NanDesuKa (CR)/86 - Eighty Six - S01E{EP_NUM} - FRENCH 1080p WEB x264 -NanDesuKa (CR).mkv",
     trims_or_dfs=(None, None),
+    idx=audio_only_idx,
     preset=[PresetWEB, PresetAAC]
 )
 
@@ -44,9 +45,10 @@ title_ranges = [(18466, 18533), (33927, 34046)]
 
 
 class Filtering(EightySixFiltering):
-    def filter_ed(self, clip: vs.VideoNode, denoise: vs.VideoNode, NCED: FileInfo) -> vs.VideoNode:
+    def filter_ed(self, clip: vs.VideoNode, denoise: vs.VideoNode, NCED: FileInfo) -> None:
         import vardefunc as vdf
         from vsutil import depth
+        from common.masks import masked_merge
 
         src = depth(self.JP_BD.clip_cut, 8)
 
@@ -62,7 +64,7 @@ class Filtering(EightySixFiltering):
         )
         credit_mask = depth(credit_mask, 16)
 
-        return core.std.MaskedMerge(clip, denoise, credit_mask)
+        self.range_map.add(masked_merge(clip, denoise, credit_mask, [self.ed_ranges]), [self.ed_ranges], "ED")
 
 
 flt = Filtering(JP_BD, NCOP, NCED, op_start, op_offset, ed_start, ed_offset, title_ranges)
@@ -70,7 +72,7 @@ filtered = flt.filter()
 
 
 if __name__ == "__main__":
-    Encoder(JP_BD, WEB, filtered, CHAPTERS, CHAPTERS_NAMES).run()
+    Encoder(JP_BD, WEB, filtered, CHAPTERS, CHAPTERS_NAMES, flt.zone_ranges).run()
 
 elif __name__ == "__vapoursynth__":
     filtered.set_output()
@@ -1,2 +1,3 @@
 from .encode import Encoder
-from .filtering import EightySixFiltering
\ No newline at end of file
+from .filtering import EightySixFiltering
+from .web import audio_only_idx
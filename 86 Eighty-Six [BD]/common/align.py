@@ -0,0 +1,200 @@
+"""Frame alignment of the WEB source with the BD episode, from downscaled luma fingerprints
+
+Print the trims_or_dfs of the WEB FileInfo of an episode (from the show folder):
+
+    python -m common.align 02.py
+"""
+import vapoursynth as vs
+import numpy as np
+from vardautomation import DuplicateFrame, FileInfo, Trim
+from vardautomation.status import Status
+
+import time
+from typing import List, Optional, Tuple, Union
+
+core = vs.core
+
+# first and last BD frames of a run of matching frames, and WEB frame - BD frame on the run
+Segment = Tuple[int, int, int]
+
+
+class Alignment:
+    """Matching frames of a BD and a WEB source, as runs with a constant offset"""
+
+    def __init__(self, segments: List[Segment], web_frames: int) -> None:
+        # runs of BD frames with a WEB frame, in order, the BD frames between two runs have no WEB frame
+        self.segments = segments
+        self.web_frames = web_frames
+
+
+    def __str__(self) -> str:
+        return ", ".join(f"BD {start}-{end}: WEB {start + offset}-{end + offset}" for start, end, offset in self.segments)
+
+
+    @property
+    def offset(self) -> int:
+        """Offset of the WEB source, as in web[offset:]. Only defined when no frame was dropped or inserted."""
+        if len(self.segments) != 1:
+            raise ValueError(f"Alignment: the WEB source has drops or inserts, use the trims ({self})")
+        return self.segments[0][2]
+
+
+    def trims(self) -> List[Union[Trim, DuplicateFrame]]:
+        """trims_or_dfs of the WEB FileInfo giving a clip matching the BD frame by frame.
+        The frames missing from the WEB source are filled with the previous one, or the next one at the start."""
+        trims: List[Union[Trim, DuplicateFrame]] = []
+        # last WEB frame used and next BD frame to match
+        last, bd_next = None, 0
+        for start, end, offset in self.segments:
+            start, end = max(start, -offset), min(end, self.web_frames - 1 - offset)
+            if start > end:
+                continue
+            if start > bd_next:
+                trims.append(DuplicateFrame(start + offset if last is None else last, dup=start - bd_next))
+            trims.append((start + offset, end + offset + 1))
+            last, bd_next = end + offset, end + 1
+
+        bd_frames = self.segments[-1][1] + 1
+        if last is not None and bd_next < bd_frames:
+            trims.append(DuplicateFrame(last, dup=bd_frames - bd_next))
+        return trims
+
+
+def fingerprints(
+    clip: vs.VideoNode, width: int = 64, height: int = 36, threads: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Downscaled luma of every frame, normalized to zero mean and unit norm so a fingerprint
+    doesn't depend on small level or contrast differences between the sources.
+    Returns the fingerprints (frames, width * height) and the average luma of every frame.
+
+    Args:
+    - clip: clip to fingerprint
+    - width, height: size of the fingerprints
+    - threads: number of frames requested concurrently (defaults to the core threads)
+    """
+    threads = threads or core.num_threads
+    small = core.resize.Bilinear(clip, width, height, format=vs.GRAYS)
+
+    prints = np.empty((clip.num_frames, width * height), np.float32)
+    start = time.monotonic()
+    for n, f in enumerate(small.frames(prefetch=threads, backlog=threads * 2, close=True)):
+        prints[n] = np.asarray(f[0]).ravel()
+    elapsed = time.monotonic() - start
+    Status.info(f"Fingerprinted {clip.num_frames} frames at {clip.num_frames / max(elapsed, 1e-6):.1f} fps")
+
+    levels = prints.mean(axis=1)
+    prints -= levels[:, None]
+    prints /= np.maximum(np.linalg.norm(prints, axis=1), 1e-6)[:, None]
+    return prints, levels
+
+
+def _distances(bd: np.ndarray, web: np.ndarray, start: int, end: int, offset: int) -> np.ndarray:
+    """Distance of the BD frames from start to end, exclusive, with their WEB frame, the largest one where there is none"""
+    dist = np.full(end - start, 2.0, np.float32)
+    lo, hi = max(start, -offset), min(end, len(web) - offset)
+    if lo < hi:
+        dist[lo - start:hi - start] = 1 - np.einsum("ij,ij->i", bd[lo:hi], web[lo + offset:hi + offset])
+    return dist
+
+
+def align(
+    bd: np.ndarray, bd_levels: np.ndarray, web: np.ndarray, web_levels: np.ndarray,
+    window: int = 500, max_offset: int = 2000, candidates: int = 5, threshold: float = 0.1
+) -> Alignment:
+    """Find the WEB frame of every BD frame from their fingerprints.
+    Every window of BD frames gets its best offset among the peaks of the FFT cross-correlation
+    of the luma variations, checked against the fingerprints. Where the offset changes, the exact
+    frames dropped or inserted are found by minimizing the fingerprint distances of both offsets.
+
+    Args:
+    - bd, bd_levels: BD fingerprints and average lumas
+    - web, web_levels: WEB fingerprints and average lumas
+    - window: number of BD frames with a single offset
+    - max_offset: highest offset searched, in frames
+    - candidates: number of correlation peaks checked in every window
+    - threshold: highest mean fingerprint distance of a matching window
+    """
+    def signal(levels: np.ndarray) -> np.ndarray:
+        diff = np.diff(levels, prepend=levels[:1])
+        return (diff - diff.mean()) / max(float(diff.std()), 1e-6)
+
+    bd_signal, web_signal = signal(bd_levels), signal(web_levels)
+    size = 1 << (len(web_signal) + window).bit_length()
+    web_fft = np.fft.rfft(web_signal, size)
+    lags = np.arange(size)
+    lags[lags > size - window] -= size
+
+    offsets: List[Optional[int]] = []
+    for start in range(0, len(bd), window):
+        end = min(start + window, len(bd))
+        # corr[k] = sum(bd[start + i] * web[k + i]), the negative k (web before its start) wrap around
+        corr = np.fft.irfft(web_fft * np.conj(np.fft.rfft(bd_signal[start:end], size)), size)
+        window_lags = lags - start
+        valid = np.abs(window_lags) <= max_offset
+        peaks = window_lags[valid][np.argsort(corr[valid])[::-1][:candidates]]
+
+        costs = {int(o): float(np.mean(_distances(bd, web, start, end, int(o)))) for o in peaks}
+        if offsets and offsets[-1] is not None:
+            costs.setdefault(offsets[-1], float(np.mean(_distances(bd, web, start, end, offsets[-1]))))
+        best = min(costs.values(), default=np.inf)
+        if best > threshold:
+            offsets.append(None)
+            continue
+        # static windows match several offsets, keep the previous one when it is as good
+        previous = offsets[-1] if offsets else None
+        if previous in costs and costs[previous] <= best + 0.01:
+            offsets.append(previous)
+        else:
+            offsets.append(min(costs, key=costs.__getitem__))
+
+    known = [o for o in offsets if o is not None]
+    if not known:
+        raise ValueError("Alignment: no window of the BD matches the WEB source")
+    # unmatched windows (e.g. credits only on one source) take the offset of the previous one
+    filled = [known[0]]
+    for o in offsets[1:]:
+        filled.append(filled[-1] if o is None else o)
+
+    segments: List[Segment] = []
+    start = 0
+    for i in range(1, len(filled)):
+        o1, o2 = filled[i - 1], filled[i]
+        if o1 == o2:
+            continue
+        lo, hi = (i - 1) * window, min((i + 1) * window, len(bd))
+        c1 = np.concatenate([[0], np.cumsum(_distances(bd, web, lo, hi, o1))])
+        c2 = np.concatenate([[0], np.cumsum(_distances(bd, web, lo, hi, o2))])
+        # BD frames without a WEB frame between the runs
+        gap = max(o1 - o2, 0)
+        ks = np.arange(max(start - lo, 0), hi - lo - gap + 1)
+        totals = c1[ks] + c2[-1] - c2[ks + gap]
+        k = lo + int(ks[np.argmin(totals)])
+        segments.append((start, k - 1, o1))
+        start = k + gap
+    segments.append((start, len(bd) - 1, filled[-1]))
+
+    return Alignment([s for s in segments if s[0] <= s[1]], len(web))
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="Align the WEB source of an episode with its BD")
+    parser.add_argument("script", help="episode script, e.g. 02.py")
+    parser.add_argument("--window", type=int, default=500, help="number of BD frames with a single offset")
+    parser.add_argument("--max-offset", type=int, default=2000, help="highest offset searched, in frames")
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__align__")
+    jp_bd: FileInfo = episode["JP_BD"]
+    web: FileInfo = episode["WEB"]
+
+    bd_prints, bd_levels = fingerprints(jp_bd.clip_cut)
+    # the WEB FileInfo doesn't index the video
+    web_prints, web_levels = fingerprints(core.ffms2.Source(web.path.to_str()))
+
+    start = time.monotonic()
+    alignment = align(bd_prints, bd_levels, web_prints, web_levels, args.window, args.max_offset)
+    Status.info(f"Aligned in {time.monotonic() - start:.2f}s: {alignment}")
+    Status.info(f"WEB trims_or_dfs: {alignment.trims()!r}")
@@ -0,0 +1,244 @@
+"""OP/ED location from audio fingerprints, a cheap first pass before the video hashes of common.detect
+
+The songs are found from spectral peak landmarks of the audio of the episode and of the NCOP/NCED,
+then only the frames around the candidate bounds are hashed to place them exactly (from the show folder):
+
+    python -m common.audio_match 03.py
+"""
+import vapoursynth as vs
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from vardautomation import FileInfo
+from vardautomation.status import Status
+
+import os
+import time
+from fractions import Fraction
+from typing import Optional, Tuple
+
+from .audio_sync import decode_mono, trim_start
+from .detect import NCMatch, dhash, hamming
+
+core = vs.core
+
+
+class AudioFingerprint:
+    """Landmarks of an audio track: pairs of spectral peaks hashed with their time difference"""
+
+    SAMPLE_RATE = 8000
+    N_FFT = 512
+    HOP = 256
+
+    def __init__(self, hashes: np.ndarray, times: np.ndarray) -> None:
+        # uint32 hash (f1, f2, dt) of every landmark, sorted, and spectrogram frame of its anchor peak
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.times = times[order]
+
+
+    @classmethod
+    def from_samples(
+        cls, samples: np.ndarray, neighborhood: int = 5, peaks_per_frame: int = 5, fan_out: int = 8,
+        max_dt: int = 63
+    ) -> "AudioFingerprint":
+        """
+        Args:
+        - samples: mono samples at SAMPLE_RATE
+        - neighborhood: half size of the time and frequency window a peak is the maximum of
+        - peaks_per_frame: highest number of peaks kept in a spectrogram frame
+        - fan_out: number of later peaks every peak is paired with
+        - max_dt: longest time difference of a pair, in spectrogram frames (6 bits)
+        """
+        frames = sliding_window_view(samples, cls.N_FFT)[::cls.HOP] * np.hanning(cls.N_FFT).astype(np.float32)
+        spec = np.log(np.abs(np.fft.rfft(frames, axis=1)) + 1e-6)[:, :256]
+
+        # local maxima of a separable max filter, above the average of their frame
+        pad = np.pad(spec, neighborhood, mode="edge")
+        local = sliding_window_view(pad, 2 * neighborhood + 1, axis=1).max(axis=-1)
+        local = sliding_window_view(local, 2 * neighborhood + 1, axis=0).max(axis=-1)
+        peaks = (spec == local) & (spec > spec.mean(axis=1, keepdims=True) + 1)
+
+        # strongest peaks of every frame
+        ranked = np.where(peaks, spec, -np.inf)
+        kept = np.argsort(ranked, axis=1)[:, ::-1][:, :peaks_per_frame]
+        t, rank = np.nonzero(np.isfinite(np.take_along_axis(ranked, kept, axis=1)))
+        f = kept[t, rank]
+        order = np.lexsort((f, t))
+        t, f = t[order], f[order]
+
+        hashes, times = [], []
+        for k in range(1, fan_out + 1):
+            t2, f2 = t[k:], f[k:]
+            dt = t2 - t[:-k]
+            valid = (dt > 0) & (dt <= max_dt)
+            hashes.append((f[:-k][valid].astype(np.uint32) << 14) | (f2[valid].astype(np.uint32) << 6) | dt[valid])
+            times.append(t[:-k][valid])
+
+        return cls(np.concatenate(hashes).astype(np.uint32), np.concatenate(times).astype(np.int32))
+
+
+    @classmethod
+    def from_file(cls, file: FileInfo, track: int = 0) -> "AudioFingerprint":
+        """Fingerprint of the audio of a FileInfo from the start of its trim, stored next to its source"""
+        path = f"{file.path.to_str()}.{track}.afp.npz"
+        if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(file.path.to_str()):
+            with np.load(path) as data:
+                return cls(data["hashes"], data["times"])
+
+        start = time.monotonic()
+        samples = decode_mono(file.path.to_str(), trim_start(file.trims_or_dfs, file.clip.fps), track, cls.SAMPLE_RATE)
+        fingerprint = cls.from_samples(samples)
+        Status.info(
+            f"Fingerprinted the audio of {file.path.name}: {len(fingerprint.hashes)} landmarks "
+            f"in {time.monotonic() - start:.1f}s"
+        )
+        with open(path, "wb") as f:
+            np.savez(f, hashes=fingerprint.hashes, times=fingerprint.times)
+        return fingerprint
+
+
+    @classmethod
+    def seconds(cls, t: float) -> float:
+        return t * cls.HOP / cls.SAMPLE_RATE
+
+
+class AudioMatch:
+    """Part of a creditless song found in the episode audio"""
+
+    def __init__(self, offset: float, start: float, end: float, score: float) -> None:
+        # time of the start of the creditless clip in the episode, first and last matching times, in seconds
+        self.offset = offset
+        self.start = start
+        self.end = end
+        # landmarks agreeing on the offset over those of the runner-up offset
+        self.score = score
+
+
+    def __str__(self) -> str:
+        return f"offset {self.offset:.2f}s, matching {self.start:.2f}s-{self.end:.2f}s, score {self.score:.1f}"
+
+
+    def frames(self, fps: Fraction, nc_frames: int) -> Tuple[int, int]:
+        """Candidate inclusive range of the episode: the creditless clip at the offset, cut where the match ends"""
+        start = round(self.offset * fps)
+        end = min(start + nc_frames - 1, round(self.end * fps))
+        return start, end
+
+
+def locate(
+    episode: AudioFingerprint, nc: AudioFingerprint, max_repeats: int = 64, tolerance: int = 1
+) -> Optional[AudioMatch]:
+    """Find the creditless song in the episode from the landmarks they share, None if no landmark is shared.
+    Every shared hash votes for the time difference of its occurrences, the song is at the most voted one.
+
+    Args:
+    - episode, nc: fingerprints of the episode and of the creditless clip
+    - max_repeats: hashes occurring more often in the episode are ignored (silence, tones)
+    - tolerance: spectrogram frames of jitter allowed around the offset
+    """
+    lo = np.searchsorted(episode.hashes, nc.hashes, side="left")
+    hi = np.searchsorted(episode.hashes, nc.hashes, side="right")
+    counts = hi - lo
+    keep = (counts > 0) & (counts <= max_repeats)
+    if not keep.any():
+        return None
+
+    # every (nc landmark, episode landmark) pair with the same hash
+    counts, lo, nc_times = counts[keep], lo[keep], nc.times[keep]
+    pairs = np.repeat(np.arange(len(counts)), counts)
+    index = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    ep_times = episode.times[index]
+    deltas = ep_times - nc_times[pairs]
+
+    shift = max(-int(deltas.min()), 0)
+    votes = np.bincount(deltas + shift)
+    smoothed = np.convolve(votes, np.ones(2 * tolerance + 1, np.int64), mode="same")
+    best = int(np.argmax(smoothed))
+
+    runner_up = smoothed.copy()
+    runner_up[max(best - 4 * tolerance - 2, 0):best + 4 * tolerance + 3] = 0
+    score = float(smoothed[best] / max(runner_up.max(), 1))
+
+    delta = best - shift
+    matched = ep_times[np.abs(deltas - delta) <= tolerance]
+    return AudioMatch(
+        AudioFingerprint.seconds(delta), AudioFingerprint.seconds(matched.min()),
+        AudioFingerprint.seconds(matched.max() + 1), score
+    )
+
+
+def refine(
+    clip: vs.VideoNode, nc: vs.VideoNode, candidate: Tuple[int, int], window: int = 24, threshold: int = 10
+) -> Optional[NCMatch]:
+    """Place the bounds of a candidate range with the video hashes of the frames around them only,
+    None if the frames around the start don't match.
+
+    Args:
+    - clip: episode clip
+    - nc: creditless clip
+    - candidate: inclusive range from AudioMatch.frames
+    - window: largest error of the candidate bounds, in frames
+    - threshold: highest Hamming distance of matching frames
+    """
+    start, end = candidate
+
+    # offset of the creditless clip: the one matching most of its first frames
+    ep_lo, ep_hi = max(start - window, 0), min(start + 2 * window, clip.num_frames - 1)
+    nc_head = dhash(nc[:min(window, nc.num_frames)])
+    ep_head = dhash(clip[ep_lo:ep_hi + 1])
+    offsets = range(ep_lo, ep_hi - len(nc_head) + 2)
+    if not len(offsets):
+        return None
+    matches = [int((hamming(ep_head[o - ep_lo:o - ep_lo + len(nc_head)], nc_head) <= threshold).sum()) for o in offsets]
+    best = max(range(len(matches)), key=matches.__getitem__)
+    offset = offsets[best]
+    if matches[best] < len(nc_head) // 2:
+        return None
+
+    # last matching frame around the candidate end, along the offset
+    lo = max(end - window, offset)
+    hi = min(end + window, clip.num_frames - 1, offset + nc.num_frames - 1)
+    ep_tail = dhash(clip[lo:hi + 1])
+    nc_tail = dhash(nc[lo - offset:hi - offset + 1])
+    matched = np.flatnonzero(hamming(ep_tail, nc_tail) <= threshold)
+    last = lo + int(matched[-1]) if len(matched) else end
+
+    confidence = (matches[best] + len(matched)) / (len(nc_head) + len(ep_tail))
+    return NCMatch(offset, last, 0, confidence)
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="Locate the OP and ED of an episode from its audio")
+    parser.add_argument("script", help="episode script, e.g. 03.py")
+    parser.add_argument("--track", type=int, default=0, help="audio track (ffmpeg 0:a:track)")
+    parser.add_argument("--no-refine", action="store_true", help="only print the audio candidates")
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__audio_match__")
+    jp_bd: FileInfo = episode["JP_BD"]
+    episode_fp = AudioFingerprint.from_file(jp_bd, args.track)
+
+    for name, nc in [("op", episode["NCOP"]), ("ed", episode["NCED"])]:
+        if nc is None:
+            continue
+        start = time.monotonic()
+        match = locate(episode_fp, AudioFingerprint.from_file(nc, args.track))
+        elapsed = time.monotonic() - start
+        if match is None or match.score < 3:
+            Status.info(f"{name.upper()}: not found in the audio ({match})")
+            continue
+
+        nc_frames = nc.clip_cut.num_frames
+        candidate = match.frames(jp_bd.clip.fps, nc_frames)
+        Status.info(f"{name.upper()}: {match}, candidate {candidate} (located in {elapsed:.2f}s)")
+        if args.no_refine:
+            continue
+
+        refined = refine(jp_bd.clip_cut, nc.clip_cut, candidate)
+        if refined is None:
+            Status.warn(f"{name.upper()}: the video doesn't match around the candidate")
+        else:
+            Status.info(f"{name}_start = {refined.start}, {name}_offset = {refined.offset(nc_frames)}")
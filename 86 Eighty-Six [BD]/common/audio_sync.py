@@ -0,0 +1,199 @@
+"""Delay and drift of the WEB dub track against the BD audio, from the cross-correlation of their onset envelopes
+
+The dub and the BD share the music and the effects, so the onsets line up even if the dialogues don't.
+Measure an episode without encoding it (from the show folder):
+
+    python -m common.audio_sync 02.py
+"""
+import numpy as np
+from vardautomation.status import Status
+
+import subprocess
+import time
+from fractions import Fraction
+from typing import List, Optional, Tuple
+
+# peak of the correlation over its background below which a measure is unreliable
+MIN_CONFIDENCE = 5.0
+
+
+class AudioSync:
+    """Delay and drift of a track against a reference, as mkvmerge --sync applies them"""
+
+    def __init__(self, delay: float, drift: float, confidence: float) -> None:
+        # seconds the content of the track comes after the reference, at the start
+        self.delay = delay
+        # seconds of delay gained per second (e.g. 1e-3 when the track runs at 999/1000 of the speed)
+        self.drift = drift
+        # peak of the correlation over its background, below MIN_CONFIDENCE the measure is unreliable
+        self.confidence = confidence
+
+
+    @property
+    def reliable(self) -> bool:
+        return self.confidence >= MIN_CONFIDENCE
+
+
+    def __str__(self) -> str:
+        return f"delay {self.delay * 1000:+.1f}ms, drift {self.drift * 1e6:+.1f}ppm (confidence {self.confidence:.1f})"
+
+
+    def mkvmerge_sync(self, tid: int = 0) -> List[str]:
+        """mkvmerge options moving the track onto the reference.
+        With t the reference time, the content is at t * (1 + drift) + delay in the track."""
+        factor = Fraction(1 / (1 + self.drift)).limit_denominator(1_000_000)
+        delay = round(-self.delay * 1000 * factor)
+        if factor == 1:
+            return ["--sync", f"{tid}:{delay}"]
+        return ["--sync", f"{tid}:{delay},{factor.numerator}/{factor.denominator}"]
+
+
+def decode_mono(path: str, start: float = 0.0, track: int = 0, sample_rate: int = 8000) -> np.ndarray:
+    """Mono downmix of an audio track decoded by ffmpeg, as float32 samples.
+
+    Args:
+    - path: media file
+    - start: time of the file the samples start at, in seconds
+    - track: audio track of the file (ffmpeg 0:a:track)
+    - sample_rate: rate of the downmix
+    """
+    params = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-ss", f"{start:.6f}", "-i", path,
+        "-map", f"0:a:{track}", "-ac", "1", "-ar", str(sample_rate), "-f", "f32le", "-"
+    ]
+    return np.frombuffer(subprocess.run(params, capture_output=True, check=True).stdout, np.float32)
+
+
+def envelope(path: str, start: float = 0.0, track: int = 0, rate: int = 200, sample_rate: int = 8000) -> np.ndarray:
+    """Onset envelope of an audio track: positive variations of the log energy of blocks of 1/rate second.
+
+    Args:
+    - path: media file
+    - start: time of the file taken as the start of the envelope, in seconds
+    - track: audio track of the file (ffmpeg 0:a:track)
+    - rate: samples per second of the envelope
+    - sample_rate: rate the mono downmix is decoded at
+    """
+    samples = decode_mono(path, start, track, sample_rate)
+
+    block = sample_rate // rate
+    blocks = samples[:len(samples) // block * block].reshape(-1, block)
+    energy = np.log10(np.einsum("ij,ij->i", blocks, blocks) + 1e-6)
+    onsets = np.maximum(np.diff(energy, prepend=energy[:1]), 0)
+    return (onsets - onsets.mean()) / max(float(onsets.std()), 1e-6)
+
+
+def _correlate(ref: np.ndarray, track: np.ndarray, max_lag: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Cross-correlation of two envelopes for the lags from -max_lag to max_lag, corr[lag] = sum(ref[i] * track[i + lag])"""
+    size = 1 << (len(ref) + len(track)).bit_length()
+    corr = np.fft.irfft(np.fft.rfft(track, size) * np.conj(np.fft.rfft(ref, size)), size)
+    lags = np.arange(-max_lag, max_lag + 1)
+    return lags, corr[lags]
+
+
+def _peak(lags: np.ndarray, corr: np.ndarray) -> Tuple[float, float]:
+    """Lag of the correlation peak, interpolated between samples, and its height over the background"""
+    i = int(np.argmax(corr))
+    lag = float(lags[i])
+    if 0 < i < len(corr) - 1:
+        a, b, c = corr[i - 1:i + 2]
+        lag += 0.5 * (a - c) / min(a - 2 * b + c, -1e-9)
+    background = np.median(np.abs(corr)) * 1.4826 + 1e-9
+    return lag, float((corr[i] - np.median(corr)) / background)
+
+
+def measure(
+    ref: np.ndarray, track: np.ndarray, rate: int = 200, max_delay: float = 10.0, chunk: float = 120.0
+) -> AudioSync:
+    """Delay of the track over the whole envelopes, then drift from the delays of chunks of the reference.
+
+    Args:
+    - ref, track: onset envelopes from `envelope` at the same rate
+    - rate: samples per second of the envelopes
+    - max_delay: highest delay searched, in seconds
+    - chunk: length of the chunks the drift is measured on, in seconds
+    """
+    lags, corr = _correlate(ref, track, int(max_delay * rate))
+    delay, confidence = _peak(lags, corr)
+
+    # local delays around the global one, a drift is a delay growing linearly with the time
+    size = int(chunk * rate)
+    search = max(int(0.5 * rate), 1)
+    times: List[float] = []
+    delays: List[float] = []
+    weights: List[float] = []
+    for start in range(0, len(ref) - size + 1, size):
+        center = int(round(delay))
+        lo = max(start + center - search, 0)
+        local = track[lo:start + size + center + search]
+        if len(local) < size:
+            continue
+        c_lags, c_corr = _correlate(ref[start:start + size], local, len(local))
+        valid = (c_lags >= 0) & (c_lags <= len(local) - size)
+        c_delay, c_confidence = _peak(c_lags[valid], c_corr[valid])
+        if c_confidence >= MIN_CONFIDENCE:
+            times.append((start + size / 2) / rate)
+            delays.append((c_delay + lo - start) / rate)
+            weights.append(c_confidence)
+
+    if len(times) >= 3:
+        slope, intercept = np.polyfit(times, delays, 1, w=weights)
+        residual = np.average(np.abs(np.polyval((slope, intercept), times) - delays), weights=weights)
+        # keep the drift only if it moves the delay by more than the residual error over the episode
+        if abs(slope) * (len(ref) / rate) > 2 * residual:
+            return AudioSync(float(intercept), float(slope), confidence)
+
+    return AudioSync(delay / rate, 0.0, confidence)
+
+
+def measure_files(
+    ref: str, track: str, ref_start: float = 0.0, track_start: float = 0.0, rate: int = 200, max_delay: float = 10.0
+) -> AudioSync:
+    """Decode the envelopes of the first audio track of two files and measure the sync of the second one.
+
+    Args:
+    - ref: reference file (e.g. the BD m2ts)
+    - track: file of the track to sync (e.g. the extracted WEB track)
+    - ref_start, track_start: time of the files taken as their start, in seconds (e.g. the BD trim)
+    - rate: samples per second of the envelopes
+    - max_delay: highest delay searched, in seconds
+    """
+    start = time.monotonic()
+    ref_env = envelope(ref, ref_start, rate=rate)
+    track_env = envelope(track, track_start, rate=rate)
+    decoded = time.monotonic()
+    sync = measure(ref_env, track_env, rate, max_delay)
+
+    Status.info(
+        f"Audio sync: {sync} (decoding {decoded - start:.1f}s, correlation {time.monotonic() - decoded:.2f}s)"
+    )
+    return sync
+
+
+def trim_start(trims_or_dfs: Optional[Tuple[Optional[int], Optional[int]]], fps: Fraction) -> float:
+    """Time of the first frame kept by a (start, end) trim, in seconds"""
+    if not trims_or_dfs or not isinstance(trims_or_dfs, tuple) or not trims_or_dfs[0]:
+        return 0.0
+    return float(trims_or_dfs[0] / fps)
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="Measure the sync of the WEB audio of an episode against the BD")
+    parser.add_argument("script", help="episode script, e.g. 02.py")
+    parser.add_argument("--max-delay", type=float, default=10.0, help="highest delay searched, in seconds")
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__audio_sync__")
+    jp_bd, web = episode["JP_BD"], episode["WEB"]
+
+    sync = measure_files(
+        jp_bd.path.to_str(), web.path.to_str(), trim_start(jp_bd.trims_or_dfs, jp_bd.clip.fps),
+        max_delay=args.max_delay
+    )
+    if sync.reliable:
+        Status.info(f"mkvmerge {' '.join(sync.mkvmerge_sync())}")
+    else:
+        Status.warn("Audio sync: weak correlation peak, an encode would keep the WEB track unsynced")
@@ -0,0 +1,201 @@
+"""Runs of duplicate frames, detected once per episode and filtered only once
+
+Detect the duplicates of an episode (from the show folder), the filterchain only loads them:
+
+    python -m common.dedup 02.py
+"""
+import vapoursynth as vs
+import numpy as np
+from vardautomation import FileInfo
+from vardautomation.status import Status
+
+import atexit
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+core = vs.core
+
+
+class DuplicateIndex:
+    """Runs of identical or near-identical consecutive frames, stored next to the source"""
+
+    MAGIC = b"DUPS"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHI")
+    SUFFIX = ".dups"
+
+    # frame kinds: UNIQUE starts a group, EXACT and NEAR duplicate its first frame
+    UNIQUE = 0
+    EXACT = 1
+    NEAR = 2
+
+    def __init__(self, path: str, kinds: bytes) -> None:
+        self.path = path
+        self.kinds = bytearray(kinds)
+        if self.kinds:
+            self.kinds[0] = self.UNIQUE
+        self._update_leaders()
+
+
+    @classmethod
+    def from_file(cls, file: FileInfo, num_frames: int) -> Optional["DuplicateIndex"]:
+        """Load the duplicates detected by "python -m common.dedup", they are never detected while building the graph.
+        None if the cache is missing, older than the source or doesn't match the clip."""
+        path = f"{file.path.to_str()}{cls.SUFFIX}"
+
+        if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(file.path.to_str()):
+            Status.warn(f"No valid duplicate index {os.path.basename(path)}, every frame is filtered")
+            return None
+
+        index = cls.load(path)
+        if index.num_frames != num_frames:
+            Status.warn(f"Duplicate index {os.path.basename(path)} does not match the clip, every frame is filtered")
+            return None
+        return index
+
+
+    @classmethod
+    def load(cls, path: str) -> "DuplicateIndex":
+        with open(path, "rb") as f:
+            magic, version, num_frames = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError(f"{path} is not a duplicate index")
+            kinds = f.read(num_frames)
+
+        return cls(path, kinds)
+
+
+    def write(self) -> None:
+        with open(self.path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.num_frames))
+            f.write(self.kinds)
+
+
+    @staticmethod
+    def detect(clip: vs.VideoNode, threshold: int = 0, width: int = 480, height: int = 270) -> bytearray:
+        """Compare every frame with the first frame of the current group
+        (not the previous frame, so that slow fades and pans don't end up in a group).
+
+        Args:
+        - clip: clip to analyse, before any temporal filtering
+        - threshold: 0 to only group frames identical on every plane at full resolution,
+          else highest 8-bit difference of a near duplicate on a downscaled luma
+        - width, height: size of the downscaled luma
+        """
+        threads = core.num_threads
+        analysed = core.resize.Bilinear(clip, width, height, format=vs.GRAY8) if threshold else clip
+
+        kinds = bytearray(clip.num_frames)
+        leader: Optional[List[np.ndarray]] = None
+
+        start = time.monotonic()
+        for n, f in enumerate(analysed.frames(prefetch=threads, backlog=threads * 2, close=True)):
+            # copied, the frame is closed once the next one is requested
+            planes = [np.array(f[p], dtype=np.int32) for p in range(f.format.num_planes)]
+
+            if leader is not None:
+                diff = max(int(np.abs(plane - lead).max()) for plane, lead in zip(planes, leader))
+                if diff <= threshold:
+                    kinds[n] = DuplicateIndex.EXACT if diff == 0 else DuplicateIndex.NEAR
+                    continue
+            leader = planes
+        elapsed = time.monotonic() - start
+
+        duplicates = clip.num_frames - kinds.count(DuplicateIndex.UNIQUE)
+        Status.info(f"Detected {duplicates} duplicate frames at {clip.num_frames / max(elapsed, 1e-6):.1f} fps")
+        return kinds
+
+
+    @property
+    def num_frames(self) -> int:
+        return len(self.kinds)
+
+
+    def split(self, ranges: Sequence[Tuple[int, int]]) -> None:
+        """Start a new group at the bounds of ranges filtered differently from their surroundings"""
+        for start, end in ranges:
+            for frame in (start, end + 1):
+                if 0 <= frame < self.num_frames:
+                    self.kinds[frame] = self.UNIQUE
+        self._update_leaders()
+
+
+    def _update_leaders(self) -> None:
+        self.leaders: List[int] = []
+        for n, kind in enumerate(self.kinds):
+            self.leaders.append(n if kind == self.UNIQUE else self.leaders[-1])
+
+
+class DuplicateReuse:
+    """Serve the duplicate frames of a filtered clip with the frame filtered for the first frame of their group.
+    Steps giving a different output for the same input (dynamic grain) have to be applied on `clip` afterwards."""
+
+    FILTERED = 0xFF
+
+    def __init__(self, clip: vs.VideoNode, index: DuplicateIndex, cache_frames: int = 32) -> None:
+        if index.num_frames != clip.num_frames:
+            raise ValueError(f"Duplicate index has {index.num_frames} frames, the clip {clip.num_frames}")
+
+        self.index = index
+        # 0 if not requested, FILTERED if filtered, else the kind of the duplicate
+        self.requested = bytearray(clip.num_frames)
+        self._filtered = clip
+        self._cache_frames = cache_frames
+        self._nodes: "OrderedDict[int, vs.VideoNode]" = OrderedDict()
+
+        self.clip = core.std.FrameEval(clip, self._select)
+
+        atexit.register(lambda: any(self.requested) and Status.info(self.report()))
+
+
+    def report(self) -> str:
+        rendered = self.requested.count(self.FILTERED)
+        exact, near = self.requested.count(DuplicateIndex.EXACT), self.requested.count(DuplicateIndex.NEAR)
+        total = rendered + exact + near
+        return (
+            f"Duplicates: {exact + near}/{total} frames ({(exact + near) / max(total, 1):.1%}) served from cache, "
+            f"{exact} exact and {near} near duplicates, {rendered} filtered"
+        )
+
+
+    def _select(self, n: int) -> vs.VideoNode:
+        leader = self.index.leaders[n]
+        if leader == n:
+            self.requested[n] = self.FILTERED
+            return self._filtered
+
+        self.requested[n] = self.index.kinds[n]
+
+        # FrameEval asks the returned clip for frame n, so the group frame is looped
+        node: Optional[vs.VideoNode] = self._nodes.pop(leader, None)
+        if node is None:
+            node = self._filtered[leader] * self._filtered.num_frames
+        self._nodes[leader] = node
+        if len(self._nodes) > self._cache_frames:
+            self._nodes.popitem(last=False)
+
+        return node
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="Detect the duplicate frames of an episode")
+    parser.add_argument("script", help="episode script, e.g. 02.py")
+    parser.add_argument(
+        "--threshold", type=int, default=0,
+        help="also group near duplicates, up to this 8-bit difference of a 480x270 luma (default: exact only)"
+    )
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__dedup__")
+    jp_bd: FileInfo = episode["JP_BD"]
+
+    kinds = DuplicateIndex.detect(jp_bd.clip_cut, args.threshold)
+    index = DuplicateIndex(f"{jp_bd.path.to_str()}{DuplicateIndex.SUFFIX}", kinds)
+    index.write()
+    Status.info(f"Wrote {os.path.basename(index.path)}, run the script again to reuse the duplicates")
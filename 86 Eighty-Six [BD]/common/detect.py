@@ -0,0 +1,162 @@
+"""OP/ED detection by matching perceptual hashes of the episode with the creditless clips
+
+Print the op_start, op_offset, ed_start and ed_offset of an episode (from the show folder):
+
+    python -m common.detect 03.py
+"""
+import vapoursynth as vs
+import numpy as np
+from vardautomation import FileInfo
+from vardautomation.status import Status
+
+import os
+import time
+from typing import Optional, Tuple
+
+core = vs.core
+
+# set bits of every byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+
+
+def hamming(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Hamming distances of broadcast uint64 hashes"""
+    xor = np.bitwise_xor(a, b)
+    return _POPCOUNT[xor.view(np.uint8)].reshape(*xor.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+class NCMatch:
+    """Range of an episode matching the start of a creditless clip"""
+
+    def __init__(self, start: int, end: int, nc_start: int, confidence: float) -> None:
+        # first and last frames of the range in the episode, inclusive
+        self.start = start
+        self.end = end
+        # frame of the creditless clip matching start, the filtering expects 0
+        self.nc_start = nc_start
+        # fraction of the frames of the range whose hashes match, credits and scene edits lower it
+        self.confidence = confidence
+
+
+    def __str__(self) -> str:
+        return f"({self.start}, {self.end}) from NC frame {self.nc_start}, confidence {self.confidence:.1%}"
+
+
+    @property
+    def ranges(self) -> Tuple[int, int]:
+        return self.start, self.end
+
+
+    def offset(self, nc_frames: int) -> int:
+        """op_offset/ed_offset of the filtering, which ends the range at start + nc_frames - offset"""
+        return nc_frames - (self.end - self.start)
+
+
+def dhash(clip: vs.VideoNode, threads: Optional[int] = None) -> np.ndarray:
+    """64-bit difference hash of every frame: signs of the horizontal gradients of a 9x8 luma.
+    The frames are fetched concurrently and hashed in a single vectorized pass.
+
+    Args:
+    - clip: clip to hash
+    - threads: number of frames requested concurrently (defaults to the core threads)
+    """
+    threads = threads or core.num_threads
+    small = core.resize.Bilinear(clip, 9, 8, format=vs.GRAY8)
+
+    lumas = np.empty((clip.num_frames, 8, 9), np.uint8)
+    start = time.monotonic()
+    for n, f in enumerate(small.frames(prefetch=threads, backlog=threads * 2, close=True)):
+        lumas[n] = np.asarray(f[0])
+    elapsed = time.monotonic() - start
+    Status.info(f"Hashed {clip.num_frames} frames at {clip.num_frames / max(elapsed, 1e-6):.1f} fps")
+
+    bits = lumas[:, :, 1:] > lumas[:, :, :-1]
+    return np.packbits(bits.reshape(clip.num_frames, 64), axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def cached_dhash(file: FileInfo, threads: Optional[int] = None) -> np.ndarray:
+    """Hashes of the cut clip of a FileInfo, stored next to its source.
+    The cache is used while it is newer than the source and has the length of the cut clip."""
+    path = f"{file.path.to_str()}.dhash"
+    if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(file.path.to_str()):
+        hashes = np.fromfile(path, np.uint64)
+        if len(hashes) == file.clip_cut.num_frames:
+            return hashes
+
+    hashes = dhash(file.clip_cut, threads)
+    hashes.tofile(path)
+    return hashes
+
+
+def find_nc(
+    episode: np.ndarray, nc: np.ndarray, threshold: int = 10, stride: int = 4, max_gap: int = 48,
+    min_confidence: float = 0.5
+) -> Optional[NCMatch]:
+    """Find the range of an episode matching a creditless clip, None if the clip isn't in the episode.
+    Every episode frame votes for the offsets of the creditless frames it is close to,
+    then the best offset is followed frame by frame to get the bounds of the range.
+
+    Args:
+    - episode, nc: hashes of the episode and of the creditless clip
+    - threshold: highest Hamming distance of matching frames
+    - stride: step between the creditless frames voting, they are all checked afterwards
+    - max_gap: longest run of non-matching frames inside the range (e.g. a credit on a static shot)
+    - min_confidence: lowest confidence of a match
+    """
+    # flat frames (black, white) have no gradient and match each other everywhere
+    popcount = hamming(nc, np.uint64(0))
+    voters = np.flatnonzero((popcount >= 4) & (popcount <= 60))[::stride]
+    if not len(voters):
+        return None
+
+    votes = np.zeros(len(episode) + len(nc), np.int64)
+    for chunk in range(0, len(episode), 4096):
+        dist = hamming(episode[chunk:chunk + 4096, None], nc[None, voters])
+        frames, indices = np.nonzero(dist <= threshold)
+        # offset of the episode frame to the creditless frame, shifted to be positive
+        votes += np.bincount(chunk + frames - voters[indices] + len(nc), minlength=len(votes))
+    offset = int(np.argmax(votes)) - len(nc)
+
+    nc_frames = np.arange(max(-offset, 0), min(len(nc), len(episode) - offset))
+    if not len(nc_frames):
+        return None
+    matched = nc_frames[hamming(episode[nc_frames + offset], nc[nc_frames]) <= threshold]
+    if not len(matched):
+        return None
+
+    # longest run of matches with gaps shorter than max_gap
+    breaks = np.flatnonzero(np.diff(matched) > max_gap + 1)
+    bounds = np.split(matched, breaks + 1)
+    run = max(bounds, key=lambda r: r[-1] - r[0])
+
+    first, last = int(run[0]), int(run[-1])
+    confidence = len(run) / (last - first + 1)
+    if confidence < min_confidence or last - first < max_gap:
+        return None
+    return NCMatch(first + offset, last + offset, first, confidence)
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="Detect the OP and ED of an episode")
+    parser.add_argument("script", help="episode script, e.g. 03.py")
+    parser.add_argument("--threshold", type=int, default=10, help="highest Hamming distance of matching frames")
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__detect__")
+    jp_bd: FileInfo = episode["JP_BD"]
+
+    start = time.monotonic()
+    hashes = cached_dhash(jp_bd)
+    for name, nc in [("op", episode["NCOP"]), ("ed", episode["NCED"])]:
+        match = find_nc(hashes, cached_dhash(nc), args.threshold) if nc is not None else None
+        if match is None:
+            Status.info(f"{name}_start = None")
+            continue
+        Status.info(f"{name.upper()}: {match}")
+        if match.nc_start:
+            Status.warn(f"{name.upper()}: the episode starts at NC frame {match.nc_start}, the filtering expects 0")
+        Status.info(f"{name}_start = {match.start}, {name}_offset = {match.offset(nc.clip_cut.num_frames)}")
+    Status.info(f"Detected in {time.monotonic() - start:.2f}s")
@@ -11,7 +11,11 @@ from vardautomation import (
 from vardautomation.status import Status
 
 import os
-from typing import Optional, List
+import subprocess
+from typing import Optional, List, Tuple
+
+from .audio_sync import measure_files, trim_start
+from .zones import ZONE_SETTINGS, merge_zones, write_zonefile
 
 
 def set_bitdepth(clip: vs.VideoNode):
@@ -27,7 +31,8 @@ class Encoder:
         web: Optional[FileInfo],
         clip: vs.VideoNode,
         chapters: Optional[List[Chapter]] = None,
-        chapter_names: Optional[List[str]] = None
+        chapter_names: Optional[List[str]] = None,
+        zones: Optional[List[Tuple[int, int]]] = None
     ) -> None:
 
         self.bd = bd
@@ -41,15 +46,18 @@ class Encoder:
         self.chapters = chapters
         self.chapters_names = chapter_names
 
+        self.zones = zones
+
 
-    def run(self, generate_keyframes: bool = True, clean_up: bool = True) -> None:
+    def run(self, generate_keyframes: bool = True, clean_up: bool = True, sync_audio: bool = False) -> None:
         """Run the encoder with specified settings.
 
         ---
 
         Eighty Six specific settings:
-        - x265 Encoder
+        - x265 Encoder (with faster settings on the zones)
         - FFmpegAudioExtracter: 1st BD track + 2nd WEB track
+        - WEB track synced on the BD audio (delay and drift) with mkvmerge (with sync_audio)
         - EztrimCutter : BD + WEB
         - QAACEncoder : BD only
         - MatroskaXMLChapters: generated from .mpls, renamed and shifted
@@ -60,10 +68,20 @@ class Encoder:
         Args:
         - generate_keyframe: generate keyframes for timing
         - clean_up: clean temporary files after encoding (e.g. raw audio)
+        - sync_audio: measure the delay and drift of the WEB track against the BD audio and correct them,
+          the track is kept unsynced if the measure is unreliable
         """
 
         v_encoder = X265("common/x265_settings")
 
+        if self.zones:
+            zonefile = VPath(f"{self.bd.name_clip_output.to_str()}_zones.txt")
+            # the runner doesn't resume encodes, the zones start at the first frame
+            write_zonefile(
+                zonefile.to_str(), merge_zones(self.zones, ZONE_SETTINGS), v_encoder.params, self.clip.num_frames
+            )
+            v_encoder.params += ["--zonefile", zonefile.to_str()]
+
         a_extract = [FFmpegAudioExtracter(self.bd, track_in=1, track_out=1)]
 
         a_cutter = EztrimCutter(self.bd, track=1)
@@ -72,8 +90,13 @@ class Encoder:
 
         audio_streams = [AudioStream(self.bd.a_enc_cut.set_track(1), "AAC 2.0", JAPANESE)]
 
-        if self.web:
+        web_audio: List[str] = []
+        if self.web and sync_audio:
+            web_audio = self.sync_web_audio()
+            audio_streams.append(AudioStream(VPath(web_audio[-1]), "AAC 2.0", FRENCH))
+        elif self.web:
             a_extract.append(FFmpegAudioExtracter(self.web, track_in=1, track_out=2))
+            web_audio = [self.web.a_src.set_track(2).to_str()]
             audio_streams.append(AudioStream(self.web.a_src.set_track(2), "AAC 2.0", FRENCH))
 
         if self.chapters:
@@ -116,5 +139,25 @@ class Encoder:
         if clean_up:
             Status.info("Cleaning up extra files")
             runner.work_files.add(f"{self.bd.name_file_final.to_str()}.ffindex")
-            runner.work_files.add(self.web.a_src.set_track(2).to_str())
+            for file in web_audio:
+                runner.work_files.add(file)
             runner.work_files.clear()
+
+
+    def sync_web_audio(self) -> List[str]:
+        """Extract the WEB track and remux it with the delay and drift measured against the BD audio,
+        the BD audio being cut like the video. Returns the extracted file and the synced one,
+        only the extracted file if the measure is unreliable."""
+        assert self.web
+        FFmpegAudioExtracter(self.web, track_in=1, track_out=2).run()
+        extracted = self.web.a_src.set_track(2).to_str()
+
+        sync = measure_files(self.bd.path.to_str(), extracted, trim_start(self.bd.trims_or_dfs, self.bd.clip.fps))
+
+        if not sync.reliable:
+            Status.warn("Audio sync: weak correlation peak, keeping the WEB track unsynced")
+            return [extracted]
+
+        synced = f"{self.bd.ep_num}_web_sync.mka"
+        subprocess.run(["mkvmerge", "-q", "-o", synced, *sync.mkvmerge_sync(), extracted], check=True)
+        return [extracted, synced]
@@ -9,10 +9,31 @@ from vardautomation import FileInfo
 
 from typing import List, Optional, Tuple
 
+from .dedup import DuplicateIndex, DuplicateReuse
+from .masks import downscaled_credit_mask, masked_merge
+from .nc_cache import NCCache, NCReuse
+from .ranges import RangeMap
+from .raw_cache import cached_clip_cut
+from .sparse import SparseEval
+
 core = vs.core
 
 
 class EightySixFiltering():
+    # filter only the first frame of every group of duplicates, detected with "python -m common.dedup <episode>"
+    DEDUP = False
+    # take the OP/ED frames without credits from the filtered creditless cache
+    NC_REUSE = True
+    # files the cached filtered creditless clips depend on
+    NC_SOURCES = [__file__]
+    # compute the credit masks at 1/2 or 1/4 of the resolution, None for the full resolution vardefunc masks
+    # (check the threshold with "python -m common.masks <episode>" when changing it)
+    CREDIT_MASK_SCALE: Optional[int] = None
+    CREDIT_MASK_THR = 150
+    # run the AA only on the tiles covered by the line mask, with this many columns and rows of tiles
+    # (check the gain with "python -m common.sparse <episode>" before turning it on)
+    SPARSE_AA = False
+    SPARSE_AA_GRID = (4, 4)
 
     def __init__(
         self,
@@ -48,30 +69,54 @@ class EightySixFiltering():
 
         denoise = eoe.denoise.BM3D(src, sigma=1, radius=1, chroma=True, CUDA=True)
 
-        baa = lvf.aa.based_aa(denoise, "common/FSRCNNX_x2_56-16-4-1.glsl")
-        sraa = lvf.aa.upscaled_sraa(denoise, rfactor=1.75)
-        aa_clamped = lvf.aa.clamp_aa(denoise, baa, sraa, strength=1)
+        def _aa(clip: vs.VideoNode) -> vs.VideoNode:
+            baa = lvf.aa.based_aa(clip, "common/FSRCNNX_x2_56-16-4-1.glsl")
+            sraa = lvf.aa.upscaled_sraa(clip, rfactor=1.75)
+            return lvf.aa.clamp_aa(clip, baa, sraa, strength=1)
 
         lmask = get_y(denoise).std.Prewitt().std.Binarize(60<<8).std.Maximum().std.BoxBlur()
-        masked_aa = core.std.MaskedMerge(denoise, aa_clamped, lmask)
+
+        if self.SPARSE_AA:
+            self.sparse_aa = SparseEval(denoise, lmask, _aa, self.SPARSE_AA_GRID)
+            aa_clamped = self.sparse_aa.clip
+        else:
+            aa_clamped = _aa(denoise)
+
+        masked_aa = masked_merge(denoise, aa_clamped, lmask)
 
         dehalo = haf.FineDehalo(masked_aa, rx=1.8, darkstr=0)
 
         deband = dumb3kdb(dehalo, radius=20, threshold=20, grain=[12, 6])
 
         detail_mask = lvf.mask.detail_mask(dehalo, brz_a=0.03, brz_b=0.045)
-        masked_deband = core.std.MaskedMerge(deband, dehalo, detail_mask)
+        masked_deband = masked_merge(deband, dehalo, detail_mask)
+
+        # every range replacement of the episode, selected by a single node
+        self.range_map = RangeMap(src.num_frames)
 
         scenefilter = self.scenefilter(masked_deband, denoise)
 
         if self.title_range:
-            scenefilter = lvf.rfs(scenefilter, denoise, self.title_range)
+            self.range_map.add(denoise, self.title_range, "title cards")
 
         if self.op_ranges:
-            scenefilter = self.filter_op(scenefilter, denoise, self.NCOP)
+            self.filter_op(scenefilter, denoise, self.NCOP)
 
         if self.ed_ranges:
-            scenefilter = self.filter_ed(scenefilter, denoise, self.NCED)
+            self.filter_ed(scenefilter, denoise, self.NCED)
+
+        scenefilter = self.range_map.compile(scenefilter)
+
+        if self.NC_REUSE:
+            scenefilter = self.reuse_nc(scenefilter)
+
+        # part of the grain is dynamic, so the duplicates only reuse the filtering before it
+        duplicates = DuplicateIndex.from_file(self.JP_BD, src.num_frames) if self.DEDUP else None
+        if duplicates is not None:
+            duplicates.split(self.range_map_ranges)
+
+            self.duplicates = DuplicateReuse(scenefilter, duplicates)
+            scenefilter = self.duplicates.clip
 
         seed = sum([ord(x) for x in "shigin"])
         grain = vdf.noise.Graigasm(
@@ -100,6 +145,23 @@ class EightySixFiltering():
         return grain
 
 
+    @property
+    def range_map_ranges(self) -> List[Tuple[int, int]]:
+        """Ranges with another filterchain than the main one (title cards, OP, ED)"""
+        return sorted((self.title_range or []) + [r for r in (self.op_ranges, self.ed_ranges) if r is not None])
+
+
+    @property
+    def zone_ranges(self) -> List[Tuple[int, int]]:
+        """Ranges passing the lightly filtered source through, to be encoded with faster settings.
+        The title cards and the ED, unless the episode overrides filter_ed (e.g. to merge the main filterchain
+        outside of the credits). The OP gets part of the main filterchain."""
+        ranges = list(self.title_range or [])
+        if self.ed_ranges and type(self).filter_ed is EightySixFiltering.filter_ed:
+            ranges.append(self.ed_ranges)
+        return sorted(ranges)
+
+
     def filtersteps(self, display_frame: int = 0, display_props: int = 0, font_scaling: int = 1):
         """Debug"""
         debug = vdf.misc.DebugOutput(props=display_props, num=display_frame, scale=font_scaling)
@@ -109,12 +171,12 @@ class EightySixFiltering():
 
 
     def scenefilter(self, clip: vs.VideoNode, denoise: vs.VideoNode) -> vs.VideoNode:
-        """Scenefilter"""
+        """Scenefilter, the frame ranges taken from another clip go to self.range_map"""
         return clip
 
 
-    def filter_op(self, clip: vs.VideoNode, denoise: vs.VideoNode, NCOP: FileInfo) -> vs.VideoNode:
-        """OP filterchain"""
+    def filter_op(self, clip: vs.VideoNode, denoise: vs.VideoNode, NCOP: FileInfo) -> None:
+        """OP filterchain, added to self.range_map"""
         op_start, op_end = self.op_ranges
         op_filterchain_ranges = self._get_op_filter_ranges(op_start, op_end)
 
@@ -123,32 +185,59 @@ class EightySixFiltering():
             strength=15, mode="deblock", matrix=1, cuda=False
         )
 
-        merged = lvf.rfs(
-            lvf.rfs(clip, dpir, self.op_ranges),  # too lazy to rewrite frame ranges
-            clip,
-            op_filterchain_ranges
-        )
+        # deblocked OP, except on the ranges getting the main filterchain
+        self.range_map.add(dpir, [self.op_ranges], "OP")  # too lazy to rewrite frame ranges
 
         if "NCOP" not in self.JP_BD.ep_num:
-            credit_mask = vdf.mask.Difference().creditless(
-                self.JP_BD.clip_cut,
-                self.JP_BD.clip_cut[op_start:op_end+1],
-                NCOP.clip_cut[:-self.op_offset],
-                op_start,
-                thr=150,
-                prefilter=True
-            )
+            credit_mask = self._credit_mask(NCOP, self.op_ranges, self.op_offset, self.CREDIT_MASK_SCALE)
+
+            credit_merged = masked_merge(clip, denoise, depth(credit_mask, 16), [self.op_ranges])
+
+            self.range_map.add(credit_merged, op_filterchain_ranges, "OP credits", override=True)
+        else:
+            self.range_map.add(clip, op_filterchain_ranges, "OP filterchain", override=True)
 
-            credit_merged = core.std.MaskedMerge(merged, denoise, depth(credit_mask, 16))
 
-            merged = lvf.rfs(merged, credit_merged, op_filterchain_ranges)
+    def filter_ed(self, clip: vs.VideoNode, denoise: vs.VideoNode, NCED: FileInfo) -> None:
+        """ED filterchain, added to self.range_map"""
+        self.range_map.add(denoise, [self.ed_ranges], "ED")
 
-        return merged
 
+    def reuse_nc(self, clip: vs.VideoNode) -> vs.VideoNode:
+        """Take the OP/ED frames without credits from the filtered creditless cache, if it has been built.
+        The cache is filtered like the base class, an episode overriding filter_op or filter_ed doesn't reuse it."""
+        for name, nc, ranges, offset, method in [
+            ("NCOP", self.NCOP, self.op_ranges, self.op_offset, "filter_op"),
+            ("NCED", self.NCED, self.ed_ranges, self.ed_offset, "filter_ed")
+        ]:
+            if nc is None or ranges is None or name in self.JP_BD.ep_num:
+                continue
+            if getattr(type(self), method) is not getattr(EightySixFiltering, method):
+                continue
 
-    def filter_ed(self, clip: vs.VideoNode, denoise: vs.VideoNode, NCED: FileInfo) -> vs.VideoNode:
-        """ED filterchain"""
-        return lvf.rfs(clip, denoise, self.ed_ranges)
+            nc_filtered = NCCache(name, nc, self.NC_SOURCES).load()
+            if nc_filtered is not None:
+                credit_mask = self._credit_mask(nc, ranges, offset, self.CREDIT_MASK_SCALE)
+                clip = NCReuse(clip, nc_filtered, self.JP_BD.clip_cut, cached_clip_cut(nc), credit_mask, ranges[0]).clip
+
+        return clip
+
+
+    def _credit_mask(
+        self, nc: FileInfo, ranges: Tuple[int, int], offset: int, scale: Optional[int] = None
+    ) -> vs.VideoNode:
+        """Credit mask of the OP or ED, computed at 1/scale of the resolution if scale isn't None"""
+        start, end = ranges
+        args = (
+            self.JP_BD.clip_cut,
+            self.JP_BD.clip_cut[start:end+1],
+            # decoded once for every episode when the raw cache is built
+            cached_clip_cut(nc)[:-offset],
+            start
+        )
+        if scale is None:
+            return vdf.mask.Difference().creditless(*args, thr=self.CREDIT_MASK_THR, prefilter=True)
+        return downscaled_credit_mask(*args, thr=self.CREDIT_MASK_THR, scale=scale)
 
 
     @staticmethod
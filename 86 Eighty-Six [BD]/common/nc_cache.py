@@ -0,0 +1,204 @@
+"""Cache of the filtered creditless OP and ED, reused by the episodes outside of the credits
+
+Build or refresh the caches of the NCOP/NCED used by an episode, decoded and filtered (from the show folder):
+
+    python -m common.nc_cache 02.py
+"""
+import vapoursynth as vs
+from vardautomation import FileInfo
+from vardautomation.status import Status
+
+import atexit
+import hashlib
+import os
+import subprocess
+from typing import List, Optional, Sequence
+
+core = vs.core
+
+
+class NCCache:
+    """Lossless encode of a filtered creditless clip, shared by the episodes using the same NCOP/NCED"""
+
+    DIR = "nc_cache"
+
+    def __init__(self, name: str, file: FileInfo, sources: Sequence[str] = ()) -> None:
+        """
+        Args:
+        - name: name of the creditless clip (NCOP or NCED)
+        - file: FileInfo of the creditless source (the volumes don't share it)
+        - sources: other files the filtered clip depends on, the cache is stale if one is newer
+        """
+        self.name = name
+        self.file = file
+
+        key = hashlib.blake2b(f"{file.path.to_str()}{file.trims_or_dfs}".encode(), digest_size=4).hexdigest()
+        self.path = os.path.join(self.DIR, f"{name}_{key}_filtered.mkv")
+        self.sources = [file.path.to_str(), *sources]
+
+
+    @property
+    def fresh(self) -> bool:
+        return os.path.isfile(self.path) and all(
+            os.path.getmtime(self.path) >= os.path.getmtime(src) for src in self.sources if os.path.isfile(src)
+        )
+
+
+    def load(self) -> Optional[vs.VideoNode]:
+        """Filtered clip, or None if the cache has to be built again"""
+        if not self.fresh:
+            Status.warn(f"{self.name} cache is missing or stale, build it with \"python -m common.nc_cache <episode>\"")
+            return None
+        return core.lsmas.LWLibavSource(self.path)
+
+
+    def build(self, clip: vs.VideoNode) -> None:
+        """Encode the filtered creditless clip to FFV1"""
+        os.makedirs(self.DIR, exist_ok=True)
+        tmp = f"{self.path[:-len('.mkv')]}.tmp.mkv"
+
+        params = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "yuv4mpegpipe", "-i", "-",
+            "-c:v", "ffv1", "-level", "3", "-slices", "24", "-slicecrc", "1", "-g", "1",
+            tmp
+        ]
+        Status.info(f"{self.name} cache command: " + " ".join(params))
+
+        with subprocess.Popen(params, stdin=subprocess.PIPE) as process:
+            clip.output(process.stdin, y4m=True)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, params)
+
+        # the episodes only see complete caches
+        os.replace(tmp, self.path)
+
+
+class NCReuse:
+    """Take the frames of a filtered clip from the filtered creditless clip where the sources match
+    and no credit is close enough to change the temporal filtering"""
+
+    def __init__(
+        self,
+        clip: vs.VideoNode,
+        nc_filtered: vs.VideoNode,
+        src: vs.VideoNode,
+        nc_src: vs.VideoNode,
+        credit_mask: vs.VideoNode,
+        start: int,
+        radius: int = 2,
+        diff_thr: float = 0
+    ) -> None:
+        """
+        Args:
+        - clip: filtered episode
+        - nc_filtered: filtered creditless clip, from NCCache.load
+        - src: episode source
+        - nc_src: creditless source, frame 0 matching frame `start` of the episode
+        - credit_mask: credit mask of the episode (full length)
+        - start: first frame of the OP or ED
+        - radius: temporal radius of the filtering, frames this close to a credit or to the bounds are filtered
+        - diff_thr: highest difference of any pixel between the sources, on every plane and at their bitdepth
+          (0 to only reuse identical sources)
+        """
+        if nc_filtered.format != clip.format:
+            raise ValueError(f"Cached clip is {nc_filtered.format}, the filtered clip {clip.format}")
+
+        length = min(nc_filtered.num_frames, nc_src.num_frames, clip.num_frames - start)
+        end = start + length
+        self.radius = radius
+        self.diff_thr = diff_thr
+        self.length = length
+        # 1 for every requested frame taken from the cache, 2 if it has been filtered
+        self.reused = bytearray(length)
+
+        self._section = clip[start:end]
+        self._cached = nc_filtered[:length]
+
+        # largest difference of any pixel between the sources, a whole-frame average hides small credits
+        assert src.format
+        self._planes = src.format.num_planes
+        diff = core.std.Expr([src[start:end], nc_src[:length]], "x y - abs")
+        for p in range(self._planes):
+            diff = diff.std.PlaneStats(plane=p, prop=f"SrcDiff{p}")
+        credits = credit_mask[start:end].std.PlaneStats()
+        # credits of the neighbouring frames, within the temporal radius
+        shifted = [credits] + [
+            credits[0] * d + credits[:-d] if d > 0 else credits[-d:] + credits[-1] * -d
+            for d in range(-radius, radius + 1) if d
+        ]
+
+        parts: List[vs.VideoNode] = [core.std.FrameEval(self._section, self._select, prop_src=[diff, *shifted])]
+        if start:
+            parts.insert(0, clip[:start])
+        if end < clip.num_frames:
+            parts.append(clip[end:])
+        self.clip = core.std.Splice(parts) if len(parts) > 1 else parts[0]
+
+        atexit.register(lambda: any(self.reused) and Status.info(self.report()))
+
+
+    def report(self) -> str:
+        reused, filtered = self.reused.count(1), self.reused.count(2)
+        return f"Creditless cache: {reused}/{reused + filtered} frames reused"
+
+
+    def _select(self, n: int, f: List[vs.VideoFrame]) -> vs.VideoNode:
+        if (
+            self.radius <= n < self.length - self.radius
+            and all(f[0].props[f"SrcDiff{p}Max"] <= self.diff_thr for p in range(self._planes))
+            and all(frame.props["PlaneStatsMax"] == 0 for frame in f[1:])
+        ):
+            self.reused[n] = 1
+            return self._cached
+
+        self.reused[n] = 2
+        return self._section
+
+
+if __name__ == "__main__":
+    import argparse
+    import copy
+    import runpy
+
+    from .filtering import EightySixFiltering
+    from .raw_cache import RawClipCache, raw_cache_path
+
+    parser = argparse.ArgumentParser(description="Filter the creditless OP and ED of an episode once")
+    parser.add_argument("script", help="episode script, e.g. 02.py")
+    parser.add_argument("--force", action="store_true", help="build the caches even if they are up to date")
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__nc_cache__")
+    episode_flt = type(episode["flt"])
+
+    for nc_name, method in [("NCOP", "filter_op"), ("NCED", "filter_ed")]:
+        nc_file: Optional[FileInfo] = episode.get(nc_name)
+        if nc_file is None:
+            continue
+        if getattr(episode_flt, method) is not getattr(EightySixFiltering, method):
+            Status.info(f"{args.script} overrides {method}, its {nc_name} frames are always filtered")
+            continue
+
+        raw = RawClipCache(raw_cache_path(nc_file))
+        if not raw.fresh([nc_file.path.to_str()]) or args.force:
+            raw.build(nc_file.clip_cut)
+
+        cache = NCCache(nc_name, nc_file, EightySixFiltering.NC_SOURCES)
+        if cache.fresh and not args.force:
+            Status.info(f"{nc_name} cache is up to date")
+            continue
+
+        # filtered like an OP/ED covering the whole creditless clip, without credit masks
+        nc = copy.copy(nc_file)
+        nc.ep_num = nc_name
+        if nc_name == "NCOP":
+            flt = EightySixFiltering(nc, nc, None, op_start=0, op_offset=1)
+            flt.NC_REUSE = False
+            flt.filter()
+            cache.build(flt.filtersteps_clips["scenefilter"])
+        else:
+            flt = EightySixFiltering(nc)
+            flt.NC_REUSE = False
+            flt.filter()
+            cache.build(flt.filtersteps_clips["denoise"])
@@ -0,0 +1,96 @@
+import vapoursynth as vs
+
+from typing import List, Optional, Sequence, Tuple, Union
+
+core = vs.core
+
+
+class RangeMap:
+    """Every range replacement of an episode (what nested lvf.rfs calls do), compiled into a single splice.
+    Overlapping ranges assigned to different clips are refused unless the later one explicitly overrides."""
+
+    def __init__(self, num_frames: int) -> None:
+        self.num_frames = num_frames
+        # clips the ranges are assigned to, index 0 is the base clip given to compile
+        self.clips: List[Optional[vs.VideoNode]] = [None]
+        # (start, end, clip index, name) in the order they were added, inclusive
+        self.assignments: List[Tuple[int, int, int, str]] = []
+
+
+    def add(
+        self,
+        clip: vs.VideoNode,
+        ranges: Sequence[Union[int, Tuple[int, int]]],
+        name: Optional[str] = None,
+        override: bool = False
+    ) -> "RangeMap":
+        """
+        Args:
+        - clip: clip taken on the ranges
+        - ranges: inclusive ranges or single frames, like lvf.rfs
+        - name: name of the replacement in the error messages
+        - override: take precedence over the overlapping ranges added before instead of raising an error
+        """
+        index = next((i for i, c in enumerate(self.clips) if c is clip), None)
+        if index is None:
+            self.clips.append(clip)
+            index = len(self.clips) - 1
+        name = name or f"clip {index}"
+
+        for r in ranges:
+            start, end = (r, r) if isinstance(r, int) else r
+            if not 0 <= start <= end < self.num_frames:
+                raise ValueError(f"RangeMap: {name} range ({start}, {end}) is out of the {self.num_frames} frames")
+            if clip.num_frames <= end:
+                raise ValueError(f"RangeMap: {name} has {clip.num_frames} frames, the range ends at {end}")
+
+            if not override:
+                for o_start, o_end, o_index, o_name in self.assignments:
+                    if start <= o_end and o_start <= end and o_index != index:
+                        raise ValueError(
+                            f"RangeMap: {name} ({start}, {end}) overlaps {o_name} ({o_start}, {o_end}) with another clip"
+                        )
+
+            self.assignments.append((start, end, index, name))
+
+        return self
+
+
+    def segments(self) -> Tuple[List[int], List[int]]:
+        """First frame and clip index of every run of frames taken from the same clip"""
+        points = sorted(
+            {0, self.num_frames} | {start for start, *_ in self.assignments} | {end + 1 for _, end, *_ in self.assignments}
+        )
+
+        starts: List[int] = []
+        indices: List[int] = []
+        for point in points[:-1]:
+            index = 0
+            # the last assignment wins, earlier ones can only differ if it overrides them
+            for start, end, i, _ in self.assignments:
+                if start <= point <= end:
+                    index = i
+            if not indices or indices[-1] != index:
+                starts.append(point)
+                indices.append(index)
+
+        return starts, indices
+
+
+    def compile(self, base: vs.VideoNode) -> vs.VideoNode:
+        """Clip taking every range from its clip and the other frames from base, spliced from trims of the clips"""
+        if base.num_frames != self.num_frames:
+            raise ValueError(f"RangeMap: base clip has {base.num_frames} frames, expected {self.num_frames}")
+
+        clips = [base, *self.clips[1:]]
+        for i, clip in enumerate(clips[1:], 1):
+            if clip.format != base.format or (clip.width, clip.height) != (base.width, base.height):
+                name = next(n for *_, idx, n in self.assignments if idx == i)
+                raise ValueError(f"RangeMap: {name} doesn't have the format or the dimensions of the base clip")
+
+        starts, indices = self.segments()
+        if len(indices) == 1:
+            return clips[indices[0]]
+
+        ends = starts[1:] + [self.num_frames]
+        return core.std.Splice([clips[i][start:end] for start, end, i in zip(starts, ends, indices)])
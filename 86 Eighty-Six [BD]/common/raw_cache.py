@@ -0,0 +1,117 @@
+import vapoursynth as vs
+import numpy as np
+from vardautomation import FileInfo
+from vardautomation.status import Status
+
+import hashlib
+import json
+import os
+from typing import List, Sequence
+
+core = vs.core
+
+
+class RawClipCache:
+    """Decoded frames of a clip stored uncompressed and memory-mapped read-only.
+    Every process reading the same cache shares its pages, nothing is decoded again."""
+
+    ALIGN = 4096
+
+    def __init__(self, path: str) -> None:
+        # raw frames, the clip properties are in a .json file next to it
+        self.path = path
+        self.info_path = f"{os.path.splitext(path)[0]}.json"
+
+
+    def fresh(self, sources: Sequence[str] = ()) -> bool:
+        """Complete and newer than every source"""
+        return os.path.isfile(self.info_path) and all(
+            os.path.getmtime(self.info_path) >= os.path.getmtime(src) for src in sources if os.path.isfile(src)
+        )
+
+
+    def build(self, clip: vs.VideoNode) -> None:
+        """Decode the clip and write every frame"""
+        fmt = clip.format
+
+        if os.path.isfile(self.info_path):
+            os.remove(self.info_path)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        props = {}
+        with open(self.path, "wb") as f:
+            for n, frame in enumerate(clip.frames(close=True)):
+                if n == 0:
+                    props = {
+                        k: v for k, v in frame.props.items() if isinstance(v, (int, float)) and k != "_AbsoluteTime"
+                    }
+                for p in range(fmt.num_planes):
+                    f.write(np.ascontiguousarray(np.asarray(frame[p])).data)
+                f.write(bytes(-f.tell() % self.ALIGN))
+
+        info = dict(
+            width=clip.width, height=clip.height, num_frames=clip.num_frames,
+            fps=[clip.fps_num, clip.fps_den],
+            format=[int(fmt.color_family), int(fmt.sample_type), fmt.bits_per_sample, fmt.subsampling_w, fmt.subsampling_h],
+            props=props,
+        )
+        # written last, a cache without it is incomplete
+        with open(self.info_path, "w") as f:
+            json.dump(info, f)
+
+        Status.info(f"Raw cache: {clip.num_frames} frames written to {os.path.basename(self.path)}")
+
+
+    def load(self) -> vs.VideoNode:
+        """Clip reading its frames from the memory-mapped cache"""
+        with open(self.info_path, "r") as f:
+            info = json.load(f)
+
+        color_family, sample_type, bits, ssw, ssh = info["format"]
+        fmt = core.query_video_format(color_family, sample_type, bits, ssw, ssh)
+        dtype = np.dtype({1: np.uint8, 2: np.uint16, 4: np.float32}[fmt.bytes_per_sample])
+
+        shapes = [
+            (info["height"] >> (ssh if p else 0), info["width"] >> (ssw if p else 0)) for p in range(fmt.num_planes)
+        ]
+        frame_size = sum(h * w for h, w in shapes) * fmt.bytes_per_sample
+        stride = frame_size + -frame_size % self.ALIGN
+
+        data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        if len(data) < stride * info["num_frames"]:
+            raise ValueError(f"Raw cache {os.path.basename(self.path)} is truncated")
+
+        def _planes(n: int) -> List[np.ndarray]:
+            planes, offset = [], n * stride
+            for h, w in shapes:
+                size = h * w * fmt.bytes_per_sample
+                planes.append(data[offset:offset + size].view(dtype).reshape(h, w))
+                offset += size
+            return planes
+
+        def _read(n: int, f: vs.VideoFrame) -> vs.VideoFrame:
+            fout = f.copy()
+            for p, plane in enumerate(_planes(n)):
+                np.copyto(np.asarray(fout[p]), plane)
+            return fout
+
+        fps_num, fps_den = info["fps"]
+        blank = core.std.BlankClip(
+            format=fmt.id, width=info["width"], height=info["height"], length=info["num_frames"],
+            fpsnum=fps_num, fpsden=fps_den, keep=True
+        )
+        return core.std.ModifyFrame(blank, blank, _read).std.SetFrameProps(**info["props"])
+
+
+def raw_cache_path(file: FileInfo) -> str:
+    """Raw cache of a creditless FileInfo, the volumes don't share it"""
+    key = hashlib.blake2b(f"{file.path.to_str()}{file.trims_or_dfs}".encode(), digest_size=4).hexdigest()
+    return os.path.join("nc_cache", f"{file.path.stem}_{key}.raw")
+
+
+def cached_clip_cut(file: FileInfo) -> vs.VideoNode:
+    """file.clip_cut from its raw cache when it is up to date"""
+    cache = RawClipCache(raw_cache_path(file))
+    if cache.fresh([file.path.to_str()]):
+        return cache.load()
+    return file.clip_cut
@@ -0,0 +1,41 @@
+import vapoursynth as vs
+from vardautomation.status import Status
+
+import json
+import subprocess
+from fractions import Fraction
+
+core = vs.core
+
+
+def audio_only_idx(path: str) -> vs.VideoNode:
+    """Indexer for the WEB FileInfo, that is only used for its audio track.
+    Returns a blank clip with the dimensions, framerate and length of the video track read from the container,
+    so the video is never indexed nor decoded.
+
+    Args:
+    - path: path of the WEB file
+    """
+    probe = subprocess.run(
+        [
+            "ffprobe", "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "stream=width,height,r_frame_rate,nb_frames:format=duration", "-of", "json", path
+        ],
+        capture_output=True, check=True, text=True
+    )
+    info = json.loads(probe.stdout)
+    stream = info["streams"][0]
+    fps = Fraction(stream["r_frame_rate"])
+
+    # mkv doesn't store the frame count, it is derived from the duration
+    if stream.get("nb_frames", "N/A") != "N/A":
+        num_frames = int(stream["nb_frames"])
+    else:
+        num_frames = round(float(info["format"]["duration"]) * fps)
+
+    Status.info(f"WEB video not indexed, blank clip of {num_frames} frames at {float(fps):.3f} fps")
+
+    return core.std.BlankClip(
+        format=vs.YUV420P8, width=int(stream["width"]), height=int(stream["height"]),
+        length=num_frames, fpsnum=fps.numerator, fpsden=fps.denominator
+    )
@@ -40,7 +40,8 @@ details = lvf.mask.detail_mask(dehalo, brz_a=0.017, brz_b=0.035)
 deband = dumb3kdb(dehalo, radius=24, threshold=26, grain=[24, 12])
 masked_deband = core.std.MaskedMerge(deband, dehalo, details)
 
-merged = lvf.rfs(masked_deband, src, [(0, 353), (120982, 127800), (128952, 129187)])
+PASSTHROUGH_RANGES = [(0, 353), (120982, 127800), (128952, 129187)]
+merged = lvf.rfs(masked_deband, src, PASSTHROUGH_RANGES)
 
 seed = sum([ord(x) for x in "shigin"])
 grain = vdf.noise.Graigasm(
@@ -57,7 +58,7 @@ grain = vdf.noise.Graigasm(
 ).graining(merged)
 
 if __name__ == "__main__":
-    Encoder(JP_BD, grain).run()
+    Encoder(JP_BD, grain, zones=PASSTHROUGH_RANGES).run()
 
 elif __name__ == "__vapoursynth__":
     grain.set_output()
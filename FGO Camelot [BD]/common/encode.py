@@ -12,7 +12,9 @@ from vardautomation import (
 from vardautomation.status import Status
 
 import os
-from typing import Optional, List
+from typing import Optional, List, Tuple
+
+from .zones import ZONE_SETTINGS, merge_zones, write_zonefile
 
 core = vs.core
 
@@ -24,20 +26,22 @@ class Encoder:
         file: FileInfo, 
         clip: vs.VideoNode, 
         chapters: Optional[List[Chapter]] = None,
-        chapter_names: Optional[List[str]] = None
+        chapter_names: Optional[List[str]] = None,
+        zones: Optional[List[Tuple[int, int]]] = None
     ) -> None:
 
         self.file = file
         self.clip = clip
         self.chapters = chapters
         self.chapters_names = chapter_names
+        self.zones = zones
 
 
     def run(self, generate_keyframes: bool=True, clean_up: bool=True) -> None:
         """Run the encoder with specified settings. 
 
         FGO Camelot specific settings: \\
-        -x265 Encoder \\
+        -x265 Encoder (with faster settings on the zones) \\
         -FFmpegAudioExtracter (tracks 1 & 2) \\
         -QAACEncoder (2x, one for each track) \\
         -Muxer
@@ -52,6 +56,14 @@ class Encoder:
 
         v_encoder = X265Encoder("common/x265_settings")
 
+        if self.zones:
+            zonefile = VPath(f"{self.file.name_clip_output.to_str()}_zones.txt")
+            # the runner doesn't resume encodes, the zones start at the first frame
+            write_zonefile(
+                zonefile.to_str(), merge_zones(self.zones, ZONE_SETTINGS), v_encoder.params, self.clip.num_frames
+            )
+            v_encoder.params += ["--zonefile", zonefile.to_str()]
+
         self.file.a_src_cut = self.file.a_src # QAACEncoder always takes a_src_cut
 
         a_tracks = [1, 2]
@@ -116,4 +128,4 @@ class Encoder:
         #remove ffindex of final file if used to generate keyframe
         ffindex = f"{self.file.name_file_final.to_str()}.ffindex"
         if os.path.isfile(ffindex):
-            os.remove(ffindex)
\ No newline at end of file
+            os.remove(ffindex)
@@ -0,0 +1,73 @@
+"""x265 zonefiles: faster settings on some ranges, restoring the base values of the encoder parameters after them"""
+from vardautomation.status import Status
+
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+
+# zonefile options for passthrough ranges
+ZONE_SETTINGS: Dict[str, Any] = {"rd": 2, "subme": 2, "ref": 3, "merange": 32}
+
+
+def merge_zones(
+    ranges: Sequence[Optional[Tuple[int, int]]], settings: Dict[str, Any]
+) -> Dict[Tuple[int, int], Dict[str, Any]]:
+    """Merge overlapping or adjacent ranges sharing the same zone settings"""
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(r for r in ranges if r is not None):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return {r: settings for r in merged}
+
+
+def write_zonefile(
+    path: str,
+    zones: Mapping[Tuple[int, int], Mapping[str, Any]],
+    base: Sequence[str],
+    num_frames: int,
+    offset: int = 0,
+) -> None:
+    """Write a x265 zonefile. Every zone is followed by an entry restoring the base settings.
+
+    Args:
+    - path: zonefile path
+    - zones: inclusive ranges and the options (without dashes) to use on them
+    - base: base encoder parameters (the encoder params list), used to restore the options after every zone
+    - num_frames: number of frames actually sent to the encoder
+    - offset: first frame sent to the encoder (resumed encodes)
+    """
+    lines: List[Tuple[int, str]] = []
+    last_end = -1
+
+    for (start, end), options in sorted(zones.items()):
+        if start <= last_end:
+            raise ValueError(f"Zone ({start}, {end}) overlaps the previous one")
+        last_end = end
+
+        start, end = max(start - offset, 0), end - offset
+        if end < 0 or start >= num_frames:
+            continue
+
+        restore: Dict[str, Any] = {}
+        for opt in options:
+            if f"--{opt}" not in base[:-1]:
+                raise ValueError(f"Zone option \"{opt}\" is not set in the encoder settings, it couldn't be restored")
+            restore[opt] = base[base.index(f"--{opt}") + 1]
+
+        lines.append((start, _format(options)))
+        if end + 1 < num_frames:
+            lines.append((end + 1, _format(restore)))
+
+    # a restore entry is useless when the next zone starts right after
+    lines = [line for line, nxt in zip(lines, lines[1:] + [(-1, "")]) if line[0] != nxt[0]]
+
+    with open(path, "w") as f:
+        f.writelines([f"{frame} {opts}\n" for frame, opts in lines])
+
+    Status.info(f"Zonefile: {len(zones)} zone(s) written to {path}")
+
+
+def _format(options: Mapping[str, Any]) -> str:
+    return " ".join(f"--{k} {v}" for k, v in options.items())
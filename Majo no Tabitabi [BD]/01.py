@@ -1,6 +1,6 @@
 import vapoursynth as vs
 
-from common import ElainaFiltering, get_encoder, BDMV
+from common import ElainaFiltering, PartialSource, PatchList, get_encoder, BDMV
 
 core = vs.core
 
@@ -13,19 +13,20 @@ CHAPTERS_NAMES = ["Intro", "Partie A", "Partie B", "Epilogue"]
 
 class Filtering(ElainaFiltering):
     def prefilter(self, bd: vs.VideoNode) -> vs.VideoNode:
-        import lvsfunc as lvf
-
-        web = core.ffms2.Source("WEB/[SubsPlease] Majo no Tabitabi - 01v2 (1080p) [C70DFF8B].mkv")[240:]
+        # only the patched frames are decoded
+        web = PartialSource(
+            "WEB/[SubsPlease] Majo no Tabitabi - 01v2 (1080p) [C70DFF8B].mkv",
+            [(1226, 1227), (3330, 3365)], offset=240
+        ).clip
+        patches = PatchList(bd)
 
         # Fix mouth misplacement introduced on BDs — https://slow.pics/c/NE6vqUdq
-        sqmask = lvf.mask.BoundingBox((1084, 663), (225, 200)).get_mask(bd).bilateral.Gaussian(sigma=10)
-        fixed = lvf.rfs(bd, bd.std.MaskedMerge(web, sqmask), [(1226, 1227)])
+        patches.add((1084, 663), (225, 200), web, [(1226, 1227)], feather=10)
 
         # Fix bit of rope they deleted on the BDs — https://slow.pics/c/JdVX7Chb
-        sqmask = lvf.mask.BoundingBox((1841, 458), (67, 17)).get_mask(fixed)
-        fixed = lvf.rfs(fixed, fixed.std.MaskedMerge(web, sqmask), [(3330, 3365)])
+        patches.add((1841, 458), (67, 17), web, [(3330, 3365)])
 
-        return fixed
+        return patches.apply()
 
 
 flt = Filtering(JPBD)
@@ -33,7 +34,7 @@ filtered = flt.filterchain()
 
 
 if __name__ == "__main__":
-    enc = get_encoder(JPBD, filtered, EP_NUM, CHAPTERS, CHAPTERS_NAMES)
+    enc = get_encoder(JPBD, filtered, EP_NUM, CHAPTERS, CHAPTERS_NAMES, flt.zone_ranges, flt.credit_ranges)
     enc.run()
     enc.clean_up()
 
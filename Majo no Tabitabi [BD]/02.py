@@ -1,6 +1,6 @@
 import vapoursynth as vs
 
-from common import ElainaFiltering, get_encoder, BDMV
+from common import ElainaFiltering, PartialSource, PatchList, get_encoder, BDMV
 
 core = vs.core
 
@@ -16,23 +16,23 @@ class Filtering(ElainaFiltering):
     ED_RANGES = (31888, 34045)
 
     def prefilter(self, bd: vs.VideoNode) -> vs.VideoNode:
-        import lvsfunc as lvf
-
-        web = core.ffms2.Source("WEB/[SubsPlease] Majo no Tabitabi - 02v2 (1080p) [C80BFA61].mkv")[240:]
+        # only the patched frames are decoded
+        web = PartialSource(
+            "WEB/[SubsPlease] Majo no Tabitabi - 02v2 (1080p) [C80BFA61].mkv",
+            [(21248, 21310), (21447, 21493)], offset=240
+        ).clip
+        patches = PatchList(bd)
 
         # Undoing a Saya face redraw — https://slow.pics/c/zFGJBtNc
-        sqmask = lvf.mask.BoundingBox((1397, 370), (86, 74)).get_mask(bd).bilateral.Gaussian(sigma=10)
-        fixed = lvf.rfs(bd, bd.std.MaskedMerge(web, sqmask), [(21248, 21310)])
+        patches.add((1397, 370), (86, 74), web, [(21248, 21310)], feather=10)
 
         # Another face redraw undo — https://slow.pics/c/QoxjoSeB
-        sqmask = lvf.mask.BoundingBox((1310, 356), (94, 80)).get_mask(bd).bilateral.Gaussian(sigma=10)
-        fixed = lvf.rfs(fixed, fixed.std.MaskedMerge(web, sqmask), [(21447, 21493)])
+        patches.add((1310, 356), (94, 80), web, [(21447, 21493)], feather=10)
 
         # Very minor line fuck-up
-        sqmask = lvf.mask.BoundingBox((1320, 478), (8, 14)).get_mask(bd)
-        fixed = lvf.rfs(fixed, fixed.std.MaskedMerge(web, sqmask), [(21452, 21454)])
+        patches.add((1320, 478), (8, 14), web, [(21452, 21454)])
 
-        return fixed
+        return patches.apply()
 
 
 flt = Filtering(JPBD)
@@ -40,7 +40,7 @@ filtered = flt.filterchain()
 
 
 if __name__ == "__main__":
-    enc = get_encoder(JPBD, filtered, EP_NUM, CHAPTERS, CHAPTERS_NAMES)
+    enc = get_encoder(JPBD, filtered, EP_NUM, CHAPTERS, CHAPTERS_NAMES, flt.zone_ranges, flt.credit_ranges)
     enc.run()
     enc.clean_up()
 
@@ -24,7 +24,7 @@ filtered = flt.filterchain()
 
 
 if __name__ == "__main__":
-    enc = get_encoder(JPBD, filtered, EP_NUM, CHAPTERS, CHAPTERS_NAMES)
+    enc = get_encoder(JPBD, filtered, EP_NUM, CHAPTERS, CHAPTERS_NAMES, flt.zone_ranges, flt.credit_ranges)
     enc.run()
     enc.clean_up()
 
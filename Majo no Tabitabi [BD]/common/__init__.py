@@ -1,4 +1,8 @@
 # flake8: noqa
 from .encode import *
 from .utils import *
-from .filtering import *
\ No newline at end of file
+from .filtering import *
+from .patch import *
+from .ranges import *
+from .scenes import *
+from .web import *
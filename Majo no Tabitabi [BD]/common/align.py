@@ -0,0 +1,242 @@
+"""
+Frame alignment of a WEB source with a BD episode, from downscaled luma fingerprints
+
+Print the offset and the trims of the WEB source of an episode (from the show folder)::
+
+    python -m common.align 01.py "WEB/[SubsPlease] Majo no Tabitabi - 01v2 (1080p) [C70DFF8B].mkv"
+"""
+__all__ = ["Alignment", "fingerprints", "align"]
+
+import os
+import time
+from typing import List, Tuple
+
+import numpy as np
+import vapoursynth as vs
+from vardautomation import DuplicateFrame, FileInfo, Trim, VPath, logger
+
+from .cache import cache_path, is_stale
+
+
+core = vs.core
+
+Segment = Tuple[int, int, int]
+"""First and last BD frames of a run of matching frames, and WEB frame - BD frame on the run"""
+
+
+class Alignment:
+    """Matching frames of a BD and a WEB source, as runs with a constant offset"""
+
+    segments: List[Segment]
+    """Runs of BD frames with a WEB frame, in order. The BD frames between two runs have no WEB frame."""
+    web_frames: int
+    """Number of frames of the WEB source"""
+
+    def __init__(self, segments: List[Segment], web_frames: int) -> None:
+        self.segments = segments
+        self.web_frames = web_frames
+
+
+    def __str__(self) -> str:
+        return ", ".join(
+            f"BD {start}-{end}: WEB {start + offset}-{end + offset}" for start, end, offset in self.segments
+        )
+
+
+    @property
+    def offset(self) -> int:
+        """Offset of the WEB source, as in ``web[offset:]``. Only defined when no frame was dropped or inserted."""
+        if len(self.segments) != 1:
+            raise ValueError(f"Alignment: the WEB source has drops or inserts, use the trims ({self})")
+        return self.segments[0][2]
+
+
+    def trims(self) -> List[Trim | DuplicateFrame]:
+        """
+        ``trims_or_dfs`` of the WEB :py:class:`FileInfo` giving a clip matching the BD frame by frame.
+        The frames missing from the WEB source are filled with the previous one, or the next one at the start.
+        """
+        trims: List[Trim | DuplicateFrame] = []
+        # last WEB frame used and next BD frame to match
+        last, bd_next = None, 0
+        for start, end, offset in self.segments:
+            start, end = max(start, -offset), min(end, self.web_frames - 1 - offset)
+            if start > end:
+                continue
+            if start > bd_next:
+                trims.append(DuplicateFrame(start + offset if last is None else last, dup=start - bd_next))
+            trims.append((start + offset, end + offset + 1))
+            last, bd_next = end + offset, end + 1
+
+        bd_frames = self.segments[-1][1] + 1
+        if last is not None and bd_next < bd_frames:
+            trims.append(DuplicateFrame(last, dup=bd_frames - bd_next))
+        return trims
+
+
+def fingerprints(
+    clip: vs.VideoNode, width: int = 64, height: int = 36, threads: int | None = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Downscaled luma of every frame, normalized to zero mean and unit norm so a fingerprint
+    doesn't depend on small level or contrast differences between the sources.
+
+    :param clip:        Clip to fingerprint
+    :param width:       Width of the fingerprints
+    :param height:      Height of the fingerprints
+    :param threads:     Number of frames requested concurrently (defaults to the core threads)
+
+    :return:            Fingerprints ``(frames, width * height)`` and average luma of every frame
+    """
+    threads = threads or core.num_threads
+    small = core.resize.Bilinear(clip, width, height, format=vs.GRAYS)
+
+    prints = np.empty((clip.num_frames, width * height), np.float32)
+    start = time.monotonic()
+    for n, f in enumerate(small.frames(prefetch=threads, backlog=threads * 2, close=True)):
+        prints[n] = np.asarray(f[0]).ravel()
+    elapsed = time.monotonic() - start
+    logger.info(f"Fingerprinted {clip.num_frames} frames at {clip.num_frames / max(elapsed, 1e-6):.1f} fps")
+
+    levels = prints.mean(axis=1)
+    prints -= levels[:, None]
+    prints /= np.maximum(np.linalg.norm(prints, axis=1), 1e-6)[:, None]
+    return prints, levels
+
+
+def _cached_fingerprints(
+    source: FileInfo | str | os.PathLike[str], clip: vs.VideoNode, width: int, height: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Fingerprints of a source clip, stored next to it. Only used for uncut sources, whose frames never change."""
+    path = cache_path(source, f".{width}x{height}.prints.npz")
+    src = source.path if isinstance(source, FileInfo) else VPath(source)
+    if not is_stale(path, src):
+        with np.load(path) as data:
+            if len(data["levels"]) == clip.num_frames:
+                return data["prints"], data["levels"]
+
+    prints, levels = fingerprints(clip, width, height)
+    with open(path, "wb") as f:
+        np.savez(f, prints=prints, levels=levels)
+    return prints, levels
+
+
+def _distances(bd: np.ndarray, web: np.ndarray, start: int, end: int, offset: int) -> np.ndarray:
+    """
+    Distance of the BD frames from start to end, exclusive, with their WEB frame,
+    the largest one where there is none
+    """
+    dist = np.full(end - start, 2.0, np.float32)
+    lo, hi = max(start, -offset), min(end, len(web) - offset)
+    if lo < hi:
+        dist[lo - start:hi - start] = 1 - np.einsum("ij,ij->i", bd[lo:hi], web[lo + offset:hi + offset])
+    return dist
+
+
+def align(
+    bd: np.ndarray, bd_levels: np.ndarray, web: np.ndarray, web_levels: np.ndarray,
+    window: int = 500, max_offset: int = 2000, candidates: int = 5, threshold: float = 0.1
+) -> Alignment:
+    """
+    Find the WEB frame of every BD frame from their fingerprints.
+    Every window of BD frames gets its best offset among the peaks of the FFT cross-correlation
+    of the luma variations, checked against the fingerprints. Where the offset changes, the exact
+    frames dropped or inserted are found by minimizing the fingerprint distances of both offsets.
+
+    :param bd:          BD fingerprints
+    :param bd_levels:   BD average lumas
+    :param web:         WEB fingerprints
+    :param web_levels:  WEB average lumas
+    :param window:      Number of BD frames with a single offset
+    :param max_offset:  Highest offset searched, in frames
+    :param candidates:  Number of correlation peaks checked in every window
+    :param threshold:   Highest mean fingerprint distance of a matching window
+
+    :return:            Alignment object
+    """
+    def signal(levels: np.ndarray) -> np.ndarray:
+        diff = np.diff(levels, prepend=levels[:1])
+        return (diff - diff.mean()) / max(float(diff.std()), 1e-6)
+
+    bd_signal, web_signal = signal(bd_levels), signal(web_levels)
+    size = 1 << (len(web_signal) + window).bit_length()
+    web_fft = np.fft.rfft(web_signal, size)
+    lags = np.arange(size)
+    lags[lags > size - window] -= size
+
+    offsets: List[int | None] = []
+    for start in range(0, len(bd), window):
+        end = min(start + window, len(bd))
+        # corr[k] = sum(bd[start + i] * web[k + i]), the negative k (web before its start) wrap around
+        corr = np.fft.irfft(web_fft * np.conj(np.fft.rfft(bd_signal[start:end], size)), size)
+        window_lags = lags - start
+        valid = np.abs(window_lags) <= max_offset
+        peaks = window_lags[valid][np.argsort(corr[valid])[::-1][:candidates]]
+
+        costs = {int(o): float(np.mean(_distances(bd, web, start, end, int(o)))) for o in peaks}
+        if offsets and offsets[-1] is not None:
+            costs.setdefault(offsets[-1], float(np.mean(_distances(bd, web, start, end, offsets[-1]))))
+        best = min(costs.values(), default=np.inf)
+        if best > threshold:
+            offsets.append(None)
+            continue
+        # static windows match several offsets, keep the previous one when it is as good
+        previous = offsets[-1] if offsets else None
+        if previous in costs and costs[previous] <= best + 0.01:
+            offsets.append(previous)
+        else:
+            offsets.append(min(costs, key=costs.__getitem__))
+
+    known = [o for o in offsets if o is not None]
+    if not known:
+        raise ValueError("Alignment: no window of the BD matches the WEB source")
+    # unmatched windows (e.g. credits only on one source) take the offset of the previous one
+    filled = [known[0]]
+    for o in offsets[1:]:
+        filled.append(filled[-1] if o is None else o)
+
+    segments: List[Segment] = []
+    start = 0
+    for i in range(1, len(filled)):
+        o1, o2 = filled[i - 1], filled[i]
+        if o1 == o2:
+            continue
+        lo, hi = (i - 1) * window, min((i + 1) * window, len(bd))
+        c1 = np.concatenate([[0], np.cumsum(_distances(bd, web, lo, hi, o1))])
+        c2 = np.concatenate([[0], np.cumsum(_distances(bd, web, lo, hi, o2))])
+        # BD frames without a WEB frame between the runs
+        gap = max(o1 - o2, 0)
+        ks = np.arange(max(start - lo, 0), hi - lo - gap + 1)
+        totals = c1[ks] + c2[-1] - c2[ks + gap]
+        k = lo + int(ks[np.argmin(totals)])
+        segments.append((start, k - 1, o1))
+        start = k + gap
+    segments.append((start, len(bd) - 1, filled[-1]))
+
+    return Alignment([s for s in segments if s[0] <= s[1]], len(web))
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="Align the WEB source of an episode with its BD")
+    parser.add_argument("script", help="episode script, e.g. 01.py")
+    parser.add_argument("web", help="WEB source")
+    parser.add_argument("--window", type=int, default=500, help="number of BD frames with a single offset")
+    parser.add_argument("--max-offset", type=int, default=2000, help="highest offset searched, in frames")
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__align__")
+    jpbd: FileInfo = episode["JPBD"]
+
+    bd_prints, bd_levels = fingerprints(jpbd.clip_cut)
+    web_prints, web_levels = _cached_fingerprints(args.web, core.ffms2.Source(args.web), 64, 36)
+
+    start = time.monotonic()
+    alignment = align(bd_prints, bd_levels, web_prints, web_levels, args.window, args.max_offset)
+    logger.info(f"Aligned in {time.monotonic() - start:.2f}s: {alignment}")
+
+    if len(alignment.segments) == 1:
+        logger.info(f"WEB offset: web[{alignment.offset}:]")
+    logger.info(f"WEB trims_or_dfs: {alignment.trims()!r}")
@@ -0,0 +1,237 @@
+"""
+Per-frame statistics of a whole clip, computed in one decoding pass and stored as columns next to the source
+
+Compute the statistics of an episode and print a summary (from the show folder)::
+
+    python -m common.analysis 01.py
+"""
+__all__ = ["FrameStats", "to_ranges"]
+
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Sequence
+
+import numpy as np
+import vapoursynth as vs
+from vardautomation import FileInfo, VPath, logger
+
+from .cache import cache_path, is_stale
+from .ranges import Range
+
+
+core = vs.core
+
+
+def to_ranges(frames: np.ndarray) -> List[Range]:
+    """Inclusive ranges of the true values of a boolean column"""
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], frames.astype(np.int8), [0]])))
+    return [(int(start), int(end) - 1) for start, end in zip(edges[::2], edges[1::2])]
+
+
+class FrameStats:
+    """
+    Columns of per-frame statistics. The luma is analysed at ``1/scale`` of the resolution in batches
+    of frames stacked from zero-copy views of the rendered planes, the plane averages come from ``PlaneStats``
+    at full resolution.
+
+    Columns:
+
+    - ``mean_y``, ``mean_u``, ``mean_v``, ``min_y``, ``max_y``: plane statistics, normalized to [0, 1]
+    - ``hist_y``: luma histogram of ``HIST_BINS`` bins
+    - ``block_std``: average standard deviation of the luma blocks, normalized
+    - ``flat_blocks``: fraction of the luma blocks whose standard deviation is below ``FLAT_STD``
+    - ``dhash``: 64-bit difference hash of a 9x8 area downscale
+    - ``thumb``: 32x18 8-bit area downscale of the luma
+    - ``diff_prev``: mean absolute difference of ``thumb`` with the previous frame, normalized
+    """
+
+    VERSION = 1
+    SUFFIX = ".stats.npz"
+    HIST_BINS = 64
+    BLOCK = 16
+    FLAT_STD = 0.5 / 255
+    THUMB = (18, 32)
+
+    columns: Dict[str, np.ndarray]
+    """Every column, indexed by frame"""
+
+    def __init__(self, columns: Dict[str, np.ndarray]) -> None:
+        self.columns = columns
+
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+
+    @property
+    def num_frames(self) -> int:
+        return len(self.columns["mean_y"])
+
+
+    @classmethod
+    def from_file(
+        cls, file: FileInfo, clip: vs.VideoNode | None = None, sources: Sequence[str | os.PathLike[str]] = (),
+        force: bool = False, **compute_args: int
+    ) -> "FrameStats":
+        """
+        Get the statistics of an episode, computing them only if there is no valid cache
+
+        :param file:            FileInfo of the episode, the cache is stored next to its source
+        :param clip:            Clip to analyse, defaults to ``file.clip_cut``
+        :param sources:         Other files the clip depends on (e.g. the script), the cache is stale if one is newer
+        :param force:           Compute the statistics even if a cache exists
+        :param compute_args:    Arguments of :py:meth:`compute`
+        """
+        clip = clip if clip is not None else file.clip_cut
+        path = cache_path(file, cls.SUFFIX)
+
+        if not force and not any(is_stale(path, src) for src in [file.path, *sources] if os.path.isfile(src)):
+            stats = cls.load(path)
+            if stats is not None and stats.num_frames == clip.num_frames:
+                return stats
+            logger.warning(f"Frame statistics {path.name} do not match the clip, computing them again")
+
+        stats = cls.compute(clip, **compute_args)
+        stats.write(path)
+        return stats
+
+
+    @classmethod
+    def load(cls, path: str | os.PathLike[str]) -> "FrameStats | None":
+        """Columns of a statistics file, None if it was written by another version"""
+        with np.load(path) as data:
+            if int(data["version"]) != cls.VERSION:
+                return None
+            return cls({name: data[name] for name in data.files if name != "version"})
+
+
+    def write(self, path: str | os.PathLike[str]) -> None:
+        # written to a temporary file first, an interrupted write doesn't leave a valid cache
+        tmp = VPath(f"{VPath(path).to_str()}.tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, version=np.array(self.VERSION), **self.columns)
+        os.replace(tmp, path)
+
+
+    @classmethod
+    def compute(
+        cls, clip: vs.VideoNode, scale: int = 2, batch: int = 32, threads: int | None = None
+    ) -> "FrameStats":
+        """
+        Render the clip once and compute every column
+
+        :param clip:        Clip to analyse
+        :param scale:       Divisor of the resolution the luma is analysed at
+        :param batch:       Number of frames stacked and analysed together
+        :param threads:     Number of frames requested concurrently (defaults to the core threads)
+        """
+        assert clip.format
+        threads = threads or core.num_threads
+        # a worker analyses a batch faster than it is rendered, a few are enough to keep up
+        workers = min(threads, 4)
+        num_frames = clip.num_frames
+
+        planes = ["y"] if clip.format.num_planes == 1 else ["y", "u", "v"]
+        analysed = clip
+        for i, plane in enumerate(planes):
+            analysed = analysed.std.PlaneStats(plane=i, prop=f"Stats{plane.upper()}")
+        analysed = core.resize.Bilinear(analysed, clip.width // scale, clip.height // scale, format=vs.GRAY16)
+
+        columns: Dict[str, np.ndarray] = {
+            **{f"mean_{p}": np.zeros(num_frames, np.float32) for p in ["y", "u", "v"]},
+            "min_y": np.zeros(num_frames, np.float32),
+            "max_y": np.zeros(num_frames, np.float32),
+            "hist_y": np.zeros((num_frames, cls.HIST_BINS), np.uint32),
+            "block_std": np.zeros(num_frames, np.float32),
+            "flat_blocks": np.zeros(num_frames, np.float32),
+            "dhash": np.zeros(num_frames, np.uint64),
+            "thumb": np.zeros((num_frames, *cls.THUMB), np.uint8),
+        }
+        peak = (1 << clip.format.bits_per_sample) - 1 if clip.format.sample_type == vs.INTEGER else 1
+
+        start = time.monotonic()
+        pending: List[Future[None]] = []
+        frames: List[vs.VideoFrame] = []
+        with ThreadPoolExecutor(workers) as executor:
+            for n, f in enumerate(analysed.frames(prefetch=threads, backlog=threads * 2)):
+                props = f.props
+                for p in planes:
+                    columns[f"mean_{p}"][n] = props[f"Stats{p.upper()}Average"]
+                columns["min_y"][n] = props["StatsYMin"] / peak
+                columns["max_y"][n] = props["StatsYMax"] / peak
+
+                frames.append(f)
+                if len(frames) == batch or n == num_frames - 1:
+                    pending.append(executor.submit(cls._analyse, columns, n + 1 - len(frames), frames))
+                    frames = []
+                # bound the frames held by the batches waiting for a worker
+                while len(pending) > workers:
+                    pending.pop(0).result()
+
+            for future in pending:
+                future.result()
+        elapsed = time.monotonic() - start
+
+        thumbs = columns["thumb"].astype(np.int16)
+        diff = np.abs(np.diff(thumbs, axis=0)).mean(axis=(1, 2)) / 255
+        columns["diff_prev"] = np.concatenate([[0], diff]).astype(np.float32)
+
+        logger.info(f"Analysed {num_frames} frames at {num_frames / max(elapsed, 1e-6):.1f} fps")
+        return cls(columns)
+
+
+    @classmethod
+    def _analyse(cls, columns: Dict[str, np.ndarray], first: int, frames: List[vs.VideoFrame]) -> None:
+        """Fill the rows of a batch of consecutive GRAY16 frames"""
+        # the planes are read in place, stacking them is the only copy
+        luma = np.stack([np.asarray(f[0]) for f in frames])
+        rows = slice(first, first + len(frames))
+        count, height, width = luma.shape
+
+        shift = 16 - int(np.log2(cls.HIST_BINS))
+        bins = (luma >> shift).reshape(count, -1).astype(np.intp) + np.arange(count)[:, None] * cls.HIST_BINS
+        columns["hist_y"][rows] = np.bincount(bins.ravel(), minlength=count * cls.HIST_BINS).reshape(count, -1)
+
+        b = cls.BLOCK
+        blocks = luma[:, :height // b * b, :width // b * b].reshape(count, height // b, b, width // b, b)
+        std = blocks.astype(np.float32).std(axis=(2, 4)) / 65535
+        columns["block_std"][rows] = std.mean(axis=(1, 2))
+        columns["flat_blocks"][rows] = (std < cls.FLAT_STD).mean(axis=(1, 2))
+
+        small = cls._area(luma, 8, 9)
+        bits = small[:, :, 1:] > small[:, :, :-1]
+        columns["dhash"][rows] = np.packbits(bits.reshape(count, 64), axis=1).view(">u8").ravel()
+
+        columns["thumb"][rows] = np.round(cls._area(luma, *cls.THUMB) / 257).astype(np.uint8)
+
+
+    @staticmethod
+    def _area(luma: np.ndarray, height: int, width: int) -> np.ndarray:
+        """Area downscale of a stack of planes, cropping the pixels that don't fill a whole area"""
+        count, h, w = luma.shape
+        bh, bw = h // height, w // width
+        areas = luma[:, :bh * height, :bw * width].reshape(count, height, bh, width, bw)
+        return areas.mean(axis=(2, 4), dtype=np.float32)
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="Compute the frame statistics of an episode")
+    parser.add_argument("script", help="episode script, e.g. 01.py")
+    parser.add_argument("--force", action="store_true", help="compute them even if a cache exists")
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__analysis__")
+    jpbd: FileInfo = episode["JPBD"]
+
+    start = time.monotonic()
+    stats = FrameStats.from_file(jpbd, force=args.force)
+    logger.info(f"Loaded {len(stats.columns)} columns of {stats.num_frames} frames in {time.monotonic() - start:.2f}s")
+
+    black = to_ranges(stats["max_y"] < 0.1)
+    logger.info(f"Black ranges: {black}")
+    logger.info(f"Exact duplicates: {int((stats['diff_prev'][1:] == 0).sum())}")
+    logger.info(f"Frames with mostly flat blocks: {int((stats['flat_blocks'] > 0.5).sum())}")
@@ -0,0 +1,113 @@
+__all__ = ["FusedAudioEncoder"]
+
+import subprocess
+from fractions import Fraction
+from typing import Dict, List, Sequence, Tuple
+
+from vardautomation import AudioEncoder, BinaryPath, FileInfo, FlacEncoder, QAACEncoder, logger
+
+from .ranges import TrimMap
+
+
+class FusedAudioEncoder:
+    """
+    Extract, cut and encode an audio track in a single pipeline.
+    ffmpeg decodes the track and cuts it with sample-exact ``atrim`` filters, then pipes the PCM to the encoder,
+    so nothing is written to disk between the three steps.
+    """
+
+    file: FileInfo
+    """FileInfo object"""
+    encoder: AudioEncoder
+    """Configured audio encoder, its ``a_src_cut`` input is replaced by the pipe"""
+    track_in: int
+    """Track number of the source file (same numbering as ``FFmpegAudioExtracter``)"""
+    track: int
+    """Output track number"""
+    segments: List[Tuple[int, int]] | None
+    """Source segments ``[start, end)`` to keep, in output order. Defaults to the trims of the file."""
+
+    def __init__(self, encoder: AudioEncoder, track_in: int, segments: Sequence[Tuple[int, int]] | None = None) -> None:
+        self.encoder = encoder
+        self.file = encoder.file
+        self.track = encoder.track
+        self.track_in = track_in
+        self.segments = list(segments) if segments is not None else None
+
+
+    def run(self) -> None:
+        assert self.file.a_src_cut
+
+        decoder = self._decoder_params()
+
+        self.encoder._update_settings()
+        src = self.file.a_src_cut.set_track(self.track).to_str()
+        encoder = [self.encoder.binary.to_str()] + self._stdin_args() + [
+            "-" if p == src else p for p in self.encoder.params[1:]
+        ]
+
+        logger.info("Fused audio command: " + " ".join(decoder) + " | " + " ".join(encoder))
+
+        with subprocess.Popen(decoder, stdout=subprocess.PIPE) as dec_proc:
+            with subprocess.Popen(encoder, stdin=dec_proc.stdout) as enc_proc:
+                # only the encoder holds the pipe, the decoder stops if the encoder dies
+                assert dec_proc.stdout
+                dec_proc.stdout.close()
+
+        if dec_proc.returncode:
+            raise subprocess.CalledProcessError(dec_proc.returncode, decoder)
+        if enc_proc.returncode:
+            raise subprocess.CalledProcessError(enc_proc.returncode, encoder)
+
+        if self.encoder.xml_tag:
+            self.encoder._write_encoder_name_file()
+
+
+    def _decoder_params(self) -> List[str]:
+        sample_rate, codec = self._track_info()
+        frames = self.segments if self.segments is not None else TrimMap.from_file(self.file).segments
+        fps = Fraction(self.file.clip.fps_num, self.file.clip.fps_den)
+
+        # samples are counted from the first sample of the track, like the cutters on an extracted file
+        segments = [(self._to_sample(s, sample_rate, fps), self._to_sample(e, sample_rate, fps)) for s, e in frames]
+        labels = [f"[s{i}]" for i in range(len(segments))]
+
+        graph = f"[0:{self.track_in}]asetpts=N/SR/TB,asplit={len(segments)}{''.join(labels)};"
+        graph += "".join(
+            f"{label}atrim=start_sample={start}:end_sample={end},asetpts=N/SR/TB[a{i}];"
+            for i, (label, (start, end)) in enumerate(zip(labels, segments))
+        )
+        graph += "".join(f"[a{i}]" for i in range(len(segments))) + f"concat=n={len(segments)}:v=0:a=1[out]"
+
+        return [
+            BinaryPath.ffmpeg.to_str(), "-hide_banner", "-loglevel", "error",
+            "-i", self.file.path.to_str(),
+            "-filter_complex", graph, "-map", "[out]",
+            "-c:a", codec, "-f", "wav", "-"
+        ]
+
+
+    def _track_info(self) -> Tuple[int, str]:
+        acodecs: Dict[int, str] = {24: "pcm_s24le", 16: "pcm_s16le"}
+
+        track = self.file.media_info.to_data()["tracks"][1 + self.track_in]
+        if track["track_type"] != "Audio":
+            raise ValueError(f"{self.__class__.__name__}: track number \"{self.track_in}\" is not an audio track!")
+
+        # lossy sources are decoded, keep enough precision for them
+        bit_depth = int(track.get("bit_depth", 24)) if track["format"] in {"PCM", "DTS"} else 24
+        return int(track["sampling_rate"]), acodecs.get(bit_depth, "pcm_s24le")
+
+
+    def _stdin_args(self) -> List[str]:
+        # the wav length is unknown on a pipe
+        if isinstance(self.encoder, QAACEncoder):
+            return ["--ignorelength"]
+        if isinstance(self.encoder, FlacEncoder) and self.encoder.binary == BinaryPath.flac:
+            return ["--ignore-chunk-sizes"]
+        return []
+
+
+    @staticmethod
+    def _to_sample(frame: int, sample_rate: int, fps: Fraction) -> int:
+        return round(frame * sample_rate / fps)
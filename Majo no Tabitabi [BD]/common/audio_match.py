@@ -0,0 +1,287 @@
+"""
+OP/ED location from audio fingerprints, a cheap first pass before the video hashes of :py:mod:`common.detect`
+
+The songs are found from spectral peak landmarks of the cut audio of the episode and of the NCOP/NCED,
+then only the frames around the candidate bounds are hashed to place them exactly::
+
+    python -m common.audio_match 01.py
+"""
+__all__ = ["AudioFingerprint", "AudioMatch", "decode_cut_audio", "locate", "refine"]
+
+import subprocess
+import time
+from fractions import Fraction
+
+import numpy as np
+import vapoursynth as vs
+from numpy.lib.stride_tricks import sliding_window_view
+from vardautomation import BinaryPath, FileInfo, logger
+
+from .cache import cache_path, is_stale
+from .detect import NCMatch, dhash, hamming
+from .ranges import Range, TrimMap
+
+
+core = vs.core
+
+
+def decode_cut_audio(file: FileInfo, track_in: int = 1, sample_rate: int = 8000) -> np.ndarray:
+    """
+    Mono downmix of an audio track cut like the video, with the ``atrim`` graph of
+    :py:class:`common.audio.FusedAudioEncoder`, so its times are those of ``clip_cut``
+
+    :param file:            FileInfo object
+    :param track_in:        Track number of the source file (same numbering as ``FFmpegAudioExtracter``)
+    :param sample_rate:     Rate of the downmix
+    """
+    fps = Fraction(file.clip.fps_num, file.clip.fps_den)
+    segments = TrimMap.from_file(file).segments
+    labels = [f"[s{i}]" for i in range(len(segments))]
+
+    graph = f"[0:{track_in}]asetpts=N/SR/TB,asplit={len(segments)}{''.join(labels)};"
+    graph += "".join(
+        f"{label}atrim=start={float(start / fps):.6f}:end={float(end / fps):.6f},asetpts=N/SR/TB[a{i}];"
+        for i, (label, (start, end)) in enumerate(zip(labels, segments))
+    )
+    graph += "".join(f"[a{i}]" for i in range(len(segments))) + f"concat=n={len(segments)}:v=0:a=1[out]"
+
+    params = [
+        BinaryPath.ffmpeg.to_str(), "-hide_banner", "-loglevel", "error", "-i", file.path.to_str(),
+        "-filter_complex", graph, "-map", "[out]", "-ac", "1", "-ar", str(sample_rate), "-f", "f32le", "-"
+    ]
+    return np.frombuffer(subprocess.run(params, capture_output=True, check=True).stdout, np.float32)
+
+
+class AudioFingerprint:
+    """Landmarks of an audio track: pairs of spectral peaks hashed with their time difference"""
+
+    SAMPLE_RATE = 8000
+    N_FFT = 512
+    HOP = 256
+
+    hashes: np.ndarray
+    """uint32 hash of every landmark ``(f1, f2, dt)``, sorted"""
+    times: np.ndarray
+    """Spectrogram frame of the anchor peak of every landmark, in the order of ``hashes``"""
+
+    def __init__(self, hashes: np.ndarray, times: np.ndarray) -> None:
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.times = times[order]
+
+
+    @classmethod
+    def from_samples(
+        cls, samples: np.ndarray, neighborhood: int = 5, peaks_per_frame: int = 5, fan_out: int = 8,
+        max_dt: int = 63
+    ) -> "AudioFingerprint":
+        """
+        :param samples:         Mono samples at ``SAMPLE_RATE``
+        :param neighborhood:    Half size of the time and frequency window a peak is the maximum of
+        :param peaks_per_frame: Highest number of peaks kept in a spectrogram frame
+        :param fan_out:         Number of later peaks every peak is paired with
+        :param max_dt:          Longest time difference of a pair, in spectrogram frames (6 bits)
+        """
+        frames = sliding_window_view(samples, cls.N_FFT)[::cls.HOP] * np.hanning(cls.N_FFT).astype(np.float32)
+        spec = np.log(np.abs(np.fft.rfft(frames, axis=1)) + 1e-6)[:, :256]
+
+        # local maxima of a separable max filter, above the average of their frame
+        pad = np.pad(spec, neighborhood, mode="edge")
+        local = sliding_window_view(pad, 2 * neighborhood + 1, axis=1).max(axis=-1)
+        local = sliding_window_view(local, 2 * neighborhood + 1, axis=0).max(axis=-1)
+        peaks = (spec == local) & (spec > spec.mean(axis=1, keepdims=True) + 1)
+
+        # strongest peaks of every frame
+        ranked = np.where(peaks, spec, -np.inf)
+        kept = np.argsort(ranked, axis=1)[:, ::-1][:, :peaks_per_frame]
+        t, rank = np.nonzero(np.isfinite(np.take_along_axis(ranked, kept, axis=1)))
+        f = kept[t, rank]
+        order = np.lexsort((f, t))
+        t, f = t[order], f[order]
+
+        hashes, times = [], []
+        for k in range(1, fan_out + 1):
+            t2, f2 = t[k:], f[k:]
+            dt = t2 - t[:-k]
+            valid = (dt > 0) & (dt <= max_dt)
+            hashes.append((f[:-k][valid].astype(np.uint32) << 14) | (f2[valid].astype(np.uint32) << 6) | dt[valid])
+            times.append(t[:-k][valid])
+
+        return cls(np.concatenate(hashes).astype(np.uint32), np.concatenate(times).astype(np.int32))
+
+
+    @classmethod
+    def from_file(cls, file: FileInfo, track_in: int = 1) -> "AudioFingerprint":
+        """Fingerprint of the cut audio of a FileInfo, stored next to its source"""
+        path = cache_path(file, f".{track_in}.afp.npz")
+        if not is_stale(path, file.path):
+            with np.load(path) as data:
+                return cls(data["hashes"], data["times"])
+
+        start = time.monotonic()
+        fingerprint = cls.from_samples(decode_cut_audio(file, track_in, cls.SAMPLE_RATE))
+        logger.info(
+            f"Fingerprinted the audio of {file.path.name}: {len(fingerprint.hashes)} landmarks "
+            f"in {time.monotonic() - start:.1f}s"
+        )
+        with open(path, "wb") as f:
+            np.savez(f, hashes=fingerprint.hashes, times=fingerprint.times)
+        return fingerprint
+
+
+    @classmethod
+    def seconds(cls, t: float) -> float:
+        return t * cls.HOP / cls.SAMPLE_RATE
+
+
+class AudioMatch:
+    """Part of a creditless song found in the episode audio"""
+
+    offset: float
+    """Time of the start of the creditless clip in the episode, in seconds"""
+    start: float
+    """First matching time of the episode, in seconds"""
+    end: float
+    """Last matching time of the episode, in seconds"""
+    score: float
+    """Landmarks agreeing on the offset over those of the runner-up offset"""
+
+    def __init__(self, offset: float, start: float, end: float, score: float) -> None:
+        self.offset = offset
+        self.start = start
+        self.end = end
+        self.score = score
+
+
+    def __str__(self) -> str:
+        return f"offset {self.offset:.2f}s, matching {self.start:.2f}s-{self.end:.2f}s, score {self.score:.1f}"
+
+
+    def frames(self, fps: Fraction, nc_frames: int) -> Range:
+        """Candidate inclusive range of the episode: the creditless clip at the offset, cut where the match ends"""
+        start = round(self.offset * fps)
+        end = min(start + nc_frames - 1, round(self.end * fps))
+        return start, end
+
+
+def locate(
+    episode: AudioFingerprint, nc: AudioFingerprint, max_repeats: int = 64, tolerance: int = 1
+) -> AudioMatch | None:
+    """
+    Find the creditless song in the episode from the landmarks they share.
+    Every shared hash votes for the time difference of its occurrences, the song is at the most voted one.
+
+    :param episode:     Fingerprint of the episode
+    :param nc:          Fingerprint of the creditless clip
+    :param max_repeats: Hashes occurring more often in the episode are ignored (silence, tones)
+    :param tolerance:   Spectrogram frames of jitter allowed around the offset
+
+    :return:            AudioMatch object, None if no landmark is shared
+    """
+    lo = np.searchsorted(episode.hashes, nc.hashes, side="left")
+    hi = np.searchsorted(episode.hashes, nc.hashes, side="right")
+    counts = hi - lo
+    keep = (counts > 0) & (counts <= max_repeats)
+    if not keep.any():
+        return None
+
+    # every (nc landmark, episode landmark) pair with the same hash
+    counts, lo, nc_times = counts[keep], lo[keep], nc.times[keep]
+    pairs = np.repeat(np.arange(len(counts)), counts)
+    index = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    ep_times = episode.times[index]
+    deltas = ep_times - nc_times[pairs]
+
+    shift = max(-int(deltas.min()), 0)
+    votes = np.bincount(deltas + shift)
+    smoothed = np.convolve(votes, np.ones(2 * tolerance + 1, np.int64), mode="same")
+    best = int(np.argmax(smoothed))
+
+    runner_up = smoothed.copy()
+    runner_up[max(best - 4 * tolerance - 2, 0):best + 4 * tolerance + 3] = 0
+    score = float(smoothed[best] / max(runner_up.max(), 1))
+
+    delta = best - shift
+    matched = ep_times[np.abs(deltas - delta) <= tolerance]
+    return AudioMatch(
+        AudioFingerprint.seconds(delta), AudioFingerprint.seconds(matched.min()),
+        AudioFingerprint.seconds(matched.max() + 1), score
+    )
+
+
+def refine(
+    clip: vs.VideoNode, nc: vs.VideoNode, candidate: Range, window: int = 24, threshold: int = 10
+) -> NCMatch | None:
+    """
+    Place the bounds of a candidate range with the video hashes of the frames around them only
+
+    :param clip:        Episode clip
+    :param nc:          Creditless clip
+    :param candidate:   Inclusive range from :py:meth:`AudioMatch.frames`
+    :param window:      Largest error of the candidate bounds, in frames
+    :param threshold:   Highest Hamming distance of matching frames
+
+    :return:            NCMatch object, None if the frames around the start don't match
+    """
+    start, end = candidate
+
+    # offset of the creditless clip: the one matching most of its first frames
+    ep_lo, ep_hi = max(start - window, 0), min(start + 2 * window, clip.num_frames - 1)
+    nc_head = dhash(nc[:min(window, nc.num_frames)])
+    ep_head = dhash(clip[ep_lo:ep_hi + 1])
+    offsets = range(ep_lo, ep_hi - len(nc_head) + 2)
+    if not len(offsets):
+        return None
+    matches = [int((hamming(ep_head[o - ep_lo:o - ep_lo + len(nc_head)], nc_head) <= threshold).sum()) for o in offsets]
+    best = max(range(len(matches)), key=matches.__getitem__)
+    offset = offsets[best]
+    if matches[best] < len(nc_head) // 2:
+        return None
+
+    # last matching frame around the candidate end, along the offset
+    lo = max(end - window, offset)
+    hi = min(end + window, clip.num_frames - 1, offset + nc.num_frames - 1)
+    ep_tail = dhash(clip[lo:hi + 1])
+    nc_tail = dhash(nc[lo - offset:hi - offset + 1])
+    matched = np.flatnonzero(hamming(ep_tail, nc_tail) <= threshold)
+    last = lo + int(matched[-1]) if len(matched) else end
+
+    confidence = (matches[best] + len(matched)) / (len(nc_head) + len(ep_tail))
+    return NCMatch(offset, last, 0, confidence)
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    from .utils import NCOP, NCED
+
+    parser = argparse.ArgumentParser(description="Locate the OP and ED of an episode from its audio")
+    parser.add_argument("script", help="episode script, e.g. 01.py")
+    parser.add_argument("--track", type=int, default=1, help="audio track (same numbering as FFmpegAudioExtracter)")
+    parser.add_argument("--no-refine", action="store_true", help="only print the audio candidates")
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__audio_match__")
+    jpbd: FileInfo = episode["JPBD"]
+    fps = Fraction(jpbd.clip.fps_num, jpbd.clip.fps_den)
+    episode_fp = AudioFingerprint.from_file(jpbd, args.track)
+
+    for name, nc in [("OP_RANGES", NCOP), ("ED_RANGES", NCED)]:
+        start = time.monotonic()
+        match = locate(episode_fp, AudioFingerprint.from_file(nc, args.track))
+        elapsed = time.monotonic() - start
+        if match is None or match.score < 3:
+            logger.info(f"{name}: not found in the audio ({match})")
+            continue
+
+        candidate = match.frames(fps, nc.clip_cut.num_frames)
+        logger.info(f"{name}: {match}, candidate {candidate} (located in {elapsed:.2f}s)")
+        if args.no_refine:
+            continue
+
+        refined = refine(jpbd.clip_cut, nc.clip_cut, candidate)
+        if refined is None:
+            logger.warning(f"{name}: the video doesn't match around the candidate")
+        else:
+            logger.info(f"{name} = {refined.ranges}")
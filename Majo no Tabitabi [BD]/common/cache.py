@@ -0,0 +1,23 @@
+__all__ = ["cache_path", "is_stale"]
+
+import os
+
+from vardautomation import FileInfo, VPath
+
+
+def cache_path(file: FileInfo | str | os.PathLike[str], suffix: str) -> VPath:
+    """
+    Path of an analysis cache stored next to the source, like the ``.lwi`` index
+
+    :param file:        FileInfo object or path of the source
+    :param suffix:      Cache extension (e.g. ``.scenes``)
+    """
+    path = file.path if isinstance(file, FileInfo) else VPath(file)
+    return VPath(f"{path.to_str()}{suffix}")
+
+
+def is_stale(cache: str | os.PathLike[str], source: str | os.PathLike[str]) -> bool:
+    """True if the cache is missing or older than its source"""
+    if not os.path.isfile(cache):
+        return True
+    return os.path.getmtime(cache) < os.path.getmtime(source)
@@ -0,0 +1,280 @@
+"""
+Per-episode CRF search from trial encodes of scene-aligned samples
+
+Usage (from the show folder)::
+
+    python -m common.crf_search 03.py --target 0.985
+"""
+__all__ = ["CRFSearch", "settings_with_crf"]
+
+import json
+import os
+import re
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence
+
+import numpy as np
+import vapoursynth as vs
+from numpy.typing import NDArray
+from vardautomation import X265, BinaryPath, FileInfo, VPath, logger
+
+from .ranges import Range, TrimMap
+from .scenes import SceneIndex
+
+
+core = vs.core
+
+
+def settings_with_crf(settings: str, crf: float | None) -> List[str]:
+    """Read a x265 settings file and replace its CRF"""
+    with open(settings, "r") as f:
+        params = [p for p in re.split(r"[\n\s]\s*", f.read()) if p]
+
+    if crf is not None:
+        if "--crf" in params:
+            params[params.index("--crf") + 1] = str(crf)
+        else:
+            params += ["--crf", str(crf)]
+
+    return params
+
+
+class CRFSearch:
+    """Pick the highest CRF of an episode that still reaches a target quality on a few samples"""
+
+    CRF_FILE = VPath("crf.json")
+    """Per-episode CRF, read by ``get_encoder``"""
+
+    file: FileInfo
+    clip: vs.VideoNode
+    ep_num: str
+    settings: str
+    crfs: List[float]
+    target: float
+    samples: int
+    sample_length: int
+    workers: int
+    workdir: VPath
+
+    def __init__(
+        self,
+        file: FileInfo,
+        clip: vs.VideoNode,
+        ep_num: int | str,
+        settings: str = "common/x265_settings",
+        crfs: Sequence[float] = (11, 12, 13, 14, 15, 16),
+        target: float = 0.985,
+        samples: int = 8,
+        sample_length: int = 48,
+        workers: int | None = None,
+    ) -> None:
+        """
+        :param file:            FileInfo object of the episode
+        :param clip:            Filtered clip, as sent to the encoder
+        :param ep_num:          Episode number
+        :param settings:        x265 settings file
+        :param crfs:            CRF values to try
+        :param target:          Quality target: 10th percentile of the per-frame luma SSIM
+        :param samples:         Number of samples (one scene each)
+        :param sample_length:   Number of frames per sample
+        :param workers:         Number of trial encodes running at the same time, defaults to one per CRF
+        """
+        self.file = file
+        self.clip = clip
+        self.ep_num = str(ep_num)
+        self.settings = settings
+        self.crfs = sorted(crfs)
+        self.target = target
+        self.samples = samples
+        self.sample_length = sample_length
+        self.workers = workers or len(self.crfs)
+        self.workdir = VPath(f"crf_search/{self.ep_num}")
+
+
+    def run(self) -> float:
+        """Run the search and store the chosen CRF"""
+        start = time.monotonic()
+        self.workdir.mkdir(parents=True, exist_ok=True)
+
+        samples = self.pick_samples()
+        sample_clip = core.std.Splice([self.clip[s:e + 1] for s, e in samples])
+
+        cost = sample_clip.num_frames * len(self.crfs) / self.clip.num_frames
+        logger.info(f"CRF search: {len(samples)} samples, {sample_clip.num_frames} frames, ~{cost:.1%} of an encode")
+        if cost > 0.1:
+            logger.warning("CRF search: the samples cost more than 10% of a full encode")
+
+        ref = self._render(sample_clip)
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            encodes = list(executor.map(lambda crf: self._encode(sample_clip, ref, crf), self.crfs))
+            scores = dict(zip(
+                self.crfs, executor.map(lambda crf, enc: self._score(ref, enc, sample_clip, crf), self.crfs, encodes)
+            ))
+
+        for crf, score in scores.items():
+            logger.info(f"CRF {crf}: {score:.5f}")
+
+        crf = self._choose(scores)
+        self.write(crf)
+
+        logger.info(f"CRF search: episode {self.ep_num} -> CRF {crf} in {time.monotonic() - start:.0f}s")
+        return crf
+
+
+    def pick_samples(self) -> List[Range]:
+        """First frames of long enough scenes spread over the episode, so samples start on a scene change"""
+        scenes = SceneIndex.from_file(self.file).scenes(TrimMap.from_file(self.file))
+        long_scenes = [(s, e) for s, e in scenes if e - s + 1 >= self.sample_length] or scenes
+
+        step = max(len(long_scenes) / self.samples, 1)
+        picked = [long_scenes[int(i * step)] for i in range(min(self.samples, len(long_scenes)))]
+        return [(s, min(e, s + self.sample_length - 1)) for s, e in picked]
+
+
+    @classmethod
+    def load(cls, ep_num: int | str) -> float | None:
+        """CRF stored for an episode, if any"""
+        if not cls.CRF_FILE.exists():
+            return None
+        with open(cls.CRF_FILE, "r") as f:
+            return json.load(f).get(str(ep_num))
+
+
+    def write(self, crf: float) -> None:
+        crfs: Dict[str, float] = {}
+        if self.CRF_FILE.exists():
+            with open(self.CRF_FILE, "r") as f:
+                crfs = json.load(f)
+
+        crfs[self.ep_num] = crf
+
+        with open(self.CRF_FILE, "w") as f:
+            json.dump(dict(sorted(crfs.items())), f, indent=4)
+
+
+    def _render(self, clip: vs.VideoNode) -> VPath:
+        ref = self.workdir / "reference.y4m"
+        with open(ref, "wb") as f:
+            clip.output(f, y4m=True)
+        return ref
+
+
+    def _encode(self, clip: vs.VideoNode, ref: VPath, crf: float) -> VPath:
+        output = self.workdir / f"crf_{crf}.hevc"
+
+        # let vardautomation fill the settings, then read from the reference file instead of stdin
+        encoder = X265(settings_with_crf(self.settings, crf))
+        encoder.file = self.file
+        encoder.clip = clip
+        encoder._update_settings()
+
+        params = encoder.params
+        params[params.index("-o") + 1] = output.to_str()
+        params += ["--pools", str(max((os.cpu_count() or 1) // self.workers, 1)), "--log-level", "error"]
+
+        with open(ref, "rb") as stdin:
+            subprocess.run(params, stdin=stdin, check=True)
+
+        return output
+
+
+    def _score(self, ref: VPath, encode: VPath, clip: vs.VideoNode, crf: float) -> float:
+        width, height = clip.width, clip.height
+        bits = clip.format.bits_per_sample
+        dtype = np.uint8 if bits == 8 else np.dtype("<u2")
+        peak = (1 << bits) - 1
+
+        frame_size = clip.width * clip.height * clip.format.bytes_per_sample
+        frame_size += 2 * (frame_size >> (clip.format.subsampling_w + clip.format.subsampling_h))
+
+        with open(ref, "rb") as f:
+            header = len(f.readline())
+        ref_frames = np.memmap(ref, dtype=np.uint8, mode="r", offset=header)
+
+        luma_bytes = width * height * (1 if bits == 8 else 2)
+        pix_fmt = "gray" if bits == 8 else f"gray{bits}le"
+
+        decoder = subprocess.Popen(
+            [
+                BinaryPath.ffmpeg.to_str(), "-v", "error", "-i", encode.to_str(),
+                "-f", "rawvideo", "-pix_fmt", pix_fmt, "-"
+            ],
+            stdout=subprocess.PIPE
+        )
+        assert decoder.stdout
+
+        ssim: List[float] = []
+        for n in range(clip.num_frames):
+            data = decoder.stdout.read(luma_bytes)
+            if len(data) < luma_bytes:
+                break
+            pos = n * (len(b"FRAME\n") + frame_size) + len(b"FRAME\n")
+            a = ref_frames[pos:pos + luma_bytes].view(dtype).reshape(height, width)
+            b = np.frombuffer(data, dtype).reshape(height, width)
+            ssim.append(_ssim(a, b, peak))
+
+        # a failed or truncated decode would be scored on the frames before the error
+        if decoder.wait():
+            raise RuntimeError(f"CRF search: decoding the CRF {crf} trial failed with code {decoder.returncode}")
+        if len(ssim) != clip.num_frames:
+            raise RuntimeError(f"CRF search: the CRF {crf} trial has {len(ssim)} frames, expected {clip.num_frames}")
+        return float(np.percentile(ssim, 10))
+
+
+    def _choose(self, scores: Dict[float, float]) -> float:
+        passing = [crf for crf in self.crfs if scores[crf] >= self.target]
+        if not passing:
+            logger.warning(f"CRF search: no CRF reaches {self.target}, using {self.crfs[0]}")
+            return self.crfs[0]
+
+        best = max(passing)
+        higher = [crf for crf in self.crfs if crf > best]
+        if not higher:
+            return best
+
+        # interpolate between the last passing and the first failing CRF, by steps of 0.5
+        nxt = higher[0]
+        ratio = (scores[best] - self.target) / max(scores[best] - scores[nxt], 1e-9)
+        return best + int(ratio * (nxt - best) * 2) / 2
+
+
+def _ssim(a: NDArray[np.generic], b: NDArray[np.generic], peak: int) -> float:
+    """Luma SSIM over non-overlapping 8x8 blocks"""
+    h, w = (a.shape[0] // 8) * 8, (a.shape[1] // 8) * 8
+    x = a[:h, :w].astype(np.float32)
+    y = b[:h, :w].astype(np.float32)
+
+    def _block_mean(plane: NDArray[np.float32]) -> NDArray[np.float32]:
+        return plane.reshape(h // 8, 8, w // 8, 8).mean(axis=(1, 3))
+
+    c1, c2 = (0.01 * peak) ** 2, (0.03 * peak) ** 2
+    mu_x, mu_y = _block_mean(x), _block_mean(y)
+    var_x = _block_mean(x * x) - mu_x * mu_x
+    var_y = _block_mean(y * y) - mu_y * mu_y
+    cov = _block_mean(x * y) - mu_x * mu_y
+
+    ssim = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(ssim.mean())
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="Find the CRF of an episode from a few trial encodes")
+    parser.add_argument("script", help="episode script, e.g. 03.py")
+    parser.add_argument("--target", type=float, default=0.985, help="10th percentile luma SSIM to reach")
+    parser.add_argument("--crfs", type=float, nargs="+", default=[11, 12, 13, 14, 15, 16])
+    parser.add_argument("--samples", type=int, default=8)
+    parser.add_argument("--sample-length", type=int, default=48)
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__crf_search__")
+
+    CRFSearch(
+        episode["JPBD"], episode["filtered"], episode["EP_NUM"],
+        crfs=args.crfs, target=args.target, samples=args.samples, sample_length=args.sample_length
+    ).run()
@@ -0,0 +1,245 @@
+"""
+Runs of duplicate frames, detected once per episode and filtered only once
+
+Detect the duplicates of an episode (from the show folder), the filterchain only loads them::
+
+    python -m common.dedup 01.py
+"""
+__all__ = ["DuplicateIndex", "DuplicateReuse"]
+
+import atexit
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import List, Sequence
+
+import numpy as np
+import vapoursynth as vs
+from vardautomation import VPath, logger
+
+from .cache import cache_path, is_stale
+from .ranges import Range
+
+
+core = vs.core
+
+
+class DuplicateIndex:
+    """Runs of identical or near-identical consecutive frames, stored next to the index cache"""
+
+    MAGIC = b"DUPS"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHI")
+    SUFFIX = ".dups"
+
+    # frame kinds
+    UNIQUE = 0
+    EXACT = 1
+    NEAR = 2
+
+    path: VPath
+    """Path of the binary duplicate file"""
+    kinds: bytearray
+    """Kind of every frame: ``UNIQUE`` starts a group, ``EXACT`` and ``NEAR`` duplicate its first frame"""
+    leaders: List[int]
+    """First frame of the group of every frame"""
+
+    def __init__(self, path: str | os.PathLike[str], kinds: bytes) -> None:
+        self.path = VPath(path)
+        self.kinds = bytearray(kinds)
+        if self.kinds:
+            self.kinds[0] = self.UNIQUE
+        self._update_leaders()
+
+
+    @classmethod
+    def from_cache(
+        cls, path: str | os.PathLike[str], num_frames: int, sources: Sequence[str | os.PathLike[str]] = ()
+    ) -> "DuplicateIndex | None":
+        """
+        Load the duplicates detected by ``python -m common.dedup``, they are never detected while building the graph
+
+        :param path:        Cache path
+        :param num_frames:  Number of frames of the clip the duplicates are reused on
+        :param sources:     Files the clip is decoded from, the cache is stale if one is newer
+
+        :return:            DuplicateIndex object, None if there is no valid cache
+        """
+        path = VPath(path)
+
+        if any(is_stale(path, src) for src in sources if os.path.isfile(src)) or not path.exists():
+            logger.warning(f"No valid duplicate index {path.name}, every frame is filtered")
+            return None
+
+        index = cls.load(path)
+        if index.num_frames != num_frames:
+            logger.warning(f"Duplicate index {path.name} does not match the clip, every frame is filtered")
+            return None
+        return index
+
+
+    @classmethod
+    def load(cls, path: str | os.PathLike[str]) -> "DuplicateIndex":
+        with open(path, "rb") as f:
+            magic, version, num_frames = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError(f"{path} is not a duplicate index")
+            kinds = f.read(num_frames)
+
+        return cls(path, kinds)
+
+
+    def write(self) -> None:
+        with open(self.path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.num_frames))
+            f.write(self.kinds)
+
+
+    @staticmethod
+    def detect(
+        clip: vs.VideoNode, threshold: int = 0, width: int = 480, height: int = 270, threads: int | None = None
+    ) -> bytearray:
+        """
+        Compare every frame with the first frame of the current group.
+        Comparing with the group instead of the previous frame keeps slow fades and pans out of the groups.
+
+        :param clip:        Clip to analyse, before any temporal filtering
+        :param threshold:   0 to only group frames identical on every plane at full resolution,
+                            else highest 8-bit difference of a near duplicate on a downscaled luma
+        :param width:       Width of the downscaled luma
+        :param height:      Height of the downscaled luma
+        :param threads:     Number of frames requested concurrently (defaults to the core threads)
+
+        :return:            Kind of every frame
+        """
+        threads = threads or core.num_threads
+        analysed = core.resize.Bilinear(clip, width, height, format=vs.GRAY8) if threshold else clip
+
+        kinds = bytearray(clip.num_frames)
+        leader: List[np.ndarray] | None = None
+
+        start = time.monotonic()
+        for n, f in enumerate(analysed.frames(prefetch=threads, backlog=threads * 2, close=True)):
+            # copied, the frame is closed once the next one is requested
+            planes = [np.array(f[p], dtype=np.int32) for p in range(f.format.num_planes)]
+
+            if leader is not None:
+                diff = max(int(np.abs(plane - lead).max()) for plane, lead in zip(planes, leader))
+                if diff <= threshold:
+                    kinds[n] = DuplicateIndex.EXACT if diff == 0 else DuplicateIndex.NEAR
+                    continue
+            leader = planes
+        elapsed = time.monotonic() - start
+
+        duplicates = clip.num_frames - kinds.count(DuplicateIndex.UNIQUE)
+        logger.info(f"Detected {duplicates} duplicate frames at {clip.num_frames / max(elapsed, 1e-6):.1f} fps")
+        return kinds
+
+
+    @property
+    def num_frames(self) -> int:
+        return len(self.kinds)
+
+
+    def split(self, ranges: Sequence[Range]) -> None:
+        """Start a new group at the bounds of inclusive ranges filtered differently from their surroundings"""
+        for start, end in ranges:
+            for frame in (start, end + 1):
+                if 0 <= frame < self.num_frames:
+                    self.kinds[frame] = self.UNIQUE
+        self._update_leaders()
+
+
+    def _update_leaders(self) -> None:
+        self.leaders = []
+        for n, kind in enumerate(self.kinds):
+            self.leaders.append(n if kind == self.UNIQUE else self.leaders[-1])
+
+
+class DuplicateReuse:
+    """Serve the duplicate frames of a filtered clip with the frame filtered for the first frame of their group"""
+
+    FILTERED = 0xFF
+
+    index: DuplicateIndex
+    """Duplicates of the clip"""
+    clip: vs.VideoNode
+    """Filtered clip only rendering the first frame of every group"""
+    requested: bytearray
+    """0 if a frame hasn't been requested, ``FILTERED`` if it has been filtered, else the kind of its duplicate"""
+
+    def __init__(
+        self, clip: vs.VideoNode, index: DuplicateIndex, cache_frames: int = 32, report_at_exit: bool = True
+    ) -> None:
+        """
+        :param clip:            Filtered clip. The steps after the duplicate detection must give the same
+                                output for the same input (e.g. static grain) or be applied afterwards.
+        :param index:           Duplicates of the clip
+        :param cache_frames:    Number of filtered group frames kept in memory
+        :param report_at_exit:  Log :py:meth:`report` when the process exits
+        """
+        if index.num_frames != clip.num_frames:
+            raise ValueError(f"Duplicate index has {index.num_frames} frames, the clip {clip.num_frames}")
+
+        self.index = index
+        self.requested = bytearray(clip.num_frames)
+        self._filtered = clip
+        self._cache_frames = cache_frames
+        self._nodes: "OrderedDict[int, vs.VideoNode]" = OrderedDict()
+
+        self.clip = core.std.FrameEval(clip, self._select)
+
+        if report_at_exit:
+            atexit.register(lambda: any(self.requested) and logger.info(self.report()))
+
+
+    def report(self) -> str:
+        rendered = self.requested.count(self.FILTERED)
+        exact, near = self.requested.count(DuplicateIndex.EXACT), self.requested.count(DuplicateIndex.NEAR)
+        total = rendered + exact + near
+        return (
+            f"Duplicates: {exact + near}/{total} frames ({(exact + near) / max(total, 1):.1%}) served from cache, "
+            f"{exact} exact and {near} near duplicates, {rendered} filtered"
+        )
+
+
+    def _select(self, n: int) -> vs.VideoNode:
+        leader = self.index.leaders[n]
+        if leader == n:
+            self.requested[n] = self.FILTERED
+            return self._filtered
+
+        self.requested[n] = self.index.kinds[n]
+
+        # FrameEval asks the returned clip for frame n, so the group frame is looped
+        node = self._nodes.pop(leader, None)
+        if node is None:
+            node = self._filtered[leader] * self._filtered.num_frames
+        self._nodes[leader] = node
+        if len(self._nodes) > self._cache_frames:
+            self._nodes.popitem(last=False)
+
+        return node
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="Detect the duplicate frames of an episode")
+    parser.add_argument("script", help="episode script, e.g. 01.py")
+    parser.add_argument(
+        "--threshold", type=int, default=0,
+        help="also group near duplicates, up to this 8-bit difference of a 480x270 luma (default: exact only)"
+    )
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__dedup__")
+    flt = episode["flt"]
+
+    # detected after the BD fixes, which would otherwise be copied over the duplicates
+    fixed: vs.VideoNode = flt.filtersteps_clips["fixed"]
+    index = DuplicateIndex(cache_path(flt.JPBD, DuplicateIndex.SUFFIX), DuplicateIndex.detect(fixed, args.threshold))
+    index.write()
+    logger.info(f"Wrote {index.path.name}, run the script again to reuse the duplicates")
@@ -0,0 +1,177 @@
+"""
+OP/ED detection by matching perceptual hashes of the episode with the creditless clips
+
+Print the ``OP_RANGES`` and ``ED_RANGES`` of an episode (from the show folder)::
+
+    python -m common.detect 01.py
+"""
+__all__ = ["NCMatch", "hamming", "dhash", "cached_dhash", "find_nc"]
+
+import time
+
+import numpy as np
+import vapoursynth as vs
+from vardautomation import FileInfo, logger
+
+from .cache import cache_path, is_stale
+from .ranges import Range
+
+
+core = vs.core
+
+# set bits of every byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+
+
+def hamming(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Hamming distances of broadcast uint64 hashes"""
+    xor = np.bitwise_xor(a, b)
+    return _POPCOUNT[xor.view(np.uint8)].reshape(*xor.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+class NCMatch:
+    """Range of an episode matching the start of a creditless clip"""
+
+    start: int
+    """First frame of the range in the episode"""
+    end: int
+    """Last frame of the range in the episode, inclusive"""
+    nc_start: int
+    """Frame of the creditless clip matching ``start``, the filtering expects 0"""
+    confidence: float
+    """Fraction of the frames of the range whose hashes match, credits and scene edits lower it"""
+
+    def __init__(self, start: int, end: int, nc_start: int, confidence: float) -> None:
+        self.start = start
+        self.end = end
+        self.nc_start = nc_start
+        self.confidence = confidence
+
+
+    def __str__(self) -> str:
+        return f"({self.start}, {self.end}) from NC frame {self.nc_start}, confidence {self.confidence:.1%}"
+
+
+    @property
+    def ranges(self) -> Range:
+        """Inclusive range, like ``OP_RANGES``"""
+        return self.start, self.end
+
+
+def dhash(clip: vs.VideoNode, threads: int | None = None) -> np.ndarray:
+    """
+    64-bit difference hash of every frame: signs of the horizontal gradients of a 9x8 luma.
+    The frames are fetched concurrently and hashed in a single vectorized pass.
+
+    :param clip:        Clip to hash
+    :param threads:     Number of frames requested concurrently (defaults to the core threads)
+
+    :return:            uint64 hash of every frame
+    """
+    threads = threads or core.num_threads
+    small = core.resize.Bilinear(clip, 9, 8, format=vs.GRAY8)
+
+    lumas = np.empty((clip.num_frames, 8, 9), np.uint8)
+    start = time.monotonic()
+    for n, f in enumerate(small.frames(prefetch=threads, backlog=threads * 2, close=True)):
+        lumas[n] = np.asarray(f[0])
+    elapsed = time.monotonic() - start
+    logger.info(f"Hashed {clip.num_frames} frames at {clip.num_frames / max(elapsed, 1e-6):.1f} fps")
+
+    bits = lumas[:, :, 1:] > lumas[:, :, :-1]
+    return np.packbits(bits.reshape(clip.num_frames, 64), axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def cached_dhash(file: FileInfo, threads: int | None = None) -> np.ndarray:
+    """
+    Hashes of the cut clip of a FileInfo, stored next to its source.
+    The cache is used while it is newer than the source and has the length of the cut clip.
+    """
+    path = cache_path(file, ".dhash")
+    if not is_stale(path, file.path):
+        hashes = np.fromfile(path, np.uint64)
+        if len(hashes) == file.clip_cut.num_frames:
+            return hashes
+
+    hashes = dhash(file.clip_cut, threads)
+    hashes.tofile(path)
+    return hashes
+
+
+def find_nc(
+    episode: np.ndarray, nc: np.ndarray, threshold: int = 10, stride: int = 4, max_gap: int = 48,
+    min_confidence: float = 0.5
+) -> NCMatch | None:
+    """
+    Find the range of an episode matching a creditless clip.
+    Every episode frame votes for the offsets of the creditless frames it is close to,
+    then the best offset is followed frame by frame to get the bounds of the range.
+
+    :param episode:         Hashes of the episode
+    :param nc:              Hashes of the creditless clip
+    :param threshold:       Highest Hamming distance of matching frames
+    :param stride:          Step between the creditless frames voting, they are all checked afterwards
+    :param max_gap:         Longest run of non-matching frames inside the range (e.g. a credit on a static shot)
+    :param min_confidence:  Lowest confidence of a match
+
+    :return:                NCMatch object, None if the clip isn't in the episode
+    """
+    # flat frames (black, white) have no gradient and match each other everywhere
+    popcount = hamming(nc, np.uint64(0))
+    voters = np.flatnonzero((popcount >= 4) & (popcount <= 60))[::stride]
+    if not len(voters):
+        return None
+
+    votes = np.zeros(len(episode) + len(nc), np.int64)
+    for chunk in range(0, len(episode), 4096):
+        dist = hamming(episode[chunk:chunk + 4096, None], nc[None, voters])
+        frames, indices = np.nonzero(dist <= threshold)
+        # offset of the episode frame to the creditless frame, shifted to be positive
+        votes += np.bincount(chunk + frames - voters[indices] + len(nc), minlength=len(votes))
+    offset = int(np.argmax(votes)) - len(nc)
+
+    nc_frames = np.arange(max(-offset, 0), min(len(nc), len(episode) - offset))
+    if not len(nc_frames):
+        return None
+    matched = nc_frames[hamming(episode[nc_frames + offset], nc[nc_frames]) <= threshold]
+    if not len(matched):
+        return None
+
+    # longest run of matches with gaps shorter than max_gap
+    breaks = np.flatnonzero(np.diff(matched) > max_gap + 1)
+    bounds = np.split(matched, breaks + 1)
+    run = max(bounds, key=lambda r: r[-1] - r[0])
+
+    first, last = int(run[0]), int(run[-1])
+    confidence = len(run) / (last - first + 1)
+    if confidence < min_confidence or last - first < max_gap:
+        return None
+    return NCMatch(first + offset, last + offset, first, confidence)
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    from .utils import NCOP, NCED
+
+    parser = argparse.ArgumentParser(description="Detect the OP and ED ranges of an episode")
+    parser.add_argument("script", help="episode script, e.g. 01.py")
+    parser.add_argument("--threshold", type=int, default=10, help="highest Hamming distance of matching frames")
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__detect__")
+    jpbd: FileInfo = episode["JPBD"]
+
+    start = time.monotonic()
+    hashes = cached_dhash(jpbd)
+    for name, nc in [("OP_RANGES", NCOP), ("ED_RANGES", NCED)]:
+        match = find_nc(hashes, cached_dhash(nc), args.threshold)
+        if match is None:
+            logger.info(f"{name}: not found")
+            continue
+        logger.info(f"{name}: {match}")
+        if match.nc_start:
+            logger.warning(f"{name}: the episode starts at NC frame {match.nc_start}, the filtering expects 0")
+        logger.info(f"{name} = {match.ranges}")
+    logger.info(f"Detected in {time.monotonic() - start:.2f}s")
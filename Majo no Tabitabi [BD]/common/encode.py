@@ -2,10 +2,16 @@ from __future__ import annotations
 
 __all__ = ["Encoder"]
 
+import copy
+import hashlib
+import json
 import os
+import random
+import shutil
+import subprocess
 from fractions import Fraction
 from shutil import rmtree
-from typing import Any, Dict, List, Literal, Sequence, Tuple, Type, Union
+from typing import Any, Callable, Dict, List, Literal, Mapping, Sequence, Tuple, Type, Union
 
 import vapoursynth as vs
 from lvsfunc import source, find_scene_changes
@@ -20,10 +26,19 @@ from vardautomation import (
     Chapter, MatroskaXMLChapters, OGMChapters,
     MatroskaFile, VideoTrack, AudioTrack, ChaptersTrack, Track,
     Lang, UNDEFINED,
-    RunnerConfig, SelfRunner, logger,
+    RunnerConfig, SelfRunner, Qpfile, BasicTool, BinaryPath, logger, progress_update_func,
     make_comps,
 )
 
+from .audio import FusedAudioEncoder
+from .monitor import SizeMonitor
+from .ranges import Range, TrimMap
+from .scenes import SceneIndex
+from .splice import FrameHashes, HevcStream
+from .tee import FrameTee, TeeSink
+from .y4m import Y4MPipeOutput, write_y4m
+from .zones import write_zonefile
+
 
 # Types
 VIDEO_ENCODER = Union[X264, X265]
@@ -48,6 +63,9 @@ class Defaults:
     OPUS: Dict[str, Any] = dict(bitrate=2 * 96, mode=BitrateMode.VBR, use_ffmpeg=True)
     FLAC: Dict[str, Any] = dict(level=FlacCompressionLevel.VARDOU, use_ffmpeg=True)
 
+    # zonefile options for passthrough ranges
+    ZONE: Dict[str, Any] = {"rd": 2, "subme": 2, "ref": 3, "merange": 32}
+
 
 class Encoder:
     """Encoder class"""
@@ -76,12 +94,27 @@ class Encoder:
     """Audio extractor"""
     a_cutter: List[AUDIO_CUTTER] | None
     """Audio cutter"""
-    a_encoder: List[AUDIO_ENCODER] | None
+    a_encoder: List[AUDIO_ENCODER | FusedAudioEncoder] | None
     """Audio encoder"""
 
     mux: MatroskaFile | None
     """Configured muxer"""
 
+    keyframes: List[int] | None
+    """Keyframes forced with a qpfile"""
+    zonefile: Dict[Tuple[int, int], Dict[str, Any]] | None
+    """Zones written to the x265 zonefile"""
+    zonefile_path: VPath | None
+    """Path of the x265 zonefile"""
+    monitor: SizeMonitor | None
+    """Size monitor of the video encode"""
+    tee_encoders: List[Tuple[VIDEO_ENCODER, VPath]]
+    """Extra video encoders fed by the tee mode and their outputs"""
+    hashes: FrameHashes | None
+    """Hash of every frame sent to the video encoder"""
+    v_encoder_args: Tuple[Callable[..., VIDEO_ENCODER], Any, Dict[str, Any], List[str]] | None
+    """Class, settings, arguments and added params of the video encoder, to build fresh copies of it"""
+
     runner: SelfRunner
     """Vardautomation runner"""
 
@@ -112,6 +145,13 @@ class Encoder:
         self.a_encoder = None
         self.a_tracks = []
         self.mux = None
+        self.keyframes = None
+        self.zonefile = None
+        self.zonefile_path = None
+        self.monitor = None
+        self.tee_encoders = []
+        self.hashes = None
+        self.v_encoder_args = None
 
 
     def video_encoder(
@@ -120,16 +160,114 @@ class Encoder:
         settings: str | List[str] | Dict[str, Any],
         zones: Dict[Tuple[int, int], Dict[str, Any]] | None = None,
         resumable: bool = False,
+        qpfile: bool | str | VPath = False,
+        zonefile: Dict[Tuple[int, int], Dict[str, Any]] | None = None,
+        zonefile_source_frames: bool = False,
+        size_budget: float | None = None,
+        scene_classes: Mapping[str, Sequence[Range]] | None = None,
+        fast_output: bool = True,
+        frame_hashes: bool = False,
         **encoder_params: Any,
     ) -> None:
+        """
+        :param qpfile:                  Force the keyframes and disable the encoder scenecut.
+                                        True uses the scene index of the source, a path uses an existing keyframes file.
+        :param zonefile:                x265 only. Inclusive ranges and the reconfigurable options to use on them
+                                        (e.g. ``Defaults.ZONE``).
+                                        Unlike ``zones``, any reconfigurable option can be used.
+        :param zonefile_source_frames:  The zonefile ranges are source frames and are shifted with ``trims_or_dfs``
+        :param size_budget:             x265 only. Size budget of the video in MiB, the encode is stopped with a report
+                                        of the most expensive scenes when its projected size exceeds it.
+        :param scene_classes:           Inclusive ranges of scene classes (e.g. credits) the size monitor
+                                        extrapolates and reports separately, besides the zonefile ranges
+        :param fast_output:             Feed the encoder with vectored writes of the frame planes
+                                        instead of ``clip.output``
+        :param frame_hashes:            Store a hash of every encoded frame next to the premux, so that ``splice``
+                                        can find the frames changed since. Needs ``fast_output``.
+        """
         logger.info(
             f"Video Encoder: {self._print_name(encoder)}" +
-            f"\nZones: {str(zones) if zones is not None else 'None'}"
+            f"\nZones: {str(zones) if zones is not None else 'None'}" +
+            f"\nQpfile: {'scene index' if qpfile is True else self._print_name(qpfile or None)}" +
+            f"\nZonefile: {str(zonefile) if zonefile is not None else 'None'}"
         )
 
+        if fast_output:
+            encoder = type(encoder.__name__, (Y4MPipeOutput, encoder), {})  # type: ignore
         self.v_encoder = encoder(settings, zones=zones, **encoder_params)
         self.v_encoder.resumable = resumable
+        # params added below, also given to the fresh copies of the encoder
+        added_params = len(self.v_encoder.params)
+
+        if qpfile:
+            if qpfile is True:
+                self.keyframes = SceneIndex.from_file(self.file).cut(TrimMap.from_file(self.file))
+            else:
+                self.keyframes = self._read_keyframes(qpfile)
+
+            no_scenecut = ["--no-scenecut"] if isinstance(self.v_encoder, X265) else ["--scenecut", "0"]
+            self.v_encoder.params += no_scenecut
+
+        if zonefile:
+            if not isinstance(self.v_encoder, X265):
+                raise ValueError("zonefile is only supported by x265")
+
+            if zonefile_source_frames:
+                trims = TrimMap.from_file(self.file)
+                zonefile = {
+                    cut: opts for r, opts in zonefile.items() for cut in trims.src_ranges_to_cut([r])
+                }
+
+            # resumed encodes rename name_clip_output to the current part, keep the path given to x265
+            self.zonefile = zonefile
+            self.zonefile_path = self.file.name_clip_output.append_stem("_zones").with_suffix(".txt")
+            self.v_encoder.params += ["--zonefile", self.zonefile_path.to_str()]
+
+        if size_budget:
+            if not isinstance(self.v_encoder, X265):
+                raise ValueError("size_budget is only supported by x265")
+
+            csv = self.file.name_clip_output.append_stem("_stats").with_suffix(".csv")
+            scenes = SceneIndex.from_file(self.file).scenes(TrimMap.from_file(self.file))
+            classes: Dict[str, Sequence[Range]] = {"zones": list(self.zonefile)} if self.zonefile else {}
+            classes.update(scene_classes or {})
+
+            self.monitor = SizeMonitor(
+                csv, size_budget, self.clip.num_frames, self.clip.fps, scenes, {k: v for k, v in classes.items() if v}
+            )
+            self.v_encoder.params += ["--csv", csv.to_str(), "--csv-log-level", "1"]
+            self.v_encoder.progress_update = self.monitor
+
+        if frame_hashes:
+            if not isinstance(self.v_encoder, Y4MPipeOutput):
+                raise ValueError("frame_hashes needs fast_output")
+
+            self.hashes = FrameHashes.load(self._hashes_path, self.clip.num_frames)
+            self.v_encoder.on_frame = self.hashes.update
+
+        self.v_encoder_args = (
+            encoder, settings, dict(zones=zones, **encoder_params), self.v_encoder.params[added_params:]
+        )
+
+
+    def tee_encoder(
+        self,
+        encoder: Type[VIDEO_ENCODER],
+        settings: str | List[str] | Dict[str, Any],
+        suffix: str,
+        **encoder_params: Any
+    ) -> None:
+        """
+        Extra video output encoded from the same frames as the main encoder, when running in tee mode.
+
+        :param suffix:      Appended to the stem of ``name_clip_output`` (e.g. ``_crf14``)
+        """
+        output = self.file.name_clip_output.append_stem(suffix)
+        if encoder == X264:
+            output = output.with_suffix(".264")
 
+        logger.info(f"Tee encoder: {self._print_name(encoder)} -> {output.to_str()}")
+        self.tee_encoders.append((encoder(settings, **encoder_params), output))
 
 
     def video_lossless_encoder(
@@ -150,7 +288,12 @@ class Encoder:
         extracter_settings: Dict[str, Any] = {},
         cutter_settings: Dict[str, Any] = {},
         encoder_settings: Dict[AUDIO_ENCODER_NAMES, Dict[str, Any]] = {},
+        fused: bool = False,
     ) -> None:
+        """
+        :param fused:       Extract, cut and encode every track in a single pipeline without intermediate files.
+                            The extracter and cutter are not used.
+        """
         if isinstance(tracks, int):
             tracks = [tracks]
         self.a_tracks = tracks
@@ -162,11 +305,17 @@ class Encoder:
             else:
                 assert len(encoder) == track_number
 
+        if fused:
+            if encoder is None or PassthroughAudioEncoder in encoder:
+                raise ValueError("fused audio needs a real encoder")
+            extracter = cutter = None
+
         logger.info(
             f"Audio extractor: {self._print_name(extracter)}" +
             f"\nAudio cutter: {self._print_name(cutter)}" +
             f"\nAudio encoder: {self._print_sequence_name(encoder)}" +
-            f"\nTrack(s): {self._print_sequence_name(tracks)}"
+            f"\nTrack(s): {self._print_sequence_name(tracks)}" +
+            f"\nFused: {fused}"
         )
 
         output_tracks = range(1, track_number + 1)
@@ -195,7 +344,11 @@ class Encoder:
                 else:
                     raise ValueError("Invalid audio encoder")
 
-                self.a_encoder.append(encoder(self.file, track=out_idx, **enc_args))
+                a_encoder = encoder(self.file, track=out_idx, **enc_args)
+                if fused:
+                    self.a_encoder.append(FusedAudioEncoder(a_encoder, self.a_tracks[out_idx - 1]))
+                else:
+                    self.a_encoder.append(a_encoder)
 
 
     def muxer(
@@ -283,37 +436,327 @@ class Encoder:
     def run(
         self,
         order: RunnerConfig.Order = RunnerConfig.Order.VIDEO,
+        tee: bool = False,
+        test: Sequence[Range] | int | None = None,
     ) -> None:
+        """
+        :param tee:     Render the clip once for the video encoder, the lossless encoder and every
+                        ``tee_encoder`` at the same time. The outputs already encoded are skipped
+                        and the encodes can't be resumed.
+        :param test:    Only encode these inclusive ranges, or this number of random scenes, to a small test file
+                        in ``test/`` with the matching audio and chapters. The regular outputs are left untouched.
+        """
+        if test is not None:
+            self._run_test(test)
+            return
+
+        if tee:
+            self._run_tee()
+
         config = RunnerConfig(
             v_encoder=self.v_encoder,  # type: ignore
             v_lossless_encoder=self.v_lossless_encoder,
             a_extracters=self.a_extracter,
             a_cutters=self.a_cutter,
-            a_encoders=self.a_encoder,
+            a_encoders=self.a_encoder,  # type: ignore
             mkv=self.mux,
             order=order,
         )
 
         self.runner = SelfRunner(self.clip, self.file, config)
+        if self._needs_qpfile:
+            self.runner.inject_qpfile_params(self.clip, self._write_qpfile)
         self.runner.run()
 
+        if self.hashes is not None:
+            self.hashes.write()
+
+
+    def _run_tee(self) -> None:
+        sinks: List[TeeSink] = []
+        progress_update = None
+
+        # the sinks get copies of the encoders, whose params are left unformatted for the runner
+        if self.v_encoder is not None and not self.file.name_clip_output.exists():
+            qpfile_params: List[str] = []
+            if self._needs_qpfile:
+                qpfile = self._write_qpfile(
+                    self.clip, self.file.name_clip_output.append_stem("_qpfile").with_suffix(".log")
+                )
+                qpfile_params = ["--qpfile", qpfile.path.to_str()]
+            sinks.append(TeeSink.from_encoder(
+                self._new_video_encoder(), self.file, self.clip, self.file.name_clip_output, qpfile_params
+            ))
+            progress_update = self.v_encoder.progress_update
+
+        if self.v_lossless_encoder is not None:
+            output = self.file.name_clip_output.append_stem(self.v_lossless_encoder.suffix_name)
+            if not output.exists():
+                sinks.append(TeeSink.from_encoder(self.v_lossless_encoder, self.file, self.clip, output))
+
+        for encoder, output in self.tee_encoders:
+            if not output.exists():
+                tee_file = copy.copy(self.file)
+                tee_file.name_clip_output = output
+                sinks.append(TeeSink.from_encoder(encoder, tee_file, self.clip, output))
+
+        if sinks:
+            prefetch = self.v_encoder.prefetch if self.v_encoder is not None else None
+            FrameTee(self.clip, sinks, prefetch=prefetch, progress_update=progress_update).run()
+
+
+    def _run_test(self, test: Sequence[Range] | int) -> None:
+        assert self.v_encoder
+        num_frames = self.clip.num_frames
+
+        if isinstance(test, int):
+            # same scenes on every run, so that settings can be compared
+            scenes = SceneIndex.from_file(self.file).scenes(TrimMap.from_file(self.file))
+            parts = sorted(random.Random(str(self.ep_num)).sample(scenes, min(test, len(scenes))))
+        else:
+            parts = TrimMap._merge(list(test))
+            if parts and (parts[0][0] < 0 or parts[-1][1] >= num_frames):
+                raise ValueError(f"Test ranges {parts} are out of the clip ({num_frames} frames)")
+        if not parts:
+            raise ValueError("No test range")
+
+        # the lossless encode is a checkpoint of the filtering, use it when it is complete
+        clip = self.clip
+        lossless = self.file.name_clip_output.append_stem("_lossless.mkv")
+        if lossless.exists():
+            checkpoint = source(lossless.resolve().to_str(), force_lsmas=True)
+            if checkpoint.num_frames == num_frames:
+                logger.info(f"Test: reading the frames from {lossless.name}")
+                clip = checkpoint
+        clip = vs.core.std.Splice([clip[s:e + 1] for s, e in parts])
+
+        workdir = VPath("test")
+        workdir.mkdir(exist_ok=True)
+        # outputs are cached by ranges and by encoder settings
+        stem = f"{self.ep_num}_{self._digest(parts)}"
+        video = workdir / f"{stem}_{self._digest(self.v_encoder.params)}{self.file.name_clip_output.suffix}"
+
+        logger.info(f"Test: {clip.num_frames} frames from {len(parts)} range(s): {parts}")
+        if video.exists():
+            logger.info(f"Test: {video.name} already encoded")
+        else:
+            self._encode_part(clip, video, parts)
+
+        tracks: List[Track] = [VideoTrack(video, f"Test {self.ep_num} {parts}")]
+        tracks += self._test_audio(workdir / stem, parts)
+        if self.chapters:
+            tracks.append(ChaptersTrack(self._test_chapters(workdir / f"{stem}_chapters.xml", parts)))
+
+        output = video.with_suffix(".mkv")
+        MatroskaFile(output, tracks).mux()
+        logger.info(f"Test: muxed {output.to_str()}")
+
+
+    def _test_audio(self, stem: VPath, parts: List[Range]) -> List[Track]:
+        """Encode the slices of the audio tracks matching ``parts``"""
+        if not self.a_encoder:
+            return []
+
+        # inclusive cut ranges to source segments [start, end)
+        segments = [(s, e + 1) for s, e in TrimMap.from_file(self.file).cut_ranges_to_src(parts)]
+
+        file = copy.copy(self.file)
+        assert file.a_src_cut and file.a_enc_cut
+        file.a_src_cut = VPath(f"{stem.to_str()}_track_{{track_number}}{file.a_src_cut.suffix}")
+        file.a_enc_cut = VPath(f"{stem.to_str()}_enc_track_{{track_number}}{file.a_enc_cut.suffix}")
+
+        tracks: List[Track] = []
+        for a_encoder, track_in in zip(self.a_encoder, self.a_tracks):
+            encoder = a_encoder.encoder if isinstance(a_encoder, FusedAudioEncoder) else a_encoder
+            if isinstance(encoder, PassthroughAudioEncoder):
+                logger.warning(f"Test: audio track {track_in} is passed through, it is not included")
+                continue
+
+            output = file.a_enc_cut.set_track(encoder.track)
+            if not output.exists():
+                encoder = copy.copy(encoder)
+                encoder.params = list(encoder.params)
+                encoder.file = file
+                FusedAudioEncoder(encoder, track_in, segments).run()
+            tracks.append(AudioTrack(output))
+
+        return tracks
 
-    def generate_keyframes(self, mode: SceneChangeMode = SceneChangeMode.WWXD, delete_index: bool = True) -> None:
-        if self.file.name_file_final.exists():
+
+    def _test_chapters(self, path: VPath, parts: List[Range]) -> VPath:
+        """One chapter per test range, named after the episode chapter it starts in"""
+        assert self.chapters
+        names = self.chapters_names or [None] * len(self.chapters)
+        offset = self.file.trims_or_dfs[0] if isinstance(self.file.trims_or_dfs[0], int) else 0  # type: ignore
+        starts = [(c if isinstance(c, int) else c.start_frame) - offset for c in self.chapters]
+
+        chapters: List[Chapter] = []
+        position = 0
+        for start, end in parts:
+            current = [name for frame, name in zip(starts, names) if frame <= start]
+            label = f"{current[-1] or 'Chapter'} " if current else ""
+            chapters.append(Chapter(f"{label}{start}-{end}", position, None))
+            position += end - start + 1
+
+        chapter_file = MatroskaXMLChapters(path)
+        chapter_file.create(chapters, Fraction(self.clip.fps_num, self.clip.fps_den))
+        return path
+
+
+    def splice(self, ranges: Sequence[Range] | None = None, remux: bool = True) -> None:
+        """
+        Re-encode only the closed GOPs covering some frames, splice them in the existing video and remux the premux.
+        Takes the video from the premux if ``name_clip_output`` has been cleaned up.
+
+        :param ranges:      Inclusive ranges of the changed frames. If None, the clip is rendered and
+                            compared with the stored frame hashes (``frame_hashes``).
+        :param remux:       Replace the video of the existing premux, keeping its other tracks
+        """
+        assert self.v_encoder
+        if ranges is None and not self._hashes_path.exists():
+            raise ValueError("Splice: no stored frame hashes, encode with frame_hashes=True or give the ranges")
+
+        final = self.file.name_file_final
+        workdir = final.parent / f"{self.ep_num}_splice"
+        workdir.mkdir(parents=True, exist_ok=True)
+
+        video = self.file.name_clip_output
+        if not video.exists():
+            video = workdir / "old.hevc"
+            BasicTool(BinaryPath.mkvextract, [final.to_str(), "tracks", f"0:{video.to_str()}"]).run()
+
+        hashes = self.hashes or FrameHashes.load(self._hashes_path, self.clip.num_frames)
+        if ranges is None:
+            ranges = hashes.changed(self.clip, self.v_encoder.prefetch or None)
+        if not ranges:
+            logger.info("Splice: no changed frame")
+            rmtree(workdir)
+            return
+
+        stream = HevcStream(video)
+        if stream.num_frames != self.clip.num_frames:
+            raise ValueError(f"Splice: the video has {stream.num_frames} frames, the clip {self.clip.num_frames}")
+
+        segments = stream.expand(ranges)
+        logger.info(
+            f"Splice: re-encoding {sum(e - s + 1 for s, e in segments)}/{self.clip.num_frames} frames "
+            f"in {len(segments)} segment(s): {segments}"
+        )
+        parts: Dict[int, VPath] = {}
+        for start, end in segments:
+            parts[start] = workdir / f"{start}-{end}.hevc"
+            hashes.offset = start
+            self._encode_part(self.clip[start:end + 1], parts[start], [(start, end)], hashes.update)
+
+        spliced = workdir / "spliced.hevc"
+        with open(video, "rb") as src, open(spliced, "wb") as out:
+            for gop in stream.gops:
+                if gop.start in parts:
+                    with open(parts[gop.start], "rb") as part:
+                        shutil.copyfileobj(part, out)
+                elif not any(s <= gop.start <= e for s, e in segments):
+                    src.seek(gop.byte_start)
+                    out.write(src.read(gop.byte_end - gop.byte_start))
+
+        if (spliced_frames := HevcStream(spliced).num_frames) != self.clip.num_frames:
+            raise ValueError(f"Splice: the spliced video has {spliced_frames} frames, {workdir} is kept")
+
+        if self.file.name_clip_output.exists():
+            os.replace(spliced, self.file.name_clip_output)
+            spliced = self.file.name_clip_output
+
+        if remux and final.exists():
+            info = json.loads(subprocess.run(
+                [BinaryPath.mkvmerge.to_str(), "-J", final.to_str()], capture_output=True, check=True, text=True
+            ).stdout)
+            title = info["tracks"][0]["properties"].get("track_name", "")
+
+            remuxed = workdir / final.name
+            BasicTool(BinaryPath.mkvmerge, [
+                "-o", remuxed.to_str(), "--track-name", f"0:{title}", spliced.to_str(), "--no-video", final.to_str()
+            ]).run()
+            os.replace(remuxed, final)
+
+        hashes.write()
+        rmtree(workdir)
+
+
+    def _encode_part(
+        self,
+        clip: vs.VideoNode,
+        output: VPath,
+        parts: Sequence[Range],
+        on_frame: Callable[[int, vs.VideoFrame], Any] | None = None,
+    ) -> None:
+        """
+        Encode some ranges of the clip with a fresh copy of the video encoder, outside of the runner.
+        The keyframes and zones are moved to the frame numbers of ``clip``.
+
+        :param clip:        The ``parts`` of the clip spliced together
+        :param output:      Video output, its qpfile and zonefile are written next to it
+        :param parts:       Inclusive ranges of the clip making ``clip``
+        :param on_frame:    See :py:func:`write_y4m`
+        """
+        assert self.v_encoder
+
+        # the size monitor, the qpfile and the zonefile belong to the full encode
+        encoder = self._new_video_encoder("--csv", "--csv-log-level", "--zonefile", "--qpfile")
+        encoder.file = copy.copy(self.file)
+        encoder.file.name_clip_output = output
+        encoder.clip = clip
+        encoder._update_settings()
+
+        if self.keyframes is not None:
+            starts = [sum(e - s + 1 for s, e in parts[:i]) for i in range(len(parts))]
+            keyframes = sorted({*starts, *(f for f, _ in self._map_ranges([(k, k) for k in self.keyframes], parts))})
+
+            qpfile = output.append_stem("_qpfile").with_suffix(".log")
+            with open(qpfile, "w") as f:
+                f.writelines([f"{frame} K\n" for frame in keyframes])
+            encoder.params += ["--qpfile", qpfile.to_str()]
+
+        if self.zonefile is not None:
+            zones = {m: opts for r, opts in self.zonefile.items() for m in self._map_ranges([r], parts)}
+            zonefile = output.append_stem("_zones").with_suffix(".txt")
+            write_zonefile(zonefile, zones, encoder.params, clip.num_frames)
+            encoder.params += ["--zonefile", zonefile.to_str()]
+
+        logger.info(f"{encoder.__class__.__name__} command: " + " ".join(encoder.params))
+        with subprocess.Popen(encoder.params, stdin=subprocess.PIPE) as process:
+            assert process.stdin
+            write_y4m(
+                clip, process.stdin, progress_update_func,
+                encoder.prefetch, encoder.backlog, on_frame
+            )
+
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, encoder.params)
+
+
+    def generate_keyframes(
+        self, mode: SceneChangeMode = SceneChangeMode.WWXD, delete_index: bool = True, from_index: bool = False
+    ) -> None:
+        if self.keyframes is not None:
+            logger.info("Writing keyframes forced by the qpfile")
+            kf = self.keyframes
+        elif from_index:
+            logger.info("Generating keyframes from the scene index")
+            kf = SceneIndex.from_file(self.file).cut(TrimMap.from_file(self.file))
+        elif self.file.name_file_final.exists():
             logger.info("Generating keyframes from encoded file")
             clip = source(self.file.name_file_final.to_str(), force_lsmas=True)
+            kf = find_scene_changes(clip, mode)
         else:
             logger.info("Generating keyframes from filtered clip")
-            clip = self.clip
-
-        kf = find_scene_changes(clip, mode)
+            kf = find_scene_changes(self.clip, mode)
 
         with open(f"{self.file.name_file_final.to_str()}_keyframes.txt", "w") as f:
             f.write("# WWXD log file, using qpfile format\n\n")
             f.writelines([f"{frame} I -1\n" for frame in kf[1:]])
 
-        if delete_index:
-            os.remove(f"{self.file.name_file_final.to_str()}.lwi")
+        lwi = f"{self.file.name_file_final.to_str()}.lwi"
+        if delete_index and os.path.isfile(lwi):
+            os.remove(lwi)
 
 
     def clean_up(
@@ -344,10 +787,17 @@ class Encoder:
         self.runner.work_files.clear()
 
 
-    def make_comp(self, **comp_args: Any) -> None:
+    def make_comp(self, scene_frames: int | None = None, **comp_args: Any) -> None:
+        """
+        :param scene_frames:    Pick this number of frames from the scene index instead of random frames
+        :param comp_args:       Additional parameters to be passed to make_comps
+        """
         logger.info("Making comp file")
 
         args: Dict[str, Any] = dict(num=100, force_bt709=True)
+        if scene_frames:
+            scenes = SceneIndex.from_file(self.file)
+            args |= dict(num=0, frames=scenes.pick_frames(scene_frames, TrimMap.from_file(self.file)))
         args |= comp_args
 
         if os.path.isdir("comps"):
@@ -371,6 +821,94 @@ class Encoder:
         )
 
 
+    @property
+    def _needs_qpfile(self) -> bool:
+        return any(x is not None for x in (self.keyframes, self.zonefile, self.monitor, self.hashes))
+
+
+    @property
+    def _hashes_path(self) -> VPath:
+        return VPath(f"{self.file.name_file_final.to_str()}{FrameHashes.SUFFIX}")
+
+
+    def _write_qpfile(self, clip: vs.VideoNode, path: str | os.PathLike[str]) -> Qpfile:
+        # resumed encodes only get the remaining part of the clip,
+        # which is also where the zonefile has to be written and the monitor and hashes start
+        offset = self.clip.num_frames - clip.num_frames
+
+        if self.monitor is not None:
+            self.monitor.reset(offset)
+        if self.hashes is not None:
+            self.hashes.offset = offset
+
+        frames = [f - offset for f in self.keyframes or [] if f >= offset]
+
+        with open(path, "w") as f:
+            f.writelines([f"{frame} K\n" for frame in frames])
+
+        if self.zonefile is not None and self.zonefile_path is not None:
+            assert isinstance(self.v_encoder, X265)
+            write_zonefile(
+                self.zonefile_path, self.zonefile, self.v_encoder.params, clip.num_frames, offset
+            )
+
+        return Qpfile(VPath(path), frames)
+
+
+    @staticmethod
+    def _map_ranges(ranges: Sequence[Range], parts: Sequence[Range]) -> List[Range]:
+        """Intersect inclusive ranges with ``parts`` and number them in the clip made of the spliced parts"""
+        out: List[Range] = []
+        offset = 0
+        for start, end in parts:
+            for lo, hi in ranges:
+                lo, hi = max(lo, start), min(hi, end)
+                if lo <= hi:
+                    out.append((offset + lo - start, offset + hi - start))
+            offset += end - start + 1
+        return out
+
+
+    def _new_video_encoder(self, *strip: str) -> VIDEO_ENCODER:
+        """
+        Video encoder built like ``v_encoder`` from its settings, with params that haven't been formatted yet.
+        ``v_encoder`` itself is formatted in place by the runner and can't be reused for another output.
+
+        :param strip:       Added options removed with their value
+        """
+        assert self.v_encoder_args
+        encoder, settings, encoder_params, added_params = self.v_encoder_args
+        new = encoder(copy.deepcopy(settings), **encoder_params)
+        new.params += self._strip_params(added_params, *strip)
+        return new
+
+
+    @staticmethod
+    def _strip_params(params: Sequence[str], *options: str) -> List[str]:
+        """Remove options and their value from a command line"""
+        out: List[str] = []
+        skip = False
+        for param in params:
+            if skip:
+                skip = False
+            elif param in options:
+                skip = True
+            else:
+                out.append(param)
+        return out
+
+
+    @staticmethod
+    def _digest(obj: Any) -> str:
+        return hashlib.blake2b(repr(obj).encode(), digest_size=4).hexdigest()
+
+
+    @staticmethod
+    def _read_keyframes(path: str | VPath) -> List[int]:
+        with open(path, "r") as f:
+            return sorted({0, *[int(line.split()[0]) for line in f if line[:1].isdigit()]})
+
+
     @staticmethod
     def _print_name(object: Any) -> str:
         if object is None:
@@ -1,6 +1,6 @@
 __all__ = ["ElainaFiltering"]
 
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 import havsfunc as haf
 import lvsfunc as lvf
@@ -15,6 +15,12 @@ from vsmask.edge import FDoG
 from vardautomation import FileInfo
 from vsutil import get_y, depth
 
+from .cache import cache_path
+from .dedup import DuplicateIndex, DuplicateReuse
+from .masks import downscaled_credit_mask, masked_merge
+from .nc_cache import NCCache, NCReuse
+from .raw_cache import cached_clip_cut
+from .sparse import SparseEval
 from .utils import NCOP, NCED
 
 
@@ -25,8 +31,24 @@ class ElainaFiltering:
     OP_RANGES: Optional[Tuple[int, int]] = None
     ED_RANGES: Optional[Tuple[int, int]] = None
 
-    NCOP = NCOP.clip_cut
-    NCED = NCED.clip_cut
+    NCOP_FILE = NCOP
+    NCED_FILE = NCED
+    # decoded once for the season when the raw caches are built
+    NCOP = cached_clip_cut(NCOP, "NCOP")
+    NCED = cached_clip_cut(NCED, "NCED")
+
+    DEDUP: bool = False
+    """Filter only the first frame of every group of duplicates, detected with ``python -m common.dedup``"""
+    NC_SOURCES: List[str] = [__file__]
+    """Files the cached filtered creditless clips depend on"""
+    CREDIT_MASK_SCALE: Optional[int] = None
+    """Compute the credit masks at 1/2 or 1/4 of the resolution, None for the full resolution vardefunc masks"""
+    CREDIT_MASK_THR: int = 130
+    """Threshold of the credit masks, check it with ``python -m common.masks`` when changing the scale"""
+    SPARSE_AA: bool = False
+    """Run the AA only on the tiles covered by the line mask, check the gain with ``python -m common.sparse``"""
+    SPARSE_AA_GRID: Tuple[int, int] = (4, 4)
+    """Columns and rows of the AA tiles"""
 
     def __init__(
         self,
@@ -41,6 +63,14 @@ class ElainaFiltering:
         # BD fixes (taken from LightArrowsEXE)
         fixed = self.prefilter(src)
 
+        duplicates = None
+        if self.DEDUP:
+            duplicates = DuplicateIndex.from_cache(
+                cache_path(self.JPBD, DuplicateIndex.SUFFIX), fixed.num_frames, [self.JPBD.path]
+            )
+        if duplicates is not None:
+            duplicates.split(self.credit_ranges)
+
         # DIRTY EDGES
         rekt = rektlvls(
             fixed,
@@ -67,20 +97,26 @@ class ElainaFiltering:
         mask_thr = 75 << 8
         lmask = FDoG().edgemask(get_y(bb), lthr=mask_thr, hthr=mask_thr).std.Convolution([1] * 9)
 
-        denoise = core.std.MaskedMerge(ccd, bm3d, lmask)
+        denoise = masked_merge(ccd, bm3d, lmask)
 
         decs = vdf.noise.decsiz(
             denoise, min_in=128 << 8, max_in=235 << 8,
             blur_method=vdf.BilateralMethod.BILATERAL_GPU
         )
 
-
         # AA
-        nnedi_aa = lvf.aa.taa(decs, lvf.aa.nnedi3(opencl=True))  # smh faster than having both use opencl
-        eedi_aa = lvf.aa.taa(decs, lvf.aa.eedi3(opencl=False))
-        clamp_aa = lvf.aa.clamp_aa(decs, nnedi_aa, eedi_aa, strength=1.25)
+        def _aa(clip: vs.VideoNode) -> vs.VideoNode:
+            nnedi_aa = lvf.aa.taa(clip, lvf.aa.nnedi3(opencl=True))  # smh faster than having both use opencl
+            eedi_aa = lvf.aa.taa(clip, lvf.aa.eedi3(opencl=False))
+            return lvf.aa.clamp_aa(clip, nnedi_aa, eedi_aa, strength=1.25)
 
-        masked_aa = core.std.MaskedMerge(decs, clamp_aa, lmask)
+        if self.SPARSE_AA:
+            self.sparse_aa = SparseEval(decs, lmask, _aa, self.SPARSE_AA_GRID)
+            clamp_aa = self.sparse_aa.clip
+        else:
+            clamp_aa = _aa(decs)
+
+        masked_aa = masked_merge(decs, clamp_aa, lmask)
 
 
         # DEHALO
@@ -92,30 +128,26 @@ class ElainaFiltering:
         detail_mask = core.std.Expr([details, lmask], "x y +", vs.GRAY)
 
         deband = dumb3kdb(dehalo, threshold=35, grain=[15, 10])
-        masked_deband = core.std.MaskedMerge(deband, dehalo, detail_mask)
+        masked_deband = masked_merge(deband, dehalo, detail_mask)
 
 
         # CREDIT MASKS
         credit_mask = core.std.BlankClip(src, format=vs.GRAY8)
+        nc_masks: List[Tuple[str, int, vs.VideoNode]] = []
 
         if self.OP_RANGES:
-            op_start, op_end = self.OP_RANGES
-            op_mask = vdf.diff_creditless_mask(
-                src, src[op_start:op_end + 1], self.NCOP[:op_end + 1 - op_start],
-                start_frame=op_start, prefilter=True, thr=130,
-            )
+            op_mask = self.credit_mask(src, "NCOP", self.OP_RANGES, self.CREDIT_MASK_SCALE)
             credit_mask = core.std.Expr([credit_mask, op_mask], "x y +", vs.YUV)
+            nc_masks.append(("NCOP", self.OP_RANGES[0], op_mask))
 
         if self.ED_RANGES:
-            ed_start, ed_end = self.ED_RANGES
-            ed_mask = vdf.diff_creditless_mask(
-                src, src[ed_start:ed_end + 1], self.NCED[:ed_end + 1 - ed_start],
-                start_frame=ed_start, prefilter=True, thr=130,
-            )
+            ed_mask = self.credit_mask(src, "NCED", self.ED_RANGES, self.CREDIT_MASK_SCALE)
             credit_mask = core.std.Expr([credit_mask, ed_mask], "x y +", vs.YUV)
+            nc_masks.append(("NCED", self.ED_RANGES[0], ed_mask))
 
+        # EdgeCleaner is only requested where there are credits
         credit_mask = depth(credit_mask, 16)
-        merge_credits = core.std.MaskedMerge(masked_deband, haf.EdgeCleaner(denoise, smode=1), credit_mask)
+        merge_credits = masked_merge(masked_deband, haf.EdgeCleaner(denoise, smode=1), credit_mask, self.credit_ranges)
 
 
         # GRAIN
@@ -125,6 +157,11 @@ class ElainaFiltering:
             static=True, seed=seed
         )
 
+        # the grain is static, so the duplicates can reuse the whole filterchain
+        if duplicates is not None:
+            self.duplicates = DuplicateReuse(grain, duplicates)
+            grain = self.duplicates.clip
+
         # DEBUG
         self.filtersteps_clips = {
             "src": self.JPBD.clip_cut,
@@ -133,13 +170,63 @@ class ElainaFiltering:
             "stab": stab,
             "bm3d": bm3d,
             "denoise": denoise,
+            "decs": decs,
             "aa": masked_aa,
             "dering": dehalo,
             "deband": masked_deband,
             "grain": grain
         }
 
-        return vdf.finalise_clip(grain)
+        final = vdf.finalise_clip(grain)
+
+        # OP and ED frames without credits come from the season cache of the filtered creditless clips
+        for name, start, mask in nc_masks:
+            nc_file: FileInfo = getattr(self, f"{name}_FILE")
+            if (nc_filtered := NCCache(name, nc_file, self.NC_SOURCES).load()) is not None:
+                nc_src = vdf.initialise_clip(getattr(self, name), bits=8)
+                final = NCReuse(final, nc_filtered, fixed, nc_src, mask, start).clip
+
+        return final
+
+
+    @property
+    def credit_ranges(self) -> List[Tuple[int, int]]:
+        """OP and ED ranges, the only ones that can have credits"""
+        return [r for r in (self.OP_RANGES, self.ED_RANGES) if r is not None]
+
+
+    @property
+    def zone_ranges(self) -> List[Tuple[int, int]]:
+        """
+        Ranges passing the source through, to be encoded with faster settings.
+        Every frame goes through the filterchain (the OP and ED too, with their credits), so there are none.
+        """
+        return []
+
+
+    def credit_mask(
+        self, src: vs.VideoNode, name: str, ranges: Tuple[int, int], scale: Optional[int] = None
+    ) -> vs.VideoNode:
+        """
+        Credit mask of the OP or ED, full length
+
+        :param src:         Source clip
+        :param name:        Creditless clip compared with the range (``NCOP`` or ``NCED``)
+        :param ranges:      Inclusive range of the OP or ED
+        :param scale:       Divisor of the resolution the difference is computed at,
+                            None for :py:func:`vardefunc.diff_creditless_mask`
+        """
+        start, end = ranges
+        nc: vs.VideoNode = getattr(self, name)
+
+        if scale is None:
+            return vdf.diff_creditless_mask(
+                src, src[start:end + 1], nc[:end + 1 - start],
+                start_frame=start, prefilter=True, thr=self.CREDIT_MASK_THR,
+            )
+        return downscaled_credit_mask(
+            src, src[start:end + 1], nc[:end + 1 - start], start, self.CREDIT_MASK_THR, scale=scale
+        )
 
 
     def filtersteps(self, name_pos: int = 8, display_props: Optional[int] = None, font_scaling: int = 1) -> None:
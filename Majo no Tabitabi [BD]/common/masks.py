@@ -0,0 +1,195 @@
+"""
+Credit masks computed at a fraction of the resolution, merges skipping the clips an empty or full mask doesn't need
+
+Benchmark and compare them with the full-resolution vardefunc masks of an episode (from the show folder)::
+
+    python -m common.masks 01.py --scale 2
+"""
+__all__ = ["downscaled_credit_mask", "mask_agreement", "set_mask_state", "masked_merge"]
+
+import time
+from typing import Any, Dict, Sequence, Tuple
+
+import lvsfunc as lvf
+import vapoursynth as vs
+from vsutil import insert_clip, split
+
+from .ranges import Range
+
+
+core = vs.core
+
+# vardefunc's ExLaplacian4, 5x5
+EX_LAPLACIAN_4 = [-1] * 12 + [24] + [-1] * 12
+
+
+def downscaled_credit_mask(
+    src: vs.VideoNode, credit_clip: vs.VideoNode, nc_clip: vs.VideoNode, start_frame: int,
+    thr: int, expand: int = 2, scale: int = 2
+) -> vs.VideoNode:
+    """
+    Difference mask of a credited and a creditless clip, like :py:func:`vardefunc.diff_creditless_mask`
+    but computed at ``1/scale`` of the width and height. Only the binary mask is upscaled and dilated.
+    The area downscale replaces the bilateral prefilter.
+
+    :param src:             Source clip, the mask has its length
+    :param credit_clip:     Credited frames
+    :param nc_clip:         Creditless frames matching ``credit_clip``
+    :param start_frame:     First frame of ``credit_clip`` in ``src``
+    :param thr:             Threshold of the edges of the difference, at the bitdepth of ``src``
+    :param expand:          Dilation of the mask, as in vardefunc
+    :param scale:           Divisor of the width and height (2 for half, 4 for quarter)
+
+    :return:                GRAY mask at the bitdepth of ``src``
+    """
+    assert src.format
+    sample_type, bits = src.format.sample_type, src.format.bits_per_sample
+    gray = core.query_video_format(vs.GRAY, sample_type, bits, 0, 0).id
+
+    # at half resolution, the 4:2:0 chroma planes are not resized
+    small = [
+        core.resize.Bilinear(
+            clip, src.width // scale, src.height // scale,
+            format=core.query_video_format(vs.YUV, sample_type, bits, 0, 0).id
+        )
+        for clip in (credit_clip, nc_clip)
+    ]
+    diff = core.std.Expr(split(small[0]) + split(small[1]), "x a - abs y b - abs max z c - abs max", format=gray)
+
+    mask = diff.std.Convolution(EX_LAPLACIAN_4, saturate=False).std.Binarize(thr)
+    mask = core.resize.Point(mask, src.width, src.height)
+    for i in range(1, expand + 3):
+        mask = mask.std.Maximum(coordinates=[0, 1, 0, 1, 1, 0, 1, 0] if i % 3 != 1 else [1] * 8)
+
+    return insert_clip(core.std.BlankClip(src, format=gray), mask, start_frame)
+
+
+def set_mask_state(mask: vs.VideoNode, ranges: Sequence[Range] | None = None) -> vs.VideoNode:
+    """
+    Set ``MaskEmpty`` and ``MaskFull`` on every frame of a mask
+
+    :param mask:            Mask clip, every plane is measured
+    :param ranges:          Inclusive ranges where the mask can be non-empty, the frames outside of them
+                            are marked empty without being requested (None to measure every frame)
+
+    :return:                Mask with the properties
+    """
+    assert mask.format
+    peak = 1.0 if mask.format.sample_type == vs.FLOAT else (1 << mask.format.bits_per_sample) - 1
+    stats = [core.std.PlaneStats(mask, plane=p, prop=f"MaskStats{p}") for p in range(mask.format.num_planes)]
+
+    def _set_state(n: int, f: Sequence[vs.VideoFrame]) -> vs.VideoFrame:
+        fout = f[0].copy()
+        fout.props["MaskEmpty"] = int(all(frame.props[f"MaskStats{p}Max"] == 0 for p, frame in enumerate(f)))
+        fout.props["MaskFull"] = int(all(frame.props[f"MaskStats{p}Min"] >= peak for p, frame in enumerate(f)))
+        return fout
+
+    measured = core.std.ModifyFrame(stats[0], stats, _set_state)
+    if ranges is None:
+        return measured
+    if not ranges:
+        return mask.std.SetFrameProps(MaskEmpty=1, MaskFull=0)
+    return lvf.rfs(mask.std.SetFrameProps(MaskEmpty=1, MaskFull=0), measured, list(ranges))
+
+
+def masked_merge(
+    clipa: vs.VideoNode, clipb: vs.VideoNode, mask: vs.VideoNode, ranges: Sequence[Range] | None = None,
+    **merge_args: Any
+) -> vs.VideoNode:
+    """
+    ``std.MaskedMerge`` that doesn't request ``clipb`` where the mask is empty,
+    nor ``clipa`` where it is full and every plane is merged
+
+    :param ranges:          Inclusive ranges where the mask can be non-empty, see :py:func:`set_mask_state`
+    :param merge_args:      Other arguments of ``std.MaskedMerge``
+    """
+    mask = set_mask_state(mask, ranges)
+    merged = core.std.MaskedMerge(clipa, clipb, mask, **merge_args)
+    skip_full = merge_args.get("planes") is None
+
+    def _select(n: int, f: vs.VideoFrame) -> vs.VideoNode:
+        if f.props["MaskEmpty"]:
+            return clipa
+        if skip_full and f.props["MaskFull"]:
+            return clipb
+        return merged
+
+    return core.std.FrameEval(merged, _select, prop_src=mask)
+
+
+def mask_agreement(reference: vs.VideoNode, mask: vs.VideoNode, prefetch: int | None = None) -> Dict[str, float]:
+    """
+    Compare two binary masks of the same frames
+
+    :return:                Intersection over union of the masked pixels, average fraction of the pixels
+                            differing, number of frames where only one of the masks is empty
+    """
+    prefetch = prefetch or core.num_threads
+    both = core.std.Expr([reference, mask], "x y min")
+
+    inter = union = 0.0
+    frames = 0
+    stats = zip(*(
+        clip.std.PlaneStats().frames(prefetch=prefetch, close=True) for clip in (reference, mask, both)
+    ))
+    for f_ref, f_mask, f_both in stats:
+        avg_both = f_both.props["PlaneStatsAverage"]
+        inter += avg_both
+        union += f_ref.props["PlaneStatsAverage"] + f_mask.props["PlaneStatsAverage"] - avg_both
+        frames += (f_ref.props["PlaneStatsMax"] == 0) != (f_mask.props["PlaneStatsMax"] == 0)
+
+    return dict(
+        iou=inter / union if union else 1.0,
+        pixels=(union - inter) / max(reference.num_frames, 1),
+        frames=frames,
+    )
+
+
+def _render_fps(clip: vs.VideoNode, prefetch: int) -> float:
+    start = time.monotonic()
+    for _ in clip.frames(prefetch=prefetch, close=True):
+        pass
+    return clip.num_frames / max(time.monotonic() - start, 1e-6)
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    import vardefunc as vdf
+    from vardautomation import logger
+
+    parser = argparse.ArgumentParser(description="Compare the downscaled credit masks of an episode with vardefunc's")
+    parser.add_argument("script", help="episode script, e.g. 01.py")
+    parser.add_argument("--scale", type=int, nargs="+", default=[2, 4], help="divisors of the resolution to test")
+    parser.add_argument("--frames", type=int, default=0, help="only the first frames of every range")
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__masks__")
+    flt = episode["flt"]
+    src = vdf.initialise_clip(flt.JPBD.clip_cut, bits=8)
+    threads = core.num_threads
+
+    ranges: Dict[str, Tuple[int, int]] = {
+        name: r for name, r in (("NCOP", flt.OP_RANGES), ("NCED", flt.ED_RANGES)) if r is not None
+    }
+    if not ranges:
+        raise SystemExit(f"{args.script} has no OP or ED range")
+
+    for name, (start, end) in ranges.items():
+        if args.frames:
+            end = min(end, start + args.frames - 1)
+
+        full = flt.credit_mask(src, name, (start, end), scale=None)[start:end + 1]
+        full_fps = _render_fps(full, threads)
+        logger.info(f"{name} {start}-{end}: full resolution {full_fps:.1f} fps")
+
+        for scale in args.scale:
+            small = flt.credit_mask(src, name, (start, end), scale=scale)[start:end + 1]
+            fps = _render_fps(small, threads)
+            agreement = mask_agreement(full, small, threads)
+            logger.info(
+                f"{name} {start}-{end}: 1/{scale} resolution {fps:.1f} fps ({fps / full_fps:.2f}x), "
+                f"IoU {agreement['iou']:.3f}, {agreement['pixels']:.3%} of the pixels differ, "
+                f"{agreement['frames']:.0f}/{full.num_frames} frames disagree on having credits"
+            )
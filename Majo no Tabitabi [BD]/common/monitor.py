@@ -0,0 +1,217 @@
+__all__ = ["SizeBudgetExceeded", "SizeMonitor"]
+
+import os
+from fractions import Fraction
+from typing import Dict, List, Mapping, Sequence, Tuple
+
+import numpy as np
+from vardautomation import VPath, logger, progress_update_func
+
+from .ranges import Range
+
+
+class SizeBudgetExceeded(Exception):
+    """Raised by the monitor to stop an encode that won't fit in its budget"""
+
+
+class SizeMonitor:
+    """
+    Follow a x265 encode through its ``--csv`` per-frame stats and extrapolate the final size.
+    Used as the ``progress_update`` callback of the encoder.
+    """
+
+    BASE_CLASS = "episode"
+    """Class of the frames outside of every given class range"""
+
+    csv: VPath
+    """x265 csv stats file"""
+    budget: int
+    """Size budget in bytes"""
+    fps: Fraction
+    """Framerate of the encoded clip"""
+    scenes: List[Range]
+    """Scenes of the encoded clip, used in the report"""
+    class_names: List[str]
+    """Name of every scene class"""
+    frame_class: np.ndarray
+    """Class index of every frame"""
+    bits: np.ndarray
+    """Size in bits of every encoded frame, -1 if not encoded yet"""
+    offset: int
+    """First frame of the current encode (resumed encodes)"""
+
+    def __init__(
+        self,
+        csv: str | os.PathLike[str],
+        budget: float,
+        num_frames: int,
+        fps: Fraction,
+        scenes: Sequence[Range] | None = None,
+        classes: Mapping[str, Sequence[Range]] | None = None,
+        interval: int = 2000,
+        warmup: int = 5000,
+        tolerance: float = 0.05,
+        abort: bool = True,
+    ) -> None:
+        """
+        :param csv:         x265 csv stats file (``--csv``, per-frame log level)
+        :param budget:      Size budget in MiB
+        :param num_frames:  Number of frames of the full encode
+        :param fps:         Framerate of the encoded clip
+        :param scenes:      Inclusive ranges of every scene, the report lists the most expensive ones
+        :param classes:     Inclusive ranges of every scene class (e.g. credits), extrapolated separately
+        :param interval:    Number of frames between two checks
+        :param warmup:      Number of encoded frames before the projection is trusted
+        :param tolerance:   Allowed overshoot of the budget
+        :param abort:       Stop the encode, otherwise only warn once
+        """
+        self.csv = VPath(csv)
+        self.budget = int(budget * 1024 ** 2)
+        self.fps = fps
+        self.scenes = list(scenes) if scenes else [(0, num_frames - 1)]
+        self.interval = interval
+        self.warmup = warmup
+        self.tolerance = tolerance
+        self.abort = abort
+
+        self.class_names = [self.BASE_CLASS]
+        self.frame_class = np.zeros(num_frames, np.uint8)
+        for name, ranges in (classes or {}).items():
+            self.class_names.append(name)
+            for start, end in ranges:
+                self.frame_class[start:end + 1] = len(self.class_names) - 1
+
+        self.bits = np.full(num_frames, -1, np.int64)
+        self.offset = 0
+
+        self._pos = 0
+        self._columns: Dict[str, int] = {}
+        self._last_check = 0
+        self._warned = False
+
+
+    def reset(self, offset: int = 0) -> None:
+        """Start following a new encode of the frames from ``offset``"""
+        self.offset = offset
+        self._pos = 0
+        self._columns = {}
+        self._last_check = 0
+        if self.csv.exists():
+            self.csv.unlink()
+
+
+    def __call__(self, value: int, endvalue: int) -> None:
+        progress_update_func(value, endvalue)
+
+        if value - self._last_check < self.interval and value != endvalue:
+            return
+        self._last_check = value
+
+        self.read()
+        self.check()
+
+
+    def read(self) -> None:
+        """Read the frames added to the csv since the last call"""
+        if not self.csv.exists():
+            return
+
+        with open(self.csv, "rb") as f:
+            f.seek(self._pos)
+            data = f.read()
+
+        # only keep complete lines, x265 may be writing the last one
+        data = data[:data.rfind(b"\n") + 1]
+        self._pos += len(data)
+
+        for line in data.decode().splitlines():
+            fields = [field.strip() for field in line.split(",")]
+            if not self._columns:
+                self._columns = {name: i for i, name in enumerate(fields)}
+                continue
+            try:
+                poc = int(fields[self._columns["POC"]])
+                bits = int(fields[self._columns["Bits"]])
+            except (ValueError, IndexError):
+                continue
+            if 0 <= poc + self.offset < len(self.bits):
+                self.bits[poc + self.offset] = bits
+
+
+    def projection(self) -> Dict[str, int]:
+        """Projected size in bytes of every class"""
+        encoded = self.bits >= 0
+        average = self.bits[encoded].mean() if encoded.any() else 0
+
+        sizes: Dict[str, int] = {}
+        for i, name in enumerate(self.class_names):
+            in_class = self.frame_class == i
+            if not in_class.any():
+                continue
+            seen = self.bits[in_class & encoded]
+            rate = seen.mean() if len(seen) else average
+            sizes[name] = int((seen.sum() + rate * (in_class.sum() - len(seen))) / 8)
+
+        return sizes
+
+
+    def check(self) -> None:
+        encoded = int((self.bits >= 0).sum())
+        if encoded < self.warmup:
+            return
+
+        projected = sum(self.projection().values())
+        logger.debug(f"Size monitor: {encoded} frames encoded, projected {projected / 1024 ** 2:.1f} MiB")
+
+        if projected <= self.budget * (1 + self.tolerance) or self._warned:
+            return
+
+        report = self.write_report()
+        if self.abort:
+            raise SizeBudgetExceeded(
+                f"Projected size {projected / 1024 ** 2:.1f} MiB exceeds the {self.budget / 1024 ** 2:.1f} MiB budget, "
+                f"see {report.to_str()}"
+            )
+
+        logger.warning(f"Size monitor: the encode will likely exceed its budget, see {report.to_str()}")
+        self._warned = True
+
+
+    def write_report(self, top: int = 20) -> VPath:
+        """Write the projection and the most expensive scenes next to the csv"""
+        report = VPath(f"{self.csv.with_suffix('').to_str()}_report.txt")
+        sizes = self.projection()
+        fps = float(self.fps)
+        duration = len(self.bits) / fps
+
+        encoded = self.bits >= 0
+        average = self.bits[encoded].mean() * fps / 1000
+
+        lines = [
+            f"Budget: {self.budget / 1024 ** 2:.1f} MiB",
+            f"Projected: {sum(sizes.values()) / 1024 ** 2:.1f} MiB "
+            f"({sum(sizes.values()) * 8 / duration / 1000:.0f} kbps)",
+            f"Encoded: {int(encoded.sum())}/{len(self.bits)} frames",
+            "",
+            "Classes:",
+        ]
+        for i, name in enumerate(self.class_names):
+            if name in sizes:
+                seen = int((encoded & (self.frame_class == i)).sum())
+                total = int((self.frame_class == i).sum())
+                lines.append(f"    {name}: {sizes[name] / 1024 ** 2:.1f} MiB projected, {seen}/{total} frames encoded")
+
+        scene_rates: List[Tuple[float, Range]] = []
+        for start, end in self.scenes:
+            seen = self.bits[start:end + 1][encoded[start:end + 1]]
+            if len(seen):
+                scene_rates.append((seen.mean() * fps / 1000, (start, end)))
+
+        lines += ["", f"Most expensive scenes (average {average:.0f} kbps):"]
+        for kbps, (start, end) in sorted(scene_rates, reverse=True)[:top]:
+            lines.append(f"    {start}-{end}: {kbps:.0f} kbps ({kbps / average:.1f}x)")
+
+        with open(report, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+        return report
@@ -0,0 +1,199 @@
+"""
+Season-level cache of the filtered creditless OP and ED, reused by the episodes outside of the credits
+
+Build or refresh the caches, decoded and filtered (from the show folder)::
+
+    python -m common.nc_cache
+"""
+__all__ = ["NCCache", "NCReuse"]
+
+import atexit
+import os
+import subprocess
+from typing import BinaryIO, List, Sequence, cast
+
+import vapoursynth as vs
+from lvsfunc import source
+from vardautomation import BinaryPath, FileInfo, VPath, logger
+
+from .cache import is_stale
+from .y4m import write_y4m
+
+
+core = vs.core
+
+
+class NCCache:
+    """Lossless encode of a filtered creditless clip, shared by every episode of the season"""
+
+    DIR = VPath("nc_cache")
+
+    name: str
+    """Name of the creditless clip (e.g. ``NCOP``)"""
+    file: FileInfo
+    """FileInfo object of the creditless source"""
+    path: VPath
+    """Path of the lossless cache"""
+    sources: Sequence[str | os.PathLike[str]]
+    """Files the filtered clip is made from, the cache is stale if one is newer"""
+
+    def __init__(self, name: str, file: FileInfo, sources: Sequence[str | os.PathLike[str]] = ()) -> None:
+        """
+        :param name:        Name of the creditless clip
+        :param file:        FileInfo object of the creditless source
+        :param sources:     Other files the filtered clip depends on (e.g. the filtering module)
+        """
+        self.name = name
+        self.file = file
+        self.path = self.DIR / f"{name}_filtered.mkv"
+        self.sources = [file.path, *sources]
+
+
+    @property
+    def fresh(self) -> bool:
+        return self.path.exists() and not any(is_stale(self.path, src) for src in self.sources)
+
+
+    def load(self) -> vs.VideoNode | None:
+        """Filtered clip, or None if the cache has to be built again"""
+        if not self.fresh:
+            logger.warning(f"{self.name} cache is missing or stale, build it with \"python -m common.nc_cache\"")
+            return None
+        return source(self.path.resolve().to_str(), force_lsmas=True)
+
+
+    def build(self, clip: vs.VideoNode) -> None:
+        """Encode the filtered creditless clip to FFV1"""
+        self.DIR.mkdir(exist_ok=True)
+        tmp = self.path.with_suffix(".tmp.mkv")
+
+        params = [
+            BinaryPath.ffmpeg.to_str(), "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "yuv4mpegpipe", "-i", "-",
+            "-c:v", "ffv1", "-level", "3", "-slices", "24", "-slicecrc", "1", "-g", "1",
+            tmp.to_str()
+        ]
+        logger.info(f"{self.name} cache command: " + " ".join(params))
+
+        with subprocess.Popen(params, stdin=subprocess.PIPE) as process:
+            write_y4m(clip, cast(BinaryIO, process.stdin), prefetch=core.num_threads)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, params)
+
+        # the episodes only see complete caches
+        os.replace(tmp, self.path)
+
+
+class NCReuse:
+    """
+    Take the frames of a filtered clip from the filtered creditless clip where the sources match
+    and no credit is close enough to change the temporal filtering
+    """
+
+    clip: vs.VideoNode
+    """Filtered clip with the reused frames"""
+    reused: bytearray
+    """1 for every requested frame of the range taken from the cache, 2 if it has been filtered"""
+
+    def __init__(
+        self,
+        clip: vs.VideoNode,
+        nc_filtered: vs.VideoNode,
+        src: vs.VideoNode,
+        nc_src: vs.VideoNode,
+        credit_mask: vs.VideoNode,
+        start: int,
+        radius: int = 2,
+        diff_thr: float = 0,
+    ) -> None:
+        """
+        :param clip:            Filtered episode
+        :param nc_filtered:     Filtered creditless clip, from :py:meth:`NCCache.load`
+        :param src:             Episode source, as given to the filtering
+        :param nc_src:          Creditless source, frame 0 matching frame ``start`` of the episode
+        :param credit_mask:     Credit mask of the episode (full length)
+        :param start:           First frame of the OP or ED
+        :param radius:          Temporal radius of the filtering, the frames this close to a credit
+                                or to the range bounds are filtered
+        :param diff_thr:        Highest difference of any pixel between the sources, on every plane
+                                and at their bitdepth (0 to only reuse identical sources)
+        """
+        if nc_filtered.format != clip.format:
+            raise ValueError(f"Cached clip is {nc_filtered.format}, the filtered clip {clip.format}")
+
+        length = min(nc_filtered.num_frames, nc_src.num_frames, clip.num_frames - start)
+        end = start + length
+        self.radius = radius
+        self.diff_thr = diff_thr
+        self.length = length
+        self.reused = bytearray(length)
+
+        section = clip[start:end]
+        self._section = section
+        self._cached = nc_filtered[:length]
+
+        # largest difference of any pixel between the sources, a whole-frame average hides small credits
+        assert src.format
+        self._planes = src.format.num_planes
+        diff = core.std.Expr([src[start:end], nc_src[:length]], "x y - abs")
+        for p in range(self._planes):
+            diff = diff.std.PlaneStats(plane=p, prop=f"SrcDiff{p}")
+        credits = credit_mask[start:end].std.PlaneStats()
+        # credits of the neighbouring frames, within the temporal radius
+        shifted = [credits] + [
+            credits[0] * d + credits[:-d] if d > 0 else credits[-d:] + credits[-1] * -d
+            for d in range(-radius, radius + 1) if d
+        ]
+
+        parts: List[vs.VideoNode] = [core.std.FrameEval(section, self._select, prop_src=[diff, *shifted])]
+        if start:
+            parts.insert(0, clip[:start])
+        if end < clip.num_frames:
+            parts.append(clip[end:])
+        self.clip = core.std.Splice(parts) if len(parts) > 1 else parts[0]
+
+        atexit.register(lambda: any(self.reused) and logger.info(self.report()))
+
+
+    def report(self) -> str:
+        reused, filtered = self.reused.count(1), self.reused.count(2)
+        return f"Creditless cache: {reused}/{reused + filtered} frames reused"
+
+
+    def _select(self, n: int, f: Sequence[vs.VideoFrame]) -> vs.VideoNode:
+        if (
+            self.radius <= n < self.length - self.radius and
+            all(f[0].props[f"SrcDiff{p}Max"] <= self.diff_thr for p in range(self._planes)) and
+            all(frame.props["PlaneStatsMax"] == 0 for frame in f[1:])
+        ):
+            self.reused[n] = 1
+            return self._cached
+
+        self.reused[n] = 2
+        return self._section
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from .raw_cache import RawClipCache
+    from .utils import NCED, NCOP
+
+    parser = argparse.ArgumentParser(description="Filter the creditless OP and ED once for the whole season")
+    parser.add_argument("--force", action="store_true", help="build the caches even if they are up to date")
+    args = parser.parse_args()
+
+    for nc_name, nc_file in [("NCOP", NCOP), ("NCED", NCED)]:
+        raw = RawClipCache(NCCache.DIR / f"{nc_name}.raw")
+        if not raw.fresh([nc_file.path]) or args.force:
+            raw.build(nc_file.clip_cut)
+
+    # imported once the raw caches exist, so that the filtering reads them
+    from .filtering import ElainaFiltering
+
+    for nc_name, nc_file in [("NCOP", NCOP), ("NCED", NCED)]:
+        cache = NCCache(nc_name, nc_file, ElainaFiltering.NC_SOURCES)
+        if cache.fresh and not args.force:
+            logger.info(f"{nc_name} cache is up to date")
+            continue
+        cache.build(ElainaFiltering(nc_file).filterchain())
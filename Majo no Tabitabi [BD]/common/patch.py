@@ -0,0 +1,154 @@
+__all__ = ["Patch", "PatchList"]
+
+import math
+from typing import Dict, List, Sequence, Tuple
+
+import lvsfunc as lvf
+import vapoursynth as vs
+
+from .ranges import Range
+
+
+core = vs.core
+
+
+class Patch:
+    """Rectangle of a clip replaced by another clip on some frames"""
+
+    pos: Tuple[int, int]
+    """Top left corner of the rectangle"""
+    size: Tuple[int, int]
+    """Width and height of the rectangle"""
+    source: vs.VideoNode
+    """Clip the rectangle is taken from (e.g. the WEB)"""
+    ranges: List[Range]
+    """Inclusive frame ranges to patch"""
+    feather: float
+    """Sigma of the gaussian blur of the mask, 0 for a hard edge"""
+
+    def __init__(
+        self, pos: Tuple[int, int], size: Tuple[int, int], source: vs.VideoNode,
+        ranges: Sequence[int | Range], feather: float = 0.0
+    ) -> None:
+        self.pos = pos
+        self.size = size
+        self.source = source
+        self.ranges = [(r, r) if isinstance(r, int) else r for r in ranges]
+        self.feather = feather
+
+
+    def region(self, width: int, height: int, align: int = 2) -> Tuple[int, int, int, int]:
+        """Bounds ``(left, top, right, bottom)`` of the rectangle and its feathering in a frame, aligned"""
+        # the blurred mask is below 1/255 after 4 sigmas
+        margin = math.ceil(4 * self.feather)
+        (x, y), (w, h) = self.pos, self.size
+        x0, y0 = max(x - margin, 0) // align * align, max(y - margin, 0) // align * align
+        x1 = min(-(-(x + w + margin) // align) * align, width)
+        y1 = min(-(-(y + h + margin) // align) * align, height)
+        return x0, y0, x1, y1
+
+
+class PatchList:
+    """
+    Patches of a clip, the patched runs of frames are spliced between trims of the clip.
+    The other frames are passed through, the patched frames only blend the bounding box of their patches.
+    """
+
+    clip: vs.VideoNode
+    """Clip to patch"""
+    patches: List[Patch]
+    """Patches in the order they are applied, a patch overlapping an earlier one is blended over it"""
+
+    def __init__(self, clip: vs.VideoNode) -> None:
+        self.clip = clip
+        self.patches = []
+
+
+    def add(
+        self, pos: Tuple[int, int], size: Tuple[int, int], source: vs.VideoNode,
+        ranges: Sequence[int | Range], feather: float = 0.0
+    ) -> "PatchList":
+        """
+        :param pos:         Top left corner of the rectangle, as in ``lvf.mask.BoundingBox``
+        :param size:        Width and height of the rectangle
+        :param source:      Clip the rectangle is taken from, matching the frames of the patched clip
+        :param ranges:      Inclusive frame ranges or single frames to patch
+        :param feather:     Sigma of the gaussian blur of the mask, 0 for a hard edge
+
+        :return:            The PatchList, to chain the calls
+        """
+        patch = Patch(pos, size, source, ranges, feather)
+        for start, end in patch.ranges:
+            if not 0 <= start <= end < min(self.clip.num_frames, source.num_frames):
+                raise ValueError(f"Patch range ({start}, {end}) is out of the clips")
+        self.patches.append(patch)
+        return self
+
+
+    def apply(self) -> vs.VideoNode:
+        """Patched clip"""
+        if not self.patches:
+            return self.clip
+
+        # runs of frames with the same patches
+        points = sorted(
+            {0, self.clip.num_frames} |
+            {start for p in self.patches for start, _ in p.ranges} |
+            {end + 1 for p in self.patches for _, end in p.ranges}
+        )
+        starts: List[int] = []
+        active: List[Tuple[int, ...]] = []
+        for point in points[:-1]:
+            indices = tuple(i for i, p in enumerate(self.patches) if any(s <= point <= e for s, e in p.ranges))
+            if not active or active[-1] != indices:
+                starts.append(point)
+                active.append(indices)
+
+        masks = [self._mask(patch) for patch in self.patches]
+        nodes: Dict[Tuple[int, ...], vs.VideoNode] = {(): self.clip}
+        for indices in active:
+            if indices not in nodes:
+                clip = self.clip
+                for i in indices:
+                    clip = self._blend(clip, self.patches[i], masks[i])
+                nodes[indices] = clip
+
+        ends = starts[1:] + [self.clip.num_frames]
+        return core.std.Splice([nodes[indices][start:end] for start, end, indices in zip(starts, ends, active)])
+
+
+    def _region(self, patch: Patch) -> Tuple[int, int, int, int]:
+        assert self.clip.format
+        return patch.region(self.clip.width, self.clip.height, 1 << max(
+            self.clip.format.subsampling_w, self.clip.format.subsampling_h
+        ))
+
+
+    def _mask(self, patch: Patch) -> vs.VideoNode:
+        """Mask of the region of a patch, computed once"""
+        x0, y0, x1, y1 = self._region(patch)
+        blank = core.std.BlankClip(self.clip, width=x1 - x0, height=y1 - y0, length=1)
+
+        mask = lvf.mask.BoundingBox((patch.pos[0] - x0, patch.pos[1] - y0), patch.size).get_mask(blank)
+        if patch.feather:
+            mask = mask.bilateral.Gaussian(sigma=patch.feather)
+        return core.std.Loop(mask, self.clip.num_frames)
+
+
+    def _blend(self, clip: vs.VideoNode, patch: Patch, mask: vs.VideoNode) -> vs.VideoNode:
+        """Blend the region of a patch and stack it back with the rest of the frame"""
+        x0, y0, x1, y1 = self._region(patch)
+        width, height = clip.width, clip.height
+
+        def _crop(c: vs.VideoNode, cx0: int, cy0: int, cx1: int, cy1: int) -> vs.VideoNode:
+            return c.std.Crop(left=cx0, top=cy0, right=width - cx1, bottom=height - cy1)
+
+        blended = core.std.MaskedMerge(_crop(clip, x0, y0, x1, y1), _crop(patch.source, x0, y0, x1, y1), mask)
+
+        row = [_crop(clip, 0, y0, x0, y1)] if x0 else []
+        row += [blended] + ([_crop(clip, x1, y0, width, y1)] if x1 < width else [])
+        column = [_crop(clip, 0, 0, width, y0)] if y0 else []
+        column += [core.std.StackHorizontal(row) if len(row) > 1 else row[0]]
+        column += [_crop(clip, 0, y1, width, height)] if y1 < height else []
+
+        return core.std.StackVertical(column) if len(column) > 1 else column[0]
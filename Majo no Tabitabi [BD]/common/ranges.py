@@ -0,0 +1,217 @@
+__all__ = ["Range", "RangeMap", "TrimMap"]
+
+from bisect import bisect_right
+from typing import Any, List, Sequence, Tuple
+
+import vapoursynth as vs
+from vardautomation import FileInfo
+
+
+core = vs.core
+
+Range = Tuple[int, int]
+"""Inclusive frame range, same convention as ``lvf.rfs``"""
+
+
+class TrimMap:
+    """Map frame numbers between a source clip and its ``trims_or_dfs`` cut"""
+
+    segments: List[Tuple[int, int]]
+    """Source segments ``[start, end)`` in output order"""
+    offsets: List[int]
+    """Output frame number of the first frame of every segment"""
+    src_frames: int
+    """Number of frames of the source clip"""
+
+    def __init__(self, trims_or_dfs: Any, src_frames: int) -> None:
+        """
+        :param trims_or_dfs:    ``FileInfo.trims_or_dfs`` value (python slicing, DuplicateFrame supported)
+        :param src_frames:      Number of frames of the untrimmed clip
+        """
+        self.src_frames = src_frames
+        self.segments = []
+
+        if trims_or_dfs is None:
+            trims_or_dfs = [(None, None)]
+        elif isinstance(trims_or_dfs, tuple):
+            trims_or_dfs = [trims_or_dfs]
+
+        for trim in trims_or_dfs:
+            if isinstance(trim, tuple):
+                frames = range(src_frames)[slice(*trim)]
+                if len(frames):
+                    self.segments.append((frames.start, frames.stop))
+            else:
+                # DuplicateFrame is an int subclass carrying the number of copies
+                self.segments += [(int(trim), int(trim) + 1)] * int(getattr(trim, "dup", 1))
+
+        self.offsets = [0]
+        for start, end in self.segments:
+            self.offsets.append(self.offsets[-1] + end - start)
+
+
+    @classmethod
+    def from_file(cls, file: FileInfo) -> "TrimMap":
+        return cls(file.trims_or_dfs, file.clip.num_frames)
+
+
+    @property
+    def num_frames(self) -> int:
+        """Number of frames of the cut clip"""
+        return self.offsets[-1]
+
+
+    def cut_to_src(self, frame: int) -> int:
+        if not 0 <= frame < self.num_frames:
+            raise ValueError(f"Frame {frame} is out of the cut clip")
+
+        idx = bisect_right(self.offsets, frame) - 1
+        return self.segments[idx][0] + frame - self.offsets[idx]
+
+
+    def src_to_cut(self, frame: int) -> List[int]:
+        """Every output frame showing the source ``frame`` (empty if trimmed away)"""
+        return [
+            offset + frame - start
+            for (start, end), offset in zip(self.segments, self.offsets)
+            if start <= frame < end
+        ]
+
+
+    def src_ranges_to_cut(self, ranges: Sequence[Range]) -> List[Range]:
+        """Convert inclusive source ranges to inclusive cut ranges, splitting them at trim boundaries"""
+        out: List[Range] = []
+
+        for r_start, r_end in ranges:
+            for (start, end), offset in zip(self.segments, self.offsets):
+                lo, hi = max(r_start, start), min(r_end, end - 1)
+                if lo <= hi:
+                    out.append((offset + lo - start, offset + hi - start))
+
+        return self._merge(out)
+
+
+    def cut_ranges_to_src(self, ranges: Sequence[Range]) -> List[Range]:
+        """Convert inclusive cut ranges to inclusive source ranges, in output order"""
+        out: List[Range] = []
+
+        for r_start, r_end in ranges:
+            for (start, end), offset in zip(self.segments, self.offsets):
+                lo, hi = max(r_start, offset), min(r_end, offset + end - start - 1)
+                if lo <= hi:
+                    out.append((start + lo - offset, start + hi - offset))
+
+        return out
+
+
+    @staticmethod
+    def _merge(ranges: List[Range]) -> List[Range]:
+        merged: List[Range] = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+
+class RangeMap:
+    """
+    Every range replacement of an episode (what nested ``lvf.rfs`` calls do), compiled into a single splice.
+    Overlapping ranges assigned to different clips are refused unless the later one explicitly overrides.
+    """
+
+    num_frames: int
+    """Number of frames of the episode"""
+    clips: List[vs.VideoNode | None]
+    """Clips the ranges are assigned to, index 0 is the base clip given to :py:meth:`compile`"""
+    assignments: List[Tuple[int, int, int, str]]
+    """Inclusive ranges, clip index and name of every assignment, in the order they were added"""
+
+    def __init__(self, num_frames: int) -> None:
+        self.num_frames = num_frames
+        self.clips = [None]
+        self.assignments = []
+
+
+    def add(
+        self, clip: vs.VideoNode, ranges: Sequence[int | Range], name: str | None = None, override: bool = False
+    ) -> "RangeMap":
+        """
+        :param clip:        Clip taken on the ranges
+        :param ranges:      Inclusive ranges or single frames, like ``lvf.rfs``
+        :param name:        Name of the replacement in the error messages
+        :param override:    Take precedence over the overlapping ranges added before instead of raising an error
+
+        :return:            The RangeMap, to chain the calls
+        """
+        index = next((i for i, c in enumerate(self.clips) if c is clip), None)
+        if index is None:
+            self.clips.append(clip)
+            index = len(self.clips) - 1
+        name = name or f"clip {index}"
+
+        for r in ranges:
+            start, end = (r, r) if isinstance(r, int) else r
+            if not 0 <= start <= end < self.num_frames:
+                raise ValueError(f"RangeMap: {name} range ({start}, {end}) is out of the {self.num_frames} frames")
+            if clip.num_frames <= end:
+                raise ValueError(f"RangeMap: {name} has {clip.num_frames} frames, the range ends at {end}")
+
+            if not override:
+                for o_start, o_end, o_index, o_name in self.assignments:
+                    if start <= o_end and o_start <= end and o_index != index:
+                        raise ValueError(
+                            f"RangeMap: {name} ({start}, {end}) overlaps {o_name} ({o_start}, {o_end}) "
+                            "with another clip"
+                        )
+
+            self.assignments.append((start, end, index, name))
+
+        return self
+
+
+    def segments(self) -> Tuple[List[int], List[int]]:
+        """First frame and clip index of every run of frames taken from the same clip"""
+        points = sorted(
+            {0, self.num_frames} |
+            {start for start, *_ in self.assignments} |
+            {end + 1 for _, end, *_ in self.assignments}
+        )
+
+        starts: List[int] = []
+        indices: List[int] = []
+        for point in points[:-1]:
+            index = 0
+            # the last assignment wins, earlier ones can only differ if it overrides them
+            for start, end, i, _ in self.assignments:
+                if start <= point <= end:
+                    index = i
+            if not indices or indices[-1] != index:
+                starts.append(point)
+                indices.append(index)
+
+        return starts, indices
+
+
+    def compile(self, base: vs.VideoNode) -> vs.VideoNode:
+        """
+        :param base:        Clip of the frames outside of every range
+
+        :return:            Clip taking every range from its clip, spliced from trims of the clips
+        """
+        if base.num_frames != self.num_frames:
+            raise ValueError(f"RangeMap: base clip has {base.num_frames} frames, expected {self.num_frames}")
+
+        clips = [base, *(c for c in self.clips[1:] if c is not None)]
+        for i, clip in enumerate(clips[1:], 1):
+            if clip.format != base.format or (clip.width, clip.height) != (base.width, base.height):
+                name = next(n for *_, idx, n in self.assignments if idx == i)
+                raise ValueError(f"RangeMap: {name} doesn't have the format or the dimensions of the base clip")
+
+        starts, indices = self.segments()
+        if len(indices) == 1:
+            return clips[indices[0]]
+
+        ends = starts[1:] + [self.num_frames]
+        return core.std.Splice([clips[i][start:end] for start, end, i in zip(starts, ends, indices)])
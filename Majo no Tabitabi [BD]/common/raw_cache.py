@@ -0,0 +1,125 @@
+__all__ = ["RawClipCache", "cached_clip_cut"]
+
+import json
+import os
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+import vapoursynth as vs
+from vardautomation import FileInfo, VPath, logger
+
+from .cache import is_stale
+
+
+core = vs.core
+
+
+class RawClipCache:
+    """
+    Decoded frames of a clip stored uncompressed and memory-mapped read-only.
+    Every process reading the same cache shares its pages, nothing is decoded again.
+    """
+
+    ALIGN = 4096
+
+    path: VPath
+    """Path of the raw frames, the clip properties are in a ``.json`` file next to it"""
+
+    def __init__(self, path: str | os.PathLike[str]) -> None:
+        self.path = VPath(path)
+
+
+    @property
+    def info_path(self) -> VPath:
+        return self.path.with_suffix(".json")
+
+
+    def fresh(self, sources: Sequence[str | os.PathLike[str]] = ()) -> bool:
+        """Complete and newer than every source"""
+        return self.info_path.exists() and not any(is_stale(self.info_path, src) for src in sources)
+
+
+    def build(self, clip: vs.VideoNode) -> None:
+        """Decode the clip and write every frame"""
+        fmt = clip.format
+        assert fmt
+
+        self.info_path.unlink(missing_ok=True)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        props: Dict[str, Any] = {}
+        with open(self.path, "wb") as f:
+            for n, frame in enumerate(clip.frames(close=True)):
+                if n == 0:
+                    props = {
+                        k: v for k, v in frame.props.items() if isinstance(v, (int, float)) and k != "_AbsoluteTime"
+                    }
+                for p in range(fmt.num_planes):
+                    f.write(np.ascontiguousarray(np.asarray(frame[p])).data)
+                f.write(bytes(-f.tell() % self.ALIGN))
+
+        info = dict(
+            width=clip.width, height=clip.height, num_frames=clip.num_frames,
+            fps=[clip.fps_num, clip.fps_den],
+            format=[
+                int(fmt.color_family), int(fmt.sample_type), fmt.bits_per_sample, fmt.subsampling_w, fmt.subsampling_h
+            ],
+            props=props,
+        )
+        # written last, a cache without it is incomplete
+        with open(self.info_path, "w") as f:
+            json.dump(info, f)
+
+        logger.info(f"Raw cache: {clip.num_frames} frames written to {self.path.name}")
+
+
+    def load(self) -> vs.VideoNode:
+        """Clip reading its frames from the memory-mapped cache"""
+        with open(self.info_path, "r") as f:
+            info = json.load(f)
+
+        color_family, sample_type, bits, ssw, ssh = info["format"]
+        fmt = core.query_video_format(color_family, sample_type, bits, ssw, ssh)
+        dtype = np.dtype({1: np.uint8, 2: np.uint16, 4: np.float32}[fmt.bytes_per_sample])
+
+        shapes: List[Tuple[int, int]] = [
+            (info["height"] >> (ssh if p else 0), info["width"] >> (ssw if p else 0)) for p in range(fmt.num_planes)
+        ]
+        frame_size = sum(h * w for h, w in shapes) * fmt.bytes_per_sample
+        stride = frame_size + -frame_size % self.ALIGN
+
+        data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        if len(data) < stride * info["num_frames"]:
+            raise ValueError(f"Raw cache {self.path.name} is truncated")
+
+        def _planes(n: int) -> List[np.ndarray]:
+            planes, offset = [], n * stride
+            for h, w in shapes:
+                size = h * w * fmt.bytes_per_sample
+                planes.append(data[offset:offset + size].view(dtype).reshape(h, w))
+                offset += size
+            return planes
+
+        def _read(n: int, f: vs.VideoFrame) -> vs.VideoFrame:
+            fout = f.copy()
+            for p, plane in enumerate(_planes(n)):
+                np.copyto(np.asarray(fout[p]), plane)
+            return fout
+
+        fps_num, fps_den = info["fps"]
+        blank = core.std.BlankClip(
+            format=fmt.id, width=info["width"], height=info["height"], length=info["num_frames"],
+            fpsnum=fps_num, fpsden=fps_den, keep=True
+        )
+        return core.std.ModifyFrame(blank, blank, _read).std.SetFrameProps(**info["props"])
+
+
+def cached_clip_cut(file: FileInfo, name: str) -> vs.VideoNode:
+    """``file.clip_cut`` from its raw cache in ``nc_cache/`` when it is up to date"""
+    cache = RawClipCache(VPath("nc_cache") / f"{name}.raw")
+    if cache.fresh([file.path]):
+        clip = cache.load()
+        # the trims may have changed since
+        if clip.num_frames == file.clip_cut.num_frames:
+            return clip
+    return file.clip_cut
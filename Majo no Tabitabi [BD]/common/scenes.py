@@ -0,0 +1,155 @@
+__all__ = ["SceneIndex"]
+
+import os
+import struct
+import sys
+import time
+from array import array
+from typing import List, Sequence
+
+import vapoursynth as vs
+from vardautomation import FileInfo, VPath, logger
+
+from .cache import cache_path, is_stale
+from .ranges import Range, TrimMap
+
+
+core = vs.core
+
+
+class SceneIndex:
+    """Scene changes of a source file, stored next to its index cache"""
+
+    MAGIC = b"SCIX"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHII")
+    SUFFIX = ".scenes"
+
+    path: VPath
+    """Path of the binary scene file"""
+    num_frames: int
+    """Number of frames of the source clip"""
+    frames: List[int]
+    """First frame of every scene (source frame numbers, always starts with 0)"""
+
+    def __init__(self, path: str | os.PathLike[str], num_frames: int, frames: Sequence[int]) -> None:
+        self.path = VPath(path)
+        self.num_frames = num_frames
+        self.frames = sorted({0, *frames})
+
+
+    @classmethod
+    def from_file(
+        cls, file: FileInfo, force: bool = False,
+        width: int = 320, height: int = 180, threads: int | None = None
+    ) -> "SceneIndex":
+        """
+        Get the scene index of a source, detecting the scene changes only if there is no valid cache
+
+        :param file:        FileInfo object of the episode (scenes are detected on the untrimmed clip)
+        :param force:       Detect the scene changes even if a cache exists
+        :param width:       Width used for the detection
+        :param height:      Height used for the detection
+        :param threads:     Number of frames requested concurrently (defaults to the core threads)
+
+        :return:            SceneIndex object
+        """
+        path = cache_path(file, cls.SUFFIX)
+
+        if not force and not is_stale(path, file.path):
+            index = cls.load(path)
+            if index.num_frames == file.clip.num_frames:
+                return index
+            logger.warning(f"Scene index {path.name} does not match the source, detecting again")
+
+        index = cls(path, file.clip.num_frames, cls.detect(file.clip, width, height, threads))
+        index.write()
+        return index
+
+
+    @classmethod
+    def load(cls, path: str | os.PathLike[str]) -> "SceneIndex":
+        with open(path, "rb") as f:
+            magic, version, num_frames, count = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError(f"{path} is not a scene index")
+
+            frames = array("I")
+            frames.fromfile(f, count)
+
+        if sys.byteorder == "big":
+            frames.byteswap()
+
+        return cls(path, num_frames, frames.tolist())
+
+
+    def write(self) -> None:
+        frames = array("I", self.frames)
+        if sys.byteorder == "big":
+            frames.byteswap()
+
+        with open(self.path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.num_frames, len(frames)))
+            frames.tofile(f)
+
+
+    @staticmethod
+    def detect(clip: vs.VideoNode, width: int = 320, height: int = 180, threads: int | None = None) -> List[int]:
+        """
+        Detect scene changes with WWXD on a downscaled clip, rendering several frames at once
+
+        :return:            List of the first frame of every scene
+        """
+        threads = threads or core.num_threads
+        small = core.resize.Bilinear(clip, width, height, format=vs.YUV420P8).wwxd.WWXD()
+
+        start = time.monotonic()
+        frames = [
+            n for n, f in enumerate(small.frames(prefetch=threads, backlog=threads * 2))
+            if f.props["Scenechange"]
+        ]
+        elapsed = time.monotonic() - start
+
+        logger.info(f"Detected {len(frames)} scene changes at {clip.num_frames / max(elapsed, 1e-6):.1f} fps")
+        return frames
+
+
+    def cut(self, trims: TrimMap) -> List[int]:
+        """Scene changes in cut frame numbers (every trim start is a scene change)"""
+        frames = {0, *trims.offsets[:-1]}
+        for frame in self.frames:
+            frames.update(trims.src_to_cut(frame))
+        return sorted(f for f in frames if f < trims.num_frames)
+
+
+    def scenes(self, trims: TrimMap | None = None) -> List[Range]:
+        """Inclusive ranges of every scene"""
+        frames = self.cut(trims) if trims else self.frames
+        end = trims.num_frames if trims else self.num_frames
+        return [(s, e - 1) for s, e in zip(frames, frames[1:] + [end])]
+
+
+    def chunks(self, min_length: int, trims: TrimMap | None = None) -> List[Range]:
+        """
+        Group consecutive scenes into chunks of at least ``min_length`` frames
+
+        :param min_length:  Minimum chunk length (the last chunk can be shorter)
+        :param trims:       Express the chunks in cut frame numbers
+        """
+        chunks: List[Range] = []
+        for start, end in self.scenes(trims):
+            if chunks and chunks[-1][1] - chunks[-1][0] + 1 < min_length:
+                chunks[-1] = (chunks[-1][0], end)
+            else:
+                chunks.append((start, end))
+        return chunks
+
+
+    def pick_frames(self, num: int, trims: TrimMap | None = None) -> List[int]:
+        """Middle frame of ``num`` scenes spread over the whole clip"""
+        scenes = self.scenes(trims)
+        if num >= len(scenes):
+            return [(s + e) // 2 for s, e in scenes]
+
+        step = len(scenes) / num
+        return [(s + e) // 2 for s, e in (scenes[int(i * step)] for i in range(num))]
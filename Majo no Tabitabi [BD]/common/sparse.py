@@ -0,0 +1,158 @@
+"""
+Evaluation of expensive spatial filters only on the tiles of a frame covered by a mask
+
+Benchmark the sparse AA of an episode against the full-frame AA (from the show folder)::
+
+    python -m common.sparse 01.py --frames 2000
+"""
+__all__ = ["SparseEval"]
+
+import atexit
+import time
+from functools import partial
+from typing import Callable, List, Sequence, Tuple
+
+import vapoursynth as vs
+from vardautomation import logger
+
+
+core = vs.core
+
+
+class SparseEval:
+    """
+    Apply a spatial filter tile by tile, only on the tiles where a mask is non-zero.
+    The tiles are filtered with a margin around them, so the result matches the full-frame filter
+    as long as its support is smaller than the margin.
+    """
+
+    PLAIN = 1
+    FILTERED = 2
+
+    clip: vs.VideoNode
+    """Clip filtered on the tiles covered by the mask, the other tiles are taken from the input clip"""
+    tiles: List[Tuple[int, int, int, int]]
+    """Bounds ``(left, top, right, bottom)`` of every tile"""
+    requested: bytearray
+    """``PLAIN`` or ``FILTERED`` for every requested tile of every frame, 0 for the others"""
+
+    def __init__(
+        self,
+        clip: vs.VideoNode,
+        mask: vs.VideoNode,
+        func: Callable[[vs.VideoNode], vs.VideoNode],
+        grid: Tuple[int, int] = (4, 4),
+        margin: int = 32,
+        align: int = 8,
+        report_at_exit: bool = True,
+    ) -> None:
+        """
+        :param clip:            Clip to filter
+        :param mask:            Mask of the pixels using the filtered clip, at the resolution of ``clip``
+        :param func:            Spatial filter, must keep the dimensions and support any size
+        :param grid:            Number of columns and rows of tiles
+        :param margin:          Pixels filtered around every tile, also added around the mask of a tile
+        :param align:           Alignment of the tile bounds and of the margin (subsampling, filter constraints)
+        :param report_at_exit:  Log :py:meth:`report` when the process exits
+        """
+        if (mask.width, mask.height) != (clip.width, clip.height):
+            raise ValueError(f"Mask is {mask.width}x{mask.height}, the clip {clip.width}x{clip.height}")
+
+        cols, rows = grid
+        margin = -(-margin // align) * align
+        xs = self._bounds(clip.width, cols, align)
+        ys = self._bounds(clip.height, rows, align)
+
+        self.tiles = [(x0, y0, x1, y1) for y0, y1 in zip(ys, ys[1:]) for x0, x1 in zip(xs, xs[1:])]
+        self.requested = bytearray(clip.num_frames * len(self.tiles))
+
+        stacked: List[vs.VideoNode] = []
+        for i, (x0, y0, x1, y1) in enumerate(self.tiles):
+            # tile with its margin, clamped to the frame
+            mx0, my0 = max(x0 - margin, 0), max(y0 - margin, 0)
+            mx1, my1 = min(x1 + margin, clip.width), min(y1 + margin, clip.height)
+
+            plain = self._crop(clip, x0, y0, x1, y1)
+            filtered = func(self._crop(clip, mx0, my0, mx1, my1))
+            filtered = self._crop(filtered, x0 - mx0, y0 - my0, x1 - mx0, y1 - my0)
+            stats = self._crop(mask, mx0, my0, mx1, my1).std.PlaneStats()
+
+            stacked.append(core.std.FrameEval(plain, partial(self._select, i, plain, filtered), prop_src=stats))
+
+        lines = [
+            core.std.StackHorizontal(line) if cols > 1 else line[0]
+            for line in (stacked[row * cols:(row + 1) * cols] for row in range(rows))
+        ]
+        self.clip = core.std.StackVertical(lines) if rows > 1 else lines[0]
+
+        if report_at_exit:
+            atexit.register(lambda: any(self.requested) and logger.info(self.report()))
+
+
+    def report(self) -> str:
+        plain, filtered = self.requested.count(self.PLAIN), self.requested.count(self.FILTERED)
+        total = plain + filtered
+        return f"Sparse evaluation: {filtered}/{total} tiles ({filtered / max(total, 1):.1%}) filtered"
+
+
+    def _select(self, i: int, plain: vs.VideoNode, filtered: vs.VideoNode, n: int, f: vs.VideoFrame) -> vs.VideoNode:
+        active = f.props["PlaneStatsMax"] > 0
+        self.requested[n * len(self.tiles) + i] = self.FILTERED if active else self.PLAIN
+        return filtered if active else plain
+
+
+    @staticmethod
+    def _bounds(size: int, count: int, align: int) -> List[int]:
+        inner = [round(size * i / count / align) * align for i in range(1, count)]
+        return [0, *inner, size]
+
+
+    @staticmethod
+    def _crop(clip: vs.VideoNode, x0: int, y0: int, x1: int, y1: int) -> vs.VideoNode:
+        if (x0, y0, x1, y1) == (0, 0, clip.width, clip.height):
+            return clip
+        return clip.std.Crop(left=x0, top=y0, right=clip.width - x1, bottom=clip.height - y1)
+
+
+def _render_seconds(clip: vs.VideoNode, frames: Sequence[int]) -> float:
+    start = time.monotonic()
+    clip = core.std.Splice([clip[n] for n in frames]) if len(frames) > 1 else clip[frames[0]]
+    for _ in clip.frames(prefetch=core.num_threads, close=True):
+        pass
+    return time.monotonic() - start
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description="Compare the sparse AA of an episode with the full-frame AA")
+    parser.add_argument("script", help="episode script, e.g. 01.py")
+    parser.add_argument("--frames", type=int, default=1000, help="number of frames, spread over the episode")
+    parser.add_argument("--grid", type=int, nargs=2, default=None, help="columns and rows of tiles")
+    args = parser.parse_args()
+
+    episode = runpy.run_path(args.script, run_name="__sparse__")
+    flt = episode["flt"]
+    if args.grid:
+        flt.SPARSE_AA_GRID = tuple(args.grid)
+
+    num_frames = flt.JPBD.clip_cut.num_frames
+    step = max(num_frames // max(args.frames, 1), 1)
+    frames = list(range(0, num_frames, step))[:args.frames]
+
+    # the filtering before the AA is the same in both modes, its time is measured separately
+    flt.SPARSE_AA = False
+    flt.filterchain()
+    before = _render_seconds(flt.filtersteps_clips["decs"], frames)
+    full = _render_seconds(flt.filtersteps_clips["aa"], frames) - before
+
+    flt.SPARSE_AA = True
+    flt.filterchain()
+    sparse = _render_seconds(flt.filtersteps_clips["aa"], frames) - before
+    logger.info(flt.sparse_aa.report())
+
+    logger.info(
+        f"AA on {len(frames)} frames: full frame {full:.1f}s, sparse {sparse:.1f}s ({full / max(sparse, 1e-6):.2f}x), "
+        f"filtering before the AA {before:.1f}s"
+    )
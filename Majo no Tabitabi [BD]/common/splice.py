@@ -0,0 +1,159 @@
+__all__ = ["FrameHashes", "Gop", "HevcStream"]
+
+import hashlib
+import mmap
+import os
+import sys
+from array import array
+from typing import List, NamedTuple, Sequence
+
+import vapoursynth as vs
+from vardautomation import VPath, logger
+
+from .ranges import Range, TrimMap
+from .y4m import _plane_buffers
+
+
+class Gop(NamedTuple):
+    """Closed GOP of a HEVC stream"""
+
+    start: int
+    """First frame (display order)"""
+    end: int
+    """Last frame + 1"""
+    byte_start: int
+    """Offset of the first NAL unit of the GOP (parameter sets included)"""
+    byte_end: int
+    """Offset of the next GOP"""
+
+
+class HevcStream:
+    """Annex B HEVC stream cut at its IDR frames"""
+
+    # NAL unit types
+    IDR = {19, 20}
+    OPEN_GOP = {8, 9, 21}  # RASL, CRA
+    PREFIX = {32, 33, 34, 35, 39}  # VPS, SPS, PPS, AUD, prefix SEI
+
+    path: VPath
+    """Path of the stream"""
+    gops: List[Gop]
+    """Every GOP of the stream"""
+    num_frames: int
+    """Number of frames of the stream"""
+
+    def __init__(self, path: str | os.PathLike[str]) -> None:
+        self.path = VPath(path)
+        self.gops = []
+
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+            frames = 0
+            prefix_start: int | None = None
+
+            pos = data.find(b"\x00\x00\x01")
+            while pos != -1:
+                offset = pos - 1 if pos > 0 and data[pos - 1] == 0 else pos
+                nal_type = (data[pos + 3] >> 1) & 0x3F
+
+                if nal_type in self.OPEN_GOP:
+                    raise ValueError(f"{self.path.name} has open GOPs, it can't be spliced (use --no-open-gop)")
+
+                if nal_type in self.PREFIX:
+                    prefix_start = offset if prefix_start is None else prefix_start
+                elif nal_type < 32:
+                    # first_slice_segment_in_pic_flag
+                    if data[pos + 5] >> 7:
+                        if nal_type in self.IDR:
+                            self.gops.append(Gop(frames, -1, offset if prefix_start is None else prefix_start, -1))
+                        frames += 1
+                    prefix_start = None
+                else:
+                    prefix_start = None
+
+                pos = data.find(b"\x00\x00\x01", pos + 3)
+
+        self.num_frames = frames
+        self.gops = [
+            gop._replace(end=nxt.start, byte_end=nxt.byte_start)
+            for gop, nxt in zip(self.gops, self.gops[1:] + [Gop(frames, -1, size, -1)])
+        ]
+
+
+    def expand(self, ranges: Sequence[Range]) -> List[Range]:
+        """Grow inclusive frame ranges to the GOPs covering them, merging the adjacent ones"""
+        out: List[Range] = []
+        for start, end in ranges:
+            if not 0 <= start <= end < self.num_frames:
+                raise ValueError(f"Range ({start}, {end}) is out of the {self.num_frames} frames of {self.path.name}")
+            covering = [gop for gop in self.gops if gop.start <= end and start < gop.end]
+            if not covering:
+                raise ValueError(f"Range ({start}, {end}) is before the first IDR frame of {self.path.name}")
+            out.append((covering[0].start, covering[-1].end - 1))
+        return TrimMap._merge(out)
+
+
+class FrameHashes:
+    """Hash of every frame sent to the encoder, used to find the frames changed since"""
+
+    SUFFIX = ".hashes"
+
+    path: VPath
+    """Path of the hash file"""
+    hashes: array
+    """64-bit hash of every frame, 0 if unknown"""
+    offset: int
+    """First frame of the current encode (resumed encodes)"""
+
+    def __init__(self, path: str | os.PathLike[str], num_frames: int) -> None:
+        self.path = VPath(path)
+        self.hashes = array("Q", bytes(8 * num_frames))
+        self.offset = 0
+
+
+    @classmethod
+    def load(cls, path: str | os.PathLike[str], num_frames: int) -> "FrameHashes":
+        hashes = cls(path, num_frames)
+        if hashes.path.exists():
+            stored = array("Q")
+            with open(hashes.path, "rb") as f:
+                stored.frombytes(f.read())
+            if sys.byteorder == "big":
+                stored.byteswap()
+            hashes.hashes[:min(len(stored), num_frames)] = stored[:num_frames]
+        return hashes
+
+
+    def write(self) -> None:
+        hashes = array("Q", self.hashes)
+        if sys.byteorder == "big":
+            hashes.byteswap()
+        with open(self.path, "wb") as f:
+            hashes.tofile(f)
+
+
+    def update(self, n: int, frame: vs.VideoFrame) -> None:
+        """Hash the ``n``-th frame of the current encode"""
+        self.hashes[self.offset + n] = self.hash(frame)
+
+
+    @staticmethod
+    def hash(frame: vs.VideoFrame) -> int:
+        h = hashlib.blake2b(digest_size=8)
+        for p in range(frame.format.num_planes):
+            for buffer in _plane_buffers(frame[p]):
+                h.update(buffer)
+        # 0 is kept for unknown frames
+        return int.from_bytes(h.digest(), "little") or 1
+
+
+    def changed(self, clip: vs.VideoNode, prefetch: int | None = None) -> List[Range]:
+        """Render the clip and return the inclusive ranges whose frames don't match the stored hashes"""
+        changed: List[Range] = []
+        for n, frame in enumerate(clip.frames(prefetch, close=True)):
+            if self.hashes[n] != self.hash(frame):
+                changed.append((n, n))
+
+        merged = TrimMap._merge(changed)
+        logger.info(f"Frame hashes: {sum(e - s + 1 for s, e in merged)} changed frame(s) in {len(merged)} range(s)")
+        return merged
@@ -0,0 +1,208 @@
+__all__ = ["FrameTee", "TeeSink", "y4m_header"]
+
+import copy
+import os
+import queue
+import subprocess
+import threading
+import time
+from typing import Any, Callable, List, Sequence
+
+import vapoursynth as vs
+from vardautomation import FileInfo, VPath, VideoEncoder, logger
+
+
+def y4m_header(clip: vs.VideoNode) -> bytes:
+    """YUV4MPEG2 stream header of a clip, like the one written by ``clip.output``"""
+    fmt = clip.format
+    assert fmt
+
+    if fmt.color_family == vs.GRAY:
+        css = "mono"
+    else:
+        css = {(1, 1): "420", (1, 0): "422", (0, 0): "444", (2, 0): "411"}[(fmt.subsampling_w, fmt.subsampling_h)]
+
+    tags = f"C{css}p{fmt.bits_per_sample} XYSCSS={css.upper()}P{fmt.bits_per_sample}" if fmt.bits_per_sample > 8 \
+        else f"C{css} XYSCSS={css.upper()}"
+
+    return f"YUV4MPEG2 W{clip.width} H{clip.height} F{clip.fps_num}:{clip.fps_den} Ip A0:0 {tags}\n".encode()
+
+
+class TeeSink:
+    """Encoder process fed by a :py:class:`FrameTee` through a bounded queue"""
+
+    name: str
+    """Name used in the logs"""
+    params: List[str]
+    """Command line of the encoder, reading y4m from stdin"""
+    queue: "queue.Queue[bytes | None]"
+    """Frames waiting to be written, the tee blocks when it is full"""
+    error: BaseException | None
+    """Error raised while writing to the encoder"""
+    blocked: float
+    """Time spent waiting for room in the queue, in seconds"""
+    output: VPath | None
+    """Output of the encoder, written under :py:meth:`partial_path` until the encode succeeded"""
+
+    def __init__(self, name: str, params: Sequence[str], queue_size: int = 8, output: VPath | None = None) -> None:
+        """
+        :param name:            Name used in the logs
+        :param params:          Command line of the encoder
+        :param queue_size:      Number of frames buffered for this sink
+        :param output:          Output renamed from :py:meth:`partial_path` by :py:meth:`finish`
+        """
+        self.name = name
+        self.params = list(params)
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+        self.blocked = 0.0
+        self.output = output
+
+
+    @classmethod
+    def from_encoder(
+        cls, encoder: VideoEncoder, file: FileInfo, clip: vs.VideoNode, output: VPath,
+        extra_params: Sequence[str] = ()
+    ) -> "TeeSink":
+        """
+        Build a sink from a copy of a vardautomation encoder, the encoder itself is left untouched.
+        The encoder has to write to ``output`` with ``file``, the sink writes to its partial path instead.
+
+        :param encoder:         Encoder whose params haven't been formatted yet
+        :param file:            FileInfo the params are formatted with
+        :param clip:            Clip the params are formatted with
+        :param output:          Output of the encoder
+        :param extra_params:    Appended to the formatted params
+        """
+        encoder = copy.copy(encoder)
+        encoder.params = list(encoder.params)
+        encoder.file, encoder.clip = file, clip
+        encoder._update_settings()
+
+        if output.to_str() not in encoder.params:
+            raise ValueError(f"Tee: {encoder.__class__.__name__} doesn't write to {output.to_str()}")
+        partial = cls.partial_path(output).to_str()
+        params = [partial if param == output.to_str() else param for param in encoder.params]
+
+        return cls(output.name, params + list(extra_params), output=output)
+
+
+    @staticmethod
+    def partial_path(output: VPath) -> VPath:
+        """Name of an output while it is written, so that an interrupted encode never looks complete"""
+        return output.append_stem("_partial")
+
+
+    def start(self) -> None:
+        logger.info(f"Tee sink {self.name} command: " + " ".join(self.params))
+        self.process = subprocess.Popen(self.params, stdin=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._write, name=f"tee-{self.name}", daemon=True)
+        self.thread.start()
+
+
+    def put(self, data: bytes | None) -> None:
+        """Queue a frame, waiting for room if the encoder is behind. None closes the sink."""
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            start = time.monotonic()
+            self.queue.put(data)
+            self.blocked += time.monotonic() - start
+
+
+    def wait(self) -> int:
+        self.thread.join()
+        return self.process.wait()
+
+
+    def finish(self) -> None:
+        """Give its final name to the output of a successful encode"""
+        if self.output is not None:
+            os.replace(self.partial_path(self.output), self.output)
+
+
+    def _write(self) -> None:
+        assert self.process.stdin
+        while (data := self.queue.get()) is not None:
+            if self.error is not None:
+                # keep draining so that a dead encoder doesn't stall the other sinks
+                continue
+            try:
+                self.process.stdin.write(data)
+            except (BrokenPipeError, OSError) as err:
+                logger.warning(f"Tee sink {self.name} stopped: {err}")
+                self.error = err
+
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+
+class FrameTee:
+    """Render every frame of a clip once and send it to several encoders at the same time"""
+
+    clip: vs.VideoNode
+    """Clip to render"""
+    sinks: List[TeeSink]
+    """Encoders fed with the frames"""
+
+    def __init__(
+        self,
+        clip: vs.VideoNode,
+        sinks: Sequence[TeeSink],
+        prefetch: int | None = None,
+        backlog: int | None = None,
+        progress_update: Callable[[int, int], Any] | None = None,
+    ) -> None:
+        """
+        :param clip:                Clip to render
+        :param sinks:               Encoders reading y4m from stdin
+        :param prefetch:            Number of frames rendered concurrently
+        :param backlog:             Number of rendered frames waiting to be sent
+        :param progress_update:     Called with the number of frames sent and the total
+        """
+        self.clip = clip
+        self.sinks = list(sinks)
+        self.prefetch = prefetch
+        self.backlog = backlog
+        self.progress_update = progress_update
+
+
+    def run(self) -> None:
+        """Feed every sink; the slowest one sets the pace since the queues are bounded"""
+        start = time.monotonic()
+        for sink in self.sinks:
+            sink.start()
+
+        try:
+            self._send(y4m_header(self.clip))
+
+            num_frames = self.clip.num_frames
+            for n, frame in enumerate(self.clip.frames(self.prefetch, self.backlog, close=True), start=1):
+                # one bytes object shared by every queue
+                self._send(b"".join([b"FRAME\n"] + [bytes(frame[p]) for p in range(frame.format.num_planes)]))
+                if self.progress_update:
+                    self.progress_update(n, num_frames)
+        finally:
+            self._send(None)
+            codes = {sink.name: sink.wait() for sink in self.sinks}
+
+        elapsed = time.monotonic() - start
+        fps = self.clip.num_frames / elapsed
+        logger.info(
+            f"Tee: {self.clip.num_frames} frames sent to {len(self.sinks)} sinks at {fps:.2f} fps" +
+            "".join(f"\n    {sink.name}: waited {sink.blocked:.0f}s on a full queue" for sink in self.sinks)
+        )
+
+        failed = [name for name, code in codes.items() if code] + [s.name for s in self.sinks if s.error]
+        for sink in self.sinks:
+            if sink.name not in failed:
+                sink.finish()
+        if failed:
+            raise RuntimeError(f"Tee: sink(s) {', '.join(sorted(set(failed)))} failed")
+
+
+    def _send(self, data: bytes | None) -> None:
+        for sink in self.sinks:
+            sink.put(data)
@@ -1,12 +1,14 @@
 __all__ = ["BDMV", "NCOP", "NCED", "get_encoder"]
 
 import os
-from typing import List, Sequence
+from typing import List, Sequence, Tuple
 
 import vapoursynth as vs
 from vardautomation import JAPANESE, X265, Chapter, FileInfo, OpusEncoder, PresetBD
 
-from .encode import Encoder
+from .crf_search import CRFSearch, settings_with_crf
+from .encode import Defaults, Encoder
+from .zones import merge_zones
 from .parse_bd import ParseBD
 
 
@@ -29,11 +31,19 @@ def get_encoder(
     file: FileInfo, clip: vs.VideoNode, ep_num: int | str,
     chapters: List[int] | List[Chapter] | None = None,
     chapters_names: Sequence[str | None] | None = None,
+    zone_ranges: Sequence[Tuple[int, int]] | None = None,
+    credit_ranges: Sequence[Tuple[int, int]] | None = None,
+    size_budget: float | None = None,
+    frame_hashes: bool = False,
 ) -> Encoder:
     file.set_name_clip_output_ext(".hevc")
 
     enc = Encoder(file, clip, ep_num, chapters, chapters_names)
-    enc.video_encoder(X265, settings="common/x265_settings", resumable=True)
+    enc.video_encoder(
+        X265, settings=settings_with_crf("common/x265_settings", CRFSearch.load(ep_num)), resumable=True, qpfile=True,
+        zonefile=merge_zones(zone_ranges, Defaults.ZONE) if zone_ranges else None,
+        size_budget=size_budget, scene_classes=dict(credits=list(credit_ranges or [])), frame_hashes=frame_hashes
+    )
 
     if chapters and chapters_names:
         enc.make_chapters()
@@ -0,0 +1,167 @@
+__all__ = ["KeyframeTable", "PartialSource"]
+
+import json
+import os
+import subprocess
+from bisect import bisect_right
+from typing import List, Sequence
+
+import vapoursynth as vs
+from lvsfunc import source
+from vardautomation import BinaryPath, VPath, logger
+
+from .cache import cache_path, is_stale
+from .ranges import Range
+
+
+core = vs.core
+
+
+class KeyframeTable:
+    """Timestamps of the video frames and position of the keyframes, read from the packets without decoding anything"""
+
+    SUFFIX = ".keyframes"
+
+    pts: List[float]
+    """Presentation time of every frame relative to the start of the file, in presentation order"""
+    keyframes: List[int]
+    """Frame numbers of the keyframes"""
+
+    def __init__(self, pts: List[float], keyframes: List[int]) -> None:
+        self.pts = pts
+        self.keyframes = keyframes
+
+
+    @classmethod
+    def from_file(cls, path: str | os.PathLike[str]) -> "KeyframeTable":
+        """Read the table from its cache next to the file, or probe the packets and write it"""
+        cache = cache_path(path, cls.SUFFIX)
+        if not is_stale(cache, path):
+            with open(cache, "r") as f:
+                data = json.load(f)
+            return cls(data["pts"], data["keyframes"])
+
+        probe = subprocess.run(
+            [
+                BinaryPath.ffmpeg.with_name("ffprobe").to_str(), "-v", "error", "-select_streams", "v:0",
+                "-show_entries", "format=start_time:packet=pts_time,flags", "-of", "json", VPath(path).to_str()
+            ],
+            capture_output=True, check=True, text=True
+        )
+        info = json.loads(probe.stdout)
+        # -ss is relative to the start of the file
+        start = float(info["format"].get("start_time", 0))
+
+        packets = sorted(
+            (float(p["pts_time"]) - start, "K" in p["flags"]) for p in info["packets"] if "pts_time" in p
+        )
+        table = cls([round(pts, 6) for pts, _ in packets], [n for n, (_, key) in enumerate(packets) if key])
+
+        with open(cache, "w") as f:
+            json.dump(dict(pts=table.pts, keyframes=table.keyframes), f)
+        return table
+
+
+    @property
+    def num_frames(self) -> int:
+        return len(self.pts)
+
+
+    def gop_start(self, frame: int) -> int:
+        """Keyframe the decoding of a frame starts from"""
+        return self.keyframes[max(bisect_right(self.keyframes, frame) - 1, 0)]
+
+
+class PartialSource:
+    """
+    Source decoding only the declared frame ranges of a file, from the GOPs covering them.
+    The decoded ranges are cached losslessly, so the cost of a source only used for a few frames
+    scales with these frames instead of the length of the file.
+    """
+
+    DIR = VPath("web_cache")
+
+    path: VPath
+    """Path of the source file"""
+    table: KeyframeTable
+    """Frame timestamps and keyframes of the file"""
+    ranges: List[Range]
+    """Declared inclusive ranges, in frames of :py:attr:`clip`"""
+    offset: int
+    """Frames of the file before frame 0 of :py:attr:`clip`, like a ``[offset:]`` trim"""
+    clip: vs.VideoNode
+    """Clip with the length of the trimmed file, only the declared frames can be requested"""
+
+    def __init__(self, path: str | os.PathLike[str], ranges: Sequence[int | Range], offset: int = 0) -> None:
+        """
+        :param path:        Source file (e.g. the WEB episode)
+        :param ranges:      Inclusive frame ranges or single frames that will be requested, after the offset
+        :param offset:      Number of frames trimmed from the start of the file
+        """
+        self.path = VPath(path)
+        self.offset = offset
+        self.table = KeyframeTable.from_file(self.path)
+
+        merged: List[Range] = []
+        for start, end in sorted((r, r) if isinstance(r, int) else r for r in ranges):
+            if not 0 <= start <= end < self.table.num_frames - offset:
+                raise ValueError(f"PartialSource: range ({start}, {end}) is out of {self.path.name}")
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        self.ranges = merged
+
+        segments = [self._segment(start + offset, end + offset) for start, end in self.ranges]
+        if not segments:
+            raise ValueError("PartialSource: no frame range declared")
+
+        length = self.table.num_frames - offset
+        missing = core.std.BlankClip(segments[0], length=length)
+        missing = core.std.FrameEval(missing, self._missing)
+
+        parts: List[vs.VideoNode] = []
+        position = 0
+        for (start, end), segment in zip(self.ranges, segments):
+            if start > position:
+                parts.append(missing[position:start])
+            parts.append(segment)
+            position = end + 1
+        if position < length:
+            parts.append(missing[position:])
+
+        self.clip = core.std.Splice(parts) if len(parts) > 1 else parts[0]
+
+
+    def _segment(self, start: int, end: int) -> vs.VideoNode:
+        """Decode the frames of the file from start to end, inclusive, from their keyframe"""
+        self.DIR.mkdir(exist_ok=True)
+        path = self.DIR / f"{self.path.stem}_{start}_{end}.mkv"
+
+        if is_stale(path, self.path):
+            tmp = path.with_suffix(".tmp.mkv")
+            # ffmpeg seeks to the keyframe at or before the frame and drops the frames decoded before it
+            params = [
+                BinaryPath.ffmpeg.to_str(), "-hide_banner", "-loglevel", "error", "-y",
+                "-ss", f"{self.table.pts[start]:.6f}", "-i", self.path.to_str(),
+                "-map", "0:v:0", "-frames:v", str(end - start + 1),
+                "-c:v", "ffv1", "-level", "3", "-g", "1",
+                tmp.to_str()
+            ]
+            logger.info(
+                f"Decoding frames {start}-{end} of {self.path.name} "
+                f"({end - self.table.gop_start(start) + 1} frames from the keyframe)"
+            )
+            subprocess.run(params, check=True)
+            os.replace(tmp, path)
+
+        clip = source(path.resolve().to_str(), force_lsmas=True)
+        if clip.num_frames != end - start + 1:
+            path.unlink()
+            raise ValueError(f"PartialSource: decoded {clip.num_frames} frames of {self.path.name}, "
+                             f"expected {end - start + 1}")
+        return clip
+
+
+    def _missing(self, n: int) -> vs.VideoNode:
+        raise ValueError(f"PartialSource: frame {n} of {self.path.name} wasn't declared")
@@ -0,0 +1,170 @@
+"""
+Y4M frame feed writing the plane buffers of the frames straight to the encoder pipe
+
+Benchmark against ``clip.output`` (from the show folder)::
+
+    python -m common.y4m --frames 500
+"""
+__all__ = ["Y4MPipeOutput", "set_pipe_size", "write_y4m"]
+
+import os
+import subprocess
+from typing import Any, BinaryIO, Callable, List, cast
+
+import numpy as np
+import vapoursynth as vs
+from vardautomation import VideoEncoder, logger
+
+from .tee import y4m_header
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+
+PIPE_SIZE = 16 << 20
+"""Requested pipe buffer size, capped by /proc/sys/fs/pipe-max-size"""
+
+_F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+_IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") and "SC_IOV_MAX" in os.sysconf_names else 1024
+_FRAME = memoryview(b"FRAME\n")
+
+
+def set_pipe_size(fd: int, size: int = PIPE_SIZE) -> int:
+    """Grow the buffer of a pipe (Linux only), returns the new size or 0 if it couldn't be changed"""
+    if fcntl is None:
+        return 0
+
+    try:
+        with open("/proc/sys/fs/pipe-max-size", "r") as f:
+            size = min(size, int(f.read()))
+    except OSError:
+        pass
+
+    try:
+        return fcntl.fcntl(fd, _F_SETPIPE_SZ, size)
+    except OSError:
+        return 0
+
+
+def write_y4m(
+    clip: vs.VideoNode,
+    stream: BinaryIO,
+    progress_update: Callable[[int, int], Any] | None = None,
+    prefetch: int = 0,
+    backlog: int = -1,
+    on_frame: Callable[[int, vs.VideoFrame], Any] | None = None,
+) -> None:
+    """
+    Drop-in for ``clip.output(stream, y4m=True, ...)``.
+    Every frame is sent with one vectored write of its plane buffers, without copying them in Python.
+    VapourSynth keeps rendering up to ``backlog`` frames ahead while the encoder reads.
+
+    :param on_frame:    Called with the number and the frame before it is sent (e.g. to hash it)
+    """
+    if not hasattr(os, "writev") and on_frame is None:
+        clip.output(stream, y4m=True, progress_update=progress_update, prefetch=prefetch, backlog=backlog)
+        return
+
+    stream.flush()
+    fd = stream.fileno()
+    set_pipe_size(fd)
+
+    num_frames = clip.num_frames
+    _write_all(fd, [memoryview(y4m_header(clip))])
+    if progress_update:
+        progress_update(0, num_frames)
+
+    # same defaults as clip.output
+    frames = clip.frames(prefetch if prefetch > 0 else None, backlog if backlog >= 0 else None, close=True)
+    for n, frame in enumerate(frames):
+        if on_frame:
+            on_frame(n, frame)
+
+        buffers = [_FRAME]
+        for p in range(frame.format.num_planes):
+            buffers += _plane_buffers(frame[p])
+        _write_all(fd, buffers)
+
+        if progress_update:
+            progress_update(n + 1, num_frames)
+
+
+def _plane_buffers(plane: Any) -> List[memoryview]:
+    view = memoryview(plane)
+    if view.c_contiguous:
+        return [view.cast("B")]
+    # padded rows, one buffer per row (memoryview can't index rows of a 2D buffer)
+    return [memoryview(row).cast("B") for row in np.asarray(view)]
+
+
+def _write_all(fd: int, buffers: List[memoryview]) -> None:
+    if not hasattr(os, "writev"):
+        for buffer in buffers:
+            while buffer:
+                buffer = buffer[os.write(fd, buffer):]
+        return
+
+    i = 0
+    while i < len(buffers):
+        written = os.writev(fd, buffers[i:i + _IOV_MAX])
+        # skip what has been written, a partial write leaves the rest of a buffer
+        while i < len(buffers) and written >= len(buffers[i]):
+            written -= len(buffers[i])
+            i += 1
+        if written:
+            buffers[i] = buffers[i][written:]
+
+
+class Y4MPipeOutput(VideoEncoder):
+    """Mixin replacing ``clip.output`` by :py:func:`write_y4m` in a vardautomation video encoder"""
+
+    on_frame: Callable[[int, vs.VideoFrame], Any] | None = None
+    """See :py:func:`write_y4m`"""
+
+    def _do_encode(self) -> None:
+        logger.info(f"{self.__class__.__name__} command: " + " ".join(self.params))
+        with logger.catch_ctx(), subprocess.Popen(self.params, stdin=subprocess.PIPE) as process:
+            write_y4m(
+                self.clip, cast(BinaryIO, process.stdin),
+                self.progress_update, self.prefetch, self.backlog, self.on_frame
+            )
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Compare clip.output and write_y4m on a pipe")
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    core = vs.core
+    bench_clip = core.std.BlankClip(
+        format=vs.YUV420P10, width=args.width, height=args.height, length=args.frames, keep=True
+    )
+    frame_bytes = len(y4m_header(bench_clip)) / args.frames + 6 + args.width * args.height * 3
+
+    def _clip_output(stream: BinaryIO) -> None:
+        bench_clip.output(stream, y4m=True)
+
+    def _write_y4m(stream: BinaryIO) -> None:
+        write_y4m(bench_clip, stream)
+
+    for name, func in [("clip.output", _clip_output), ("write_y4m", _write_y4m)]:
+        best = float("inf")
+        for _ in range(args.runs):
+            with open(os.devnull, "wb") as devnull:
+                reader = subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=devnull)
+                assert reader.stdin
+                start = time.perf_counter()
+                func(cast(BinaryIO, reader.stdin))
+                reader.stdin.close()
+                reader.wait()
+                best = min(best, time.perf_counter() - start)
+
+        print(f"{name:>12}: {args.frames / best:8.1f} fps {args.frames * frame_bytes / best / 2 ** 20:8.1f} MiB/s")
@@ -0,0 +1,71 @@
+__all__ = ["merge_zones", "write_zonefile"]
+
+import os
+from typing import Any, Dict, List, Mapping, Sequence, Tuple
+
+from vardautomation import logger
+
+from .ranges import Range
+
+
+def merge_zones(ranges: Sequence[Range | None], settings: Dict[str, Any]) -> Dict[Range, Dict[str, Any]]:
+    """Merge overlapping or adjacent ranges sharing the same zone settings"""
+    merged: List[Range] = []
+    for start, end in sorted(r for r in ranges if r is not None):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return {r: settings for r in merged}
+
+
+def write_zonefile(
+    path: str | os.PathLike[str],
+    zones: Mapping[Range, Mapping[str, Any]],
+    base: Sequence[str],
+    num_frames: int,
+    offset: int = 0,
+) -> None:
+    """
+    Write a x265 zonefile. Every zone is followed by an entry restoring the base settings.
+
+    :param path:        Zonefile path
+    :param zones:       Inclusive ranges and the options (without dashes) to use on them
+    :param base:        Base encoder parameters, used to restore the options after every zone
+    :param num_frames:  Number of frames actually sent to the encoder
+    :param offset:      First frame sent to the encoder (resumed encodes)
+    """
+    lines: List[Tuple[int, str]] = []
+    last_end = -1
+
+    for (start, end), options in sorted(zones.items()):
+        if start <= last_end:
+            raise ValueError(f"Zone ({start}, {end}) overlaps the previous one")
+        last_end = end
+
+        start, end = max(start - offset, 0), end - offset
+        if end < 0 or start >= num_frames:
+            continue
+
+        restore: Dict[str, Any] = {}
+        for opt in options:
+            if f"--{opt}" not in base[:-1]:
+                raise ValueError(f"Zone option \"{opt}\" is not set in the encoder settings, it couldn't be restored")
+            restore[opt] = base[base.index(f"--{opt}") + 1]
+
+        lines.append((start, _format(options)))
+        if end + 1 < num_frames:
+            lines.append((end + 1, _format(restore)))
+
+    # a restore entry is useless when the next zone starts right after
+    lines = [line for line, nxt in zip(lines, lines[1:] + [(-1, "")]) if line[0] != nxt[0]]
+
+    with open(path, "w") as f:
+        f.writelines([f"{frame} {opts}\n" for frame, opts in lines])
+
+    logger.info(f"Zonefile: {len(zones)} zone(s) written to {path}")
+
+
+def _format(options: Mapping[str, Any]) -> str:
+    return " ".join(f"--{k} {v}" for k, v in options.items())